@@ -20,14 +20,9 @@ def main():
     # Setup logging
     logger = setup_logger()
     
-    # Initialize config
+    # Reading the config never writes it; commands that change state save it
     config = Config()
     
-    # Check if pig3on is properly installed
-    if not config.is_initialized():
-        logger.info("First time setup...")
-        config.initialize()
-    
     # Initialize CLI
     cli = CLI(config)
     
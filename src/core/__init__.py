@@ -1,8 +1,18 @@
 """Core functionality for Pig3on"""
 
-from .cli import CLI
-from .config import Config
-from .connection import ConnectionManager
-from .transfer import FileTransfer
+from importlib import import_module
 
-__all__ = ['CLI', 'Config', 'ConnectionManager', 'FileTransfer']
\ No newline at end of file
+# Name -> submodule; imported on first access so `import core.x` stays cheap
+_EXPORTS = {
+    'CLI': 'cli',
+    'Config': 'config',
+    'ConnectionManager': 'connection',
+    'FileTransfer': 'transfer',
+}
+
+__all__ = ['CLI', 'Config', 'ConnectionManager', 'FileTransfer']
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(f'.{_EXPORTS[name]}', __name__), name)
@@ -0,0 +1,345 @@
+"""
+Batch Transfer for Pig3on
+Streams many files and directories back-to-back in one session
+"""
+
+import os
+import glob
+import time
+from pathlib import Path, PurePosixPath
+from utils.logger import get_logger
+from .compression import CODECS, Compressor, choose_codec, decompress, offered_codecs, send_chunk
+from .integrity import StreamHasher
+from .protocol import FLAG_COMPRESSED, FRAME_CONTROL
+
+logger = get_logger(__name__)
+
+
+def expand_sources(patterns):
+    """Expand glob patterns (the shell doesn't on Windows) into existing paths"""
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            for match in sorted(glob.iglob(pattern)):
+                yield Path(match)
+        else:
+            yield Path(pattern)
+
+
+def walk_sources(paths):
+    """
+    Lazily yield (path, relative posix path, is_dir) for every file and
+    directory below the given paths. Directories keep their own name as
+    the root of their entries.
+    """
+    for path in paths:
+        if path.is_dir():
+            yield from _walk_dir(path, PurePosixPath(path.resolve().name))
+        elif path.exists():
+            yield path, str(PurePosixPath(path.name)), False
+        else:
+            logger.warning(f"Skipping missing path: {path}")
+
+
+def _walk_dir(path, relative):
+    yield path, str(relative), True
+    try:
+        with os.scandir(path) as entries:
+            children = sorted(entries, key=lambda entry: entry.name)
+    except OSError as e:
+        logger.warning(f"Skipping unreadable directory {path}: {e}")
+        return
+
+    for entry in children:
+        child = Path(entry.path)
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk_dir(child, relative / entry.name)
+        elif entry.is_file():
+            yield child, str(relative / entry.name), False
+
+
+def safe_destination(root, relative):
+    """Resolve an entry path under root, refusing anything that would escape it"""
+    parts = PurePosixPath(relative).parts
+    if not parts or PurePosixPath(relative).is_absolute():
+        return None
+    if any(part in ('', '.', '..') or ':' in part or '\\' in part for part in parts):
+        return None
+    return Path(root).joinpath(*parts)
+
+
+class BatchTransfer:
+    """Sends and receives multi-file batches as one multiplexed stream"""
+
+    WINDOW_BYTES = 8 * 1024 * 1024  # Unacknowledged bytes before the sender waits
+    MAX_PENDING = 4096              # Unacknowledged entries before the sender waits
+    ACK_ENTRIES = 256               # Receiver acknowledges after this many entries...
+    ACK_BYTES = 1024 * 1024         # ...or this many bytes, whichever comes first
+    ENTRY_OVERHEAD = 256            # Approximate framing cost per entry
+
+    def __init__(self, config, connection_manager, packet_size):
+        self.config = config
+        self.connection = connection_manager
+        self.packet_size = packet_size
+        self.totals = (0, 0)    # Files and bytes moved by the last send or receive
+
+    @property
+    def _channel(self):
+        return self.connection.channel
+
+    def send(self, paths, compression=None):
+        """Send files and directories; returns True if every entry arrived intact"""
+        request = {'type': 'BATCH_TRANSFER', 'window': self.WINDOW_BYTES}
+        if 'compress' in self.connection.peer_features:
+            codecs = offered_codecs(compression or self.config.compression)
+            if codecs:
+                request['compression'] = codecs
+        self._channel.send_control(request)
+
+        ready = self._channel.receive_control()
+        if ready.get('status') != 'READY':
+            logger.error("Peer not ready to receive")
+            return False
+
+        codec = ready.get('compression')
+        compressor = Compressor(codec) if codec in CODECS else None
+
+        pending = []        # (id, relative path, size) awaiting acknowledgment
+        in_flight = 0
+        failed = []
+        entry_id = 0
+        files = 0
+        total_bytes = 0
+        start_time = time.time()
+        f = None
+
+        try:
+            ranges = self._walk_ranges(paths)
+            if compressor:
+                # Upcoming packets, across files, are compressed in the pool meanwhile
+                ranges = compressor.pipeline(ranges, self._chunk_range)
+            else:
+                ranges = ((item, None) for item in ranges)
+
+            for (path, relative, size, offset), chunk in ranges:
+                if offset == 0:
+                    if size is None:
+                        self._channel.send_control({'type': 'ENTRY', 'id': entry_id,
+                                                    'path': relative, 'dir': True})
+                    else:
+                        try:
+                            f = open(path, 'rb')
+                        except OSError as e:
+                            logger.warning(f"Skipping unreadable file {path}: {e}")
+                            continue
+                        self._channel.send_control({'type': 'ENTRY', 'id': entry_id,
+                                                    'path': relative, 'size': size})
+                        hasher = StreamHasher()
+                elif f is None:
+                    continue  # Rest of a file that couldn't be opened
+
+                if size:
+                    length = min(self.packet_size, size - offset)
+                    send_chunk(self._channel, f, offset, length, chunk, FLAG_COMPRESSED,
+                               stream_id=entry_id)
+                    hasher.update_from_file(f, offset, length)
+                    if compressor:
+                        compressor.account(length, chunk)
+                    if offset + length < size:
+                        continue
+
+                if f is not None:
+                    f.close()
+                    f = None
+                    self._channel.send_control({'type': 'ENTRY_END', 'id': entry_id,
+                                                'checksum': hasher.hexdigest()})
+
+                pending.append((entry_id, relative, size or 0))
+                in_flight += (size or 0) + self.ENTRY_OVERHEAD
+                total_bytes += size or 0
+                files += size is not None
+                entry_id += 1
+
+                # Batched acknowledgments replace per-file handshakes
+                while in_flight > self.WINDOW_BYTES or len(pending) > self.MAX_PENDING:
+                    in_flight -= self._process_ack(self._channel.receive_control(),
+                                                   pending, failed)
+
+            self._channel.send_control({'type': 'BATCH_COMPLETE', 'entries': entry_id})
+
+            while True:
+                message = self._channel.receive_control()
+                if message.get('type') == 'ACK':
+                    self._process_ack(message, pending, failed)
+                    continue
+                break
+
+        except KeyboardInterrupt:
+            self._channel.send_control({'type': 'CANCEL'})
+            logger.error("\n❌ Transfer cancelled by user")
+            return False
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self._channel.send_control({'type': 'ERROR', 'message': str(e)})
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            return False
+        finally:
+            if f is not None:
+                f.close()
+            if compressor:
+                compressor.close()
+
+        self.totals = (files, total_bytes)
+        elapsed = time.time() - start_time
+        logger.info(f"📦 Sent {entry_id} entries ({total_bytes} bytes) in {elapsed:.1f}s")
+        if compressor:
+            compressor.report(lambda size: f"{size} bytes")
+
+        for relative in failed:
+            logger.error(f"Failed on peer: {relative}")
+
+        return message.get('status') == 'SUCCESS' and not failed
+
+    def _walk_ranges(self, paths):
+        """
+        Yield (path, relative path, size, offset) for every packet of every
+        entry; directories have size None and empty files one empty packet.
+        """
+        for path, relative, is_dir in walk_sources(paths):
+            if is_dir:
+                yield path, relative, None, 0
+                continue
+            try:
+                size = path.stat().st_size
+            except OSError as e:
+                logger.warning(f"Skipping unreadable file {path}: {e}")
+                continue
+            for offset in range(0, max(size, 1), self.packet_size):
+                yield path, relative, size, offset
+
+    def _chunk_range(self, item):
+        """File range a packet covers, for the compressor"""
+        path, _, size, offset = item
+        if not size:
+            return None
+        return path, offset, min(self.packet_size, size - offset)
+
+    def _process_ack(self, message, pending, failed):
+        """Retire acknowledged entries; returns the bytes they freed from the window"""
+        if message.get('type') == 'CANCEL':
+            raise Exception("Transfer cancelled by receiver")
+        if message.get('type') != 'ACK':
+            raise Exception(message.get('message', 'Batch not acknowledged'))
+
+        failed_ids = set(message.get('failed', []))
+        freed = 0
+        while pending and pending[0][0] < message['ack']:
+            entry_id, relative, size = pending.pop(0)
+            if entry_id in failed_ids:
+                failed.append(relative)
+            freed += size + self.ENTRY_OVERHEAD
+        return freed
+
+    def receive(self, metadata):
+        """Receive a batch into download_dir, recreating its directory structure"""
+        root = Path(self.config.download_dir)
+        root.mkdir(parents=True, exist_ok=True)
+
+        open_files = {}     # id -> (file, part path, final path, hasher, size)
+        completed = 0
+        acked = 0
+        unacked_bytes = 0
+        failed = []
+        files = 0
+        total_bytes = 0
+
+        codec = choose_codec(metadata.get('compression'))
+        ready = {'status': 'READY'}
+        if codec:
+            ready['compression'] = codec
+        self._channel.send_control(ready)
+        logger.info("\n📥 Incoming batch transfer")
+
+        try:
+            while True:
+                frame = self._channel.receive()
+
+                if frame.type != FRAME_CONTROL:
+                    entry = open_files.get(frame.stream_id)
+                    if entry is None:
+                        continue  # Data for an entry that was refused
+                    f, _, _, hasher, size = entry
+                    if frame.offset != hasher.position:
+                        raise Exception(f"Unexpected data at {frame.offset} for entry {frame.stream_id}")
+                    payload = frame.payload
+                    if frame.flags & FLAG_COMPRESSED:
+                        if not codec:
+                            raise Exception("Compressed data without a negotiated codec")
+                        payload = decompress(codec, payload, size - frame.offset)
+                    f.write(payload)
+                    hasher.update(payload, frame.offset)
+                    unacked_bytes += len(payload)
+                    continue
+
+                message = frame.payload
+                kind = message.get('type')
+
+                if kind == 'ENTRY':
+                    destination = safe_destination(root, message['path'])
+                    if destination is None:
+                        logger.warning(f"Refusing unsafe path: {message['path']}")
+                        failed.append(message['id'])
+                        if message.get('dir'):
+                            completed += 1
+                    elif message.get('dir'):
+                        destination.mkdir(parents=True, exist_ok=True)
+                        completed += 1
+                    else:
+                        destination.parent.mkdir(parents=True, exist_ok=True)
+                        part_path = destination.with_name(destination.name + '.part')
+                        open_files[message['id']] = (open(part_path, 'wb'), part_path,
+                                                     destination, StreamHasher(),
+                                                     message.get('size', 0))
+
+                elif kind == 'ENTRY_END':
+                    entry = open_files.pop(message['id'], None)
+                    if entry is not None:
+                        f, part_path, destination, hasher, _ = entry
+                        f.close()
+                        if hasher.hexdigest() == message.get('checksum'):
+                            os.replace(part_path, destination)
+                            files += 1
+                            total_bytes += hasher.position
+                        else:
+                            logger.error(f"❌ Verification failed: {destination.name}")
+                            part_path.unlink()
+                            failed.append(message['id'])
+                    completed += 1
+
+                elif kind == 'BATCH_COMPLETE':
+                    break
+
+                elif kind in ('CANCEL', 'ERROR'):
+                    logger.error(f"\n❌ Transfer error: {message.get('message', 'Cancelled by sender')}")
+                    return False
+
+                else:
+                    raise Exception(f"Unexpected message {kind}")
+
+                if (completed - acked >= self.ACK_ENTRIES or
+                        (unacked_bytes >= self.ACK_BYTES and completed > acked)):
+                    self._channel.send_control({'type': 'ACK', 'ack': completed, 'failed': failed})
+                    acked = completed
+                    unacked_bytes = 0
+                    failed = []
+
+            self._channel.send_control({'type': 'ACK', 'ack': completed, 'failed': failed})
+            self._channel.send_control({'status': 'SUCCESS', 'entries': completed})
+            self.totals = (files, total_bytes)
+            logger.info(f"✅ Received {completed} entries ({total_bytes} bytes) into: {root}")
+            return True
+
+        finally:
+            for f, part_path, _, _, _ in open_files.values():
+                f.close()
+                part_path.unlink()
@@ -0,0 +1,617 @@
+"""
+Benchmarks for Pig3on
+Loopback transfers that measure throughput, latency and resource use
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+import contextlib
+from pathlib import Path
+from utils.crypto import AEAD_AVAILABLE
+from utils.logger import get_logger
+from .config import SIZE_UNITS, Config, parse_size
+from .connection import ConnectionManager
+from .protocol import MAX_PAYLOAD_SIZE
+from .storage import check_space
+from .transfer import FileTransfer
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+logger = get_logger(__name__)
+
+SPARSE_SIZE = 256 * 1024 * 1024     # Payloads this large are written as sparse files
+DEDUP_STORE = 16 * 1024 ** 3        # Chunk store the receiver keeps in dedup scenarios
+REGRESSION_THRESHOLD = 10.0         # Percent a scenario may get slower before it is flagged
+TTFB_NOISE = 2.0                    # Milliseconds of TTFB change never flagged
+MIN_CHUNK = 4 * 1024
+MAX_CHUNK = MAX_PAYLOAD_SIZE        # Largest data frame a receiver accepts
+RESULTS_VERSION = 1
+STARTUP_COMMANDS = ('help', 'status', 'trust')
+IMPORT_BUDGET = 50.0                # Milliseconds of imports a command may spend before it runs
+ENTRY_POINT = Path(__file__).resolve().parents[2] / 'pig3on.py'
+
+
+def parse_sizes(text):
+    """Parse a comma-separated list of sizes; 'none' or an empty list gives no sizes"""
+    if text.strip().lower() in ('', 'none'):
+        return []
+    return [parse_size(part) for part in text.split(',')]
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def scratch_config(root, name):
+    """A Config that keeps all its state under root, leaving the user's own untouched"""
+    config = Config()
+    config.config_dir = root / name
+    config.config_file = config.config_dir / 'config.json'
+    config.chunk_dir = config.config_dir / 'chunks'
+    config.peers_file = config.config_dir / 'peers.json'
+    config.history_file = config.config_dir / 'history.jsonl'
+    config.download_dir = root / name / 'received'
+    config.peer_links = {}
+    config.accept_policy = 'auto'
+    config.metrics_file = ''
+    config.config_dir.mkdir(parents=True, exist_ok=True)
+    return config
+
+
+@contextlib.contextmanager
+def quiet():
+    """Hide progress bars and log lines while measuring; failures surface as exceptions"""
+    pig3on = logging.getLogger('pig3on')
+    level = pig3on.level
+    pig3on.setLevel(logging.CRITICAL)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        pig3on.setLevel(level)
+
+
+def receiver_config(root, transfer_port, discovery_port, chunk_store_limit=0):
+    """The loopback receiver's config; the same whether it runs in this process or a child"""
+    config = scratch_config(root, 'receiver')
+    config.transfer_port = transfer_port
+    config.discovery_port = discovery_port
+    config.chunk_store_limit = chunk_store_limit
+    return config
+
+
+def _listen(config):
+    """Start a non-discoverable listener for config and wait until it accepts"""
+    listener = ConnectionManager(config)
+    listener.discoverable = False
+    listener.listening = True
+    threading.Thread(target=listener._listen_loop, daemon=True).start()
+    deadline = time.time() + 5
+    while listener.server_socket is None:
+        if time.time() > deadline:
+            raise Exception("Loopback listener did not start")
+        time.sleep(0.01)
+    return listener
+
+
+def serve_receiver(root, transfer_port, discovery_port, chunk_store_limit=0):
+    """Entry point of a receiver process started by LoopbackBench; runs until stdin closes"""
+    _listen(receiver_config(Path(root), transfer_port, discovery_port, chunk_store_limit))
+    print('ready', flush=True)
+    sys.stdout = open(os.devnull, 'w')     # Nobody reads the pipe from here on
+    sys.stdin.read()
+
+
+class LoopbackBench:
+    """
+    A listener and a sender that pairs with it over loopback. The listener
+    runs in this process, or with separate=True in a child process, which
+    keeps the two sides from sharing an interpreter lock and shows each
+    side's memory on its own. With a chunk_store_limit the receiver
+    deduplicates, starting every run from an empty store.
+    """
+
+    def __init__(self, root, separate=False, chunk_store_limit=0):
+        self.root = Path(root)
+        self.separate = separate
+        self.receiver = receiver_config(self.root, _free_port(), _free_port(), chunk_store_limit)
+        self.listener = None
+        self.process = None
+
+    @property
+    def pids(self):
+        """Processes taking part in the transfers"""
+        return [os.getpid()] + ([self.process.pid] if self.process else [])
+
+    def start(self):
+        if not self.separate:
+            self.listener = _listen(self.receiver)
+            return
+
+        src = Path(__file__).resolve().parents[1]
+        script = ("import sys; sys.path.insert(0, sys.argv[1]); "
+                  "from core.bench import serve_receiver; "
+                  "serve_receiver(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))")
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', script, str(src), str(self.root),
+             str(self.receiver.transfer_port), str(self.receiver.discovery_port),
+             str(self.receiver.chunk_store_limit)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if self.process.stdout.readline().strip() != 'ready':
+            self.stop()
+            raise Exception("Loopback receiver process did not start")
+
+    def stop(self):
+        if self.listener:
+            self.listener.listening = False
+        if self.process:
+            self.process.stdin.close()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+            self.process = None
+
+    def _wait_idle(self, timeout=5):
+        """Let the listener finish with the last session so runs don't overlap"""
+        if self.listener is None:
+            return
+        deadline = time.time() + timeout
+        while self.listener.sessions and time.time() < deadline:
+            time.sleep(0.01)
+
+    def sender(self, **settings):
+        """A sender config with the given settings, e.g. encryption='off'"""
+        config = scratch_config(self.root, 'sender')
+        config.compression = 'off'
+        for key, value in settings.items():
+            setattr(config, key, value)
+        return config
+
+    def send(self, config, path, streams=1, packet_size=None):
+        """
+        Pair, send a file or directory and disconnect. Returns the seconds
+        the transfer took and the seconds until the first data frame went
+        out (None where the transfer doesn't send through the session's
+        channel, e.g. batches).
+        """
+        connection = ConnectionManager(config)
+        if not connection.connect({'name': 'loopback', 'address': '127.0.0.1',
+                                   'port': self.receiver.transfer_port, 'protocol': 2}):
+            raise Exception("Could not pair over loopback")
+        try:
+            first_byte = []
+            channel = connection.channel
+            for method in ('send_data', 'send_frame', 'send_file_range'):
+                setattr(channel, method, _first_call(getattr(channel, method), first_byte))
+
+            transfer = FileTransfer(config, connection)
+            transfer.packet_size = packet_size
+            start_time = time.perf_counter()
+            if not transfer.send_paths([path], streams=streams):
+                raise Exception("Loopback transfer failed")
+            seconds = time.perf_counter() - start_time
+            return seconds, (first_byte[0] - start_time if first_byte else None)
+        finally:
+            connection.disconnect()
+            self._wait_idle()
+            # A copy left on the receiver would turn the next run into a delta sync
+            received = self.receiver.download_dir / Path(path).name
+            if received.is_dir():
+                shutil.rmtree(received)
+            elif received.exists():
+                received.unlink()
+            # Stored chunks would let the next run skip sending them
+            if self.receiver.chunk_store_limit:
+                shutil.rmtree(self.receiver.chunk_dir, ignore_errors=True)
+
+
+def _first_call(method, times):
+    """Wrap method to note when it is first called"""
+    def wrapper(*args, **kwargs):
+        if not times:
+            times.append(time.perf_counter())
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def _cpu_seconds(pid):
+    """User plus system CPU time a process has used so far"""
+    if pid == os.getpid():
+        return time.process_time()
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def _peak_rss(pid):
+    """Peak resident memory of a process in bytes, from /proc or else getrusage"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource and pid == os.getpid():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return 0
+
+
+class ResourceMeter:
+    """
+    CPU time and peak resident memory of the benchmark's processes over a
+    scenario. Linux lets the peak be reset, so each scenario reports its
+    own; elsewhere the peak covers everything since the process started.
+    """
+
+    def __init__(self, pids):
+        self.pids = pids
+        self._cpu = 0.0
+
+    def start(self):
+        for pid in self.pids:
+            try:
+                with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                    f.write('5')
+            except OSError:
+                pass
+        self._cpu = sum(_cpu_seconds(pid) for pid in self.pids)
+
+    def stop(self):
+        """Returns CPU seconds used since start() and the summed peak RSS in bytes"""
+        cpu = sum(_cpu_seconds(pid) for pid in self.pids) - self._cpu
+        return cpu, sum(_peak_rss(pid) for pid in self.pids)
+
+
+def make_payload(path, size, sparse=None):
+    """
+    Write size bytes of incompressible data. Payloads of SPARSE_SIZE or
+    more are sparse files instead, so a 10 GB run needs no 10 GB of source
+    data; reading the holes costs no disk time, which leaves the network
+    and hashing path as what is measured.
+    """
+    if sparse is None:
+        sparse = size >= SPARSE_SIZE
+    with open(path, 'wb') as f:
+        if sparse:
+            f.truncate(size)
+            return
+        block = os.urandom(min(size, 4 * 1024 * 1024))
+        remaining = size
+        while remaining:
+            count = min(remaining, len(block))
+            f.write(block[:count])
+            remaining -= count
+
+
+def make_files(directory, count, size):
+    """A directory of count incompressible files of size bytes each"""
+    directory.mkdir(parents=True)
+    for index in range(count):
+        make_payload(directory / f'file-{index:05d}.bin', size, sparse=False)
+
+
+def encryption_benchmark(size, runs=3):
+    """Compare plain and encrypted loopback throughput; returns {mode: MB/s}"""
+    modes = [('plain', {'encryption': 'off'})]
+    if AEAD_AVAILABLE:
+        modes.append(('encrypted', {'encryption': 'aead'}))
+    else:
+        logger.warning("The cryptography package isn't installed; measuring plain transfers only")
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='pig3on-bench-') as root:
+        bench = LoopbackBench(root)
+        payload = Path(root) / 'payload.bin'
+        make_payload(payload, size)
+        with quiet():
+            bench.start()
+        try:
+            for mode, settings in modes:
+                config = bench.sender(**settings)
+                with quiet():
+                    best = min(bench.send(config, payload)[0] for _ in range(runs))
+                results[mode] = size / best / (1024 * 1024)
+        finally:
+            bench.stop()
+    return results
+
+
+def report_encryption(results, size, runs):
+    """Log the encrypted-vs-plain comparison"""
+    logger.info(f"\n🏁 Loopback transfer of {size / (1024 * 1024):.0f} MB, best of {runs}")
+    plain = results.get('plain')
+    for mode, rate in results.items():
+        change = f"  ({(rate - plain) / plain * 100:+.1f}%)" if mode != 'plain' and plain else ""
+        logger.info(f"  {mode:<10} {rate:8.1f} MB/s{change}")
+
+
+def size_label(size):
+    """The shortest exact spelling of size that parse_size reads back, e.g. 64M"""
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+def plan_suite(sizes=(), counts=(), file_size=16 * 1024, chunks=(), chunk_file=64 * 1024 * 1024,
+               dedup=()):
+    """
+    The scenarios of a benchmark run: one file of each size, a directory
+    of each count of file_size files, one chunk_file sized file sent with
+    each fixed chunk (packet) size, and one file of each dedup size sent
+    to a receiver with an empty chunk store
+    """
+    scenarios = []
+    for size in sizes:
+        scenarios.append({'name': f"size-{size_label(size)}", 'kind': 'size',
+                          'files': 1, 'bytes': size, 'chunk': None})
+    for count in counts:
+        scenarios.append({'name': f"count-{count}x{size_label(file_size)}", 'kind': 'count',
+                          'files': count, 'bytes': count * file_size, 'chunk': None,
+                          'file_size': file_size})
+    for chunk in chunks:
+        scenarios.append({'name': f"chunk-{size_label(chunk)}", 'kind': 'chunk',
+                          'files': 1, 'bytes': chunk_file, 'chunk': chunk})
+    for size in dedup:
+        scenarios.append({'name': f"dedup-{size_label(size)}", 'kind': 'dedup',
+                          'files': 1, 'bytes': size, 'chunk': None})
+    return scenarios
+
+
+def run_suite(scenarios, runs=3, separate=False, directory=None, **settings):
+    """
+    Run each scenario runs times over loopback, in a scratch directory
+    under directory (the system temp directory by default). Returns one
+    result per scenario; scenarios the filesystem has no room for are
+    skipped with a warning. Dedup scenarios get a receiver of their own
+    that keeps a chunk store.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='pig3on-bench-', dir=directory) as root:
+        benches = {}    # Whether the receiver deduplicates -> (bench, sender config)
+        try:
+            for scenario in scenarios:
+                dedup = scenario['kind'] == 'dedup'
+                if dedup not in benches:
+                    bench = (LoopbackBench(Path(root) / 'dedup', separate, DEDUP_STORE) if dedup
+                             else LoopbackBench(root, separate))
+                    with quiet():
+                        bench.start()
+                    benches[dedup] = (bench, bench.sender(**settings))
+                bench, config = benches[dedup]
+                result = _run_scenario(bench, config, scenario, runs)
+                if result:
+                    results.append(result)
+        finally:
+            for bench, _ in benches.values():
+                bench.stop()
+    return results
+
+
+def _run_scenario(bench, config, scenario, runs):
+    name = scenario['name']
+    size = scenario['bytes']
+    # Holes would be one chunk repeated, which the store sends only once
+    sparse = scenario['kind'] not in ('count', 'dedup') and size >= SPARSE_SIZE
+    copies = 1 if sparse else 2
+    if scenario['kind'] == 'dedup':
+        copies += 1     # The receiver's chunk store
+    try:
+        # The receiver's copy, plus the source unless it is sparse
+        check_space(bench.root, copies * size)
+    except Exception as e:
+        logger.warning(f"Skipping {name}: {e}")
+        return None
+
+    logger.info(f"  ⏱️  {name}")
+    payload = bench.root / 'payload' / name
+    payload.parent.mkdir(exist_ok=True)
+    if scenario['kind'] == 'count':
+        make_files(payload, scenario['files'], scenario['file_size'])
+    else:
+        make_payload(payload, size, sparse)
+
+    meter = ResourceMeter(bench.pids)
+    try:
+        meter.start()
+        with quiet():
+            timings = [bench.send(config, payload, packet_size=scenario['chunk'])
+                       for _ in range(runs)]
+        cpu, peak = meter.stop()
+    finally:
+        if payload.is_dir():
+            shutil.rmtree(payload)
+        else:
+            payload.unlink()
+
+    seconds = statistics.median(elapsed for elapsed, _ in timings)
+    first_bytes = [first for _, first in timings if first is not None]
+    ttfb = statistics.median(first_bytes) * 1000 if first_bytes else None
+    return {
+        'name': name,
+        'kind': scenario['kind'],
+        'files': scenario['files'],
+        'bytes': size,
+        'chunk': scenario['chunk'],
+        'runs': runs,
+        'seconds': round(seconds, 6),
+        'mb_s': round(size / seconds / (1024 * 1024), 2),
+        'files_s': round(scenario['files'] / seconds, 2),
+        'ttfb_ms': round(ttfb, 3) if ttfb is not None else None,
+        'cpu_s': round(cpu / runs, 4),
+        'peak_rss_mb': round(peak / (1024 * 1024), 1),
+    }
+
+
+def suite_document(results, settings):
+    """The JSON document a run is saved as, and compared against later"""
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {'name': socket.gethostname(), 'platform': platform.platform(),
+                 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'settings': settings,
+        'results': results,
+    }
+
+
+def save_suite(document, path):
+    """Write a run's document as JSON to path, or to stdout for '-'"""
+    text = json.dumps(document, indent=2)
+    if path == '-':
+        print(text)
+    else:
+        Path(path).write_text(text + '\n')
+
+
+def load_suite(path):
+    """Read a document saved by save_suite"""
+    try:
+        return json.loads(Path(path).read_text())
+    except (OSError, ValueError) as e:
+        raise Exception(f"Can't read benchmark results {path}: {e}")
+
+
+def report_suite(results):
+    """Log the results as a table"""
+    logger.info(f"\n🏁 {'Scenario':<18} {'Size':>8} {'MB/s':>9} {'files/s':>9} "
+                f"{'TTFB ms':>8} {'CPU s':>7} {'Peak RSS':>9}")
+    for result in results:
+        ttfb = f"{result['ttfb_ms']:.1f}" if result['ttfb_ms'] is not None else "-"
+        logger.info(f"   {result['name']:<18} {size_label(result['bytes']):>8} "
+                    f"{result['mb_s']:>9.1f} {result['files_s']:>9.1f} {ttfb:>8} "
+                    f"{result['cpu_s']:>7.2f} {result['peak_rss_mb']:>6.0f} MB")
+
+
+def compare_suite(document, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare a run against a baseline document scenario by scenario. Logs
+    the change in throughput and TTFB, and returns the names of scenarios
+    whose throughput dropped, or whose TTFB rose, by more than threshold
+    percent.
+    """
+    previous = {result['name']: result for result in baseline.get('results', [])}
+    regressions = []
+    logger.info(f"\n📊 Against the baseline from {baseline.get('created', 'an earlier run')} "
+                f"(threshold {threshold:g}%)")
+    for result in document['results']:
+        before = previous.get(result['name'])
+        if not before:
+            logger.info(f"   {result['name']:<18} new scenario")
+            continue
+
+        changes = []
+        regressed = False
+        if before.get('mb_s'):
+            change = (result['mb_s'] - before['mb_s']) / before['mb_s'] * 100
+            changes.append(f"{before['mb_s']:.1f} → {result['mb_s']:.1f} MB/s ({change:+.1f}%)")
+            regressed = change < -threshold
+        if before.get('ttfb_ms') and result['ttfb_ms'] is not None:
+            change = (result['ttfb_ms'] - before['ttfb_ms']) / before['ttfb_ms'] * 100
+            changes.append(f"TTFB {change:+.1f}%")
+            regressed = regressed or (change > threshold
+                                      and result['ttfb_ms'] - before['ttfb_ms'] > TTFB_NOISE)
+
+        line = f"{result['name']:<18} {', '.join(changes)}"
+        if regressed:
+            regressions.append(result['name'])
+            logger.warning(f"{line}  ← regression")
+        else:
+            logger.info(f"   {line}")
+    return regressions
+
+
+def parse_importtime(text):
+    """
+    Module import times from `python -X importtime` output as (name, self,
+    cumulative, depth) in milliseconds, leaving out what the interpreter
+    imports for itself before the script starts.
+    """
+    entries = []
+    for line in text.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), int(own) / 1000, int(cumulative) / 1000, depth))
+
+    # site is the last module of the interpreter's own start-up
+    for index in range(len(entries) - 1, -1, -1):
+        if entries[index][0] == 'site' and entries[index][3] == 0:
+            return entries[index + 1:]
+    return entries
+
+
+def startup_benchmark(commands=STARTUP_COMMANDS, runs=5):
+    """
+    Run `pig3on <command>` in fresh interpreters with -X importtime against
+    an empty home directory, so no daemon or saved config is involved.
+    Returns each command's median wall time, median import time and the
+    packages that took longest to import.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix='pig3on-startup-') as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        for command in commands:
+            walls, imports, packages = [], [], {}
+            for _ in range(runs):
+                started = time.perf_counter()
+                done = subprocess.run([sys.executable, '-X', 'importtime', str(ENTRY_POINT),
+                                       *command.split()], env=env, stdin=subprocess.DEVNULL,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                walls.append((time.perf_counter() - started) * 1000)
+                entries = parse_importtime(done.stderr)
+                imports.append(sum(cumulative for _, _, cumulative, depth in entries if depth == 0))
+                run_packages = {}
+                for name, own, _, _ in entries:
+                    package = name.split('.')[0]
+                    run_packages[package] = run_packages.get(package, 0.0) + own
+                for package, spent in run_packages.items():
+                    packages.setdefault(package, []).append(spent)
+
+            heaviest = sorted(((statistics.median(spent + [0.0] * (runs - len(spent))), package)
+                               for package, spent in packages.items()), reverse=True)[:5]
+            results.append({
+                'command': command,
+                'wall_ms': round(statistics.median(walls), 1),
+                'import_ms': round(statistics.median(imports), 1),
+                'heaviest': [{'package': package, 'ms': round(spent, 1)} for spent, package in heaviest],
+            })
+    return results
+
+
+def report_startup(results, budget=IMPORT_BUDGET):
+    """Log start-up times; returns the commands whose imports went over budget"""
+    over = []
+    logger.info(f"\n🏁 {'Command':<12} {'Wall ms':>8} {'Import ms':>10}  Heaviest imports")
+    for result in results:
+        heaviest = ', '.join(f"{entry['package']} {entry['ms']:.1f}" for entry in result['heaviest'])
+        line = (f"{result['command']:<12} {result['wall_ms']:>8.1f} {result['import_ms']:>10.1f}  "
+                f"{heaviest}")
+        if result['import_ms'] > budget:
+            over.append(result['command'])
+            logger.warning(f"{line}  ← over the {budget:g} ms budget")
+        else:
+            logger.info(f"   {line}")
+    return over
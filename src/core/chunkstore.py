@@ -0,0 +1,202 @@
+"""
+Chunk Store for Pig3on
+Content-addressed storage of file chunks shared across transfers
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from utils.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+logger = get_logger(__name__)
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+SCAN_SIZE = 4 * 1024 * 1024
+
+# Content-defined boundaries: a chunk ends after three bytes drawn from these
+# sets, about one hit per 32 KB of random data and much more often in text.
+# Searching with the regex engine keeps chunking at C speed where a per-byte
+# rolling hash would not.
+_ANCHOR_SETS = (
+    b'\n e.;)}>',
+    b'tasohwi\t',
+    b'ehnrdlcu',
+)
+_ANCHOR = re.compile(b''.join(b'[' + re.escape(chars) + b']' for chars in _ANCHOR_SETS))
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def iter_chunks(f):
+    """Split a file into content-defined chunks, yielding (offset, data)"""
+    buf = b''
+    pos = 0     # Start of the next chunk within buf
+    base = 0    # File offset of buf[0]
+    eof = False
+
+    while True:
+        if not eof and len(buf) - pos < MAX_CHUNK_SIZE:
+            data = f.read(SCAN_SIZE)
+            eof = len(data) < SCAN_SIZE
+            buf = buf[pos:] + data
+            base += pos
+            pos = 0
+            continue
+
+        if pos >= len(buf):
+            return
+
+        match = _ANCHOR.search(buf, pos + MIN_CHUNK_SIZE, pos + MAX_CHUNK_SIZE)
+        end = match.end() if match else min(pos + MAX_CHUNK_SIZE, len(buf))
+
+        yield base + pos, buf[pos:end]
+        pos = end
+
+
+def chunk_digest(data):
+    """Content address of a chunk"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def store_for(config):
+    """The process-wide ChunkStore for config's chunk directory, shared by every session receiving into it"""
+    with _stores_lock:
+        store = _stores.get(config.chunk_dir)
+        if store is None:
+            store = _stores[config.chunk_dir] = ChunkStore(config.chunk_dir, config.chunk_store_limit)
+        store.limit = config.chunk_store_limit
+        return store
+
+
+class ChunkStore:
+    """Chunks stored by digest under a directory, evicted least-recently-used past a size limit"""
+
+    INDEX_NAME = 'index.json'
+    LOCK_NAME = 'index.lock'
+
+    def __init__(self, root, limit):
+        self.root = Path(root)
+        self.limit = limit
+        self.index_path = self.root / self.INDEX_NAME
+        self._index = None      # digest -> [size, last used]
+        self._evicted = set()   # Dropped since the last save, so merging doesn't bring them back
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._index is not None:
+            return
+        self._index = self._read_index()
+        self._adopt_orphans()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Chunk index unreadable, starting empty: {e}")
+            return {}
+
+    def _adopt_orphans(self):
+        """Index chunks left on disk by a process that stopped before saving, so eviction counts them"""
+        if not self.root.is_dir():
+            return
+        for path in self.root.glob('??/*'):
+            if len(path.name) != 64 or path.name in self._index:
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            self._index[path.name] = [stat.st_size, stat.st_mtime]
+
+    def _path(self, digest):
+        return self.root / digest[:2] / digest
+
+    def has(self, digest):
+        """Check whether a chunk is stored"""
+        with self._lock:
+            self._load()
+            if digest in self._index and self._path(digest).exists():
+                return True
+            self._index.pop(digest, None)
+            return False
+
+    def put(self, digest, data):
+        """Store a chunk after checking it matches its digest"""
+        if chunk_digest(data) != digest:
+            raise ValueError(f"Chunk {digest[:12]} failed verification")
+
+        path = self._path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(_temp_name(path.name))
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self._load()
+            self._index[digest] = [len(data), time.time()]
+
+    def read(self, digest):
+        """Read a stored chunk and mark it recently used"""
+        with open(self._path(digest), 'rb') as f:
+            data = f.read()
+        with self._lock:
+            self._load()
+            self._index[digest] = [len(data), time.time()]
+        return data
+
+    def evict(self):
+        """Drop least recently used chunks until the store fits its limit"""
+        with self._lock:
+            self._load()
+            total = sum(size for size, _ in self._index.values())
+            for digest, (size, _) in sorted(self._index.items(), key=lambda item: item[1][1]):
+                if total <= self.limit:
+                    break
+                try:
+                    self._path(digest).unlink()
+                except FileNotFoundError:
+                    pass
+                del self._index[digest]
+                self._evicted.add(digest)
+                total -= size
+
+    def save(self):
+        """Persist the index atomically, merged with what other processes saved meanwhile"""
+        with self._lock:
+            if self._index is None:
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+            with open(self.root / self.LOCK_NAME, 'a') as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                for digest, (size, used) in self._read_index().items():
+                    if digest in self._evicted:
+                        continue
+                    if digest not in self._index or self._index[digest][1] < used:
+                        self._index[digest] = [size, used]
+                self._evicted.clear()
+
+                temp_path = self.index_path.with_name(_temp_name(self.INDEX_NAME))
+                with open(temp_path, 'w') as f:
+                    json.dump(self._index, f)
+                os.replace(temp_path, self.index_path)
+
+
+def _temp_name(name):
+    """Temporary file name unique to this thread; sessions served at once share the store"""
+    return f"{name}.{os.getpid()}.{threading.get_ident()}.tmp"
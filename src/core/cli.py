@@ -5,51 +5,134 @@ CLI Command Handler for Pig3on
 import argparse
 import sys
 from pathlib import Path
-from .connection import ConnectionManager
-from .transfer import FileTransfer
-from utils.logger import get_logger
+from .client import DaemonClient
+from .config import ACCEPT_POLICIES, parse_size
+from utils.logger import get_logger, log_to_stderr
+from utils.progress import MODES as PROGRESS_MODES, set_mode as set_progress_mode
 
 logger = get_logger(__name__)
 
 class CLI:
+    # Command -> handler. Handlers import the modules they use themselves, so
+    # `help` or `status` never load the transfer, crypto or benchmark code.
+    COMMANDS = {
+        'connect': 'handle_connect',
+        'send': 'handle_send',
+        'receive': 'handle_receive',
+        'daemon': 'handle_daemon',
+        'trust': 'handle_trust',
+        'bench': 'handle_bench',
+        'disconnect': 'handle_disconnect',
+        'status': 'handle_status',
+        'help': 'print_help',
+        '-h': 'print_help',
+        '--help': 'print_help',
+    }
+    
     def __init__(self, config):
         self.config = config
-        self.connection_manager = ConnectionManager(config)
-        self.file_transfer = FileTransfer(config, self.connection_manager)
+        self.daemon = DaemonClient(config)
+        self._connection_manager = None
+        self._file_transfer = None
         
+    @property
+    def connection_manager(self):
+        """This process's connection, created by the first command that needs one"""
+        if self._connection_manager is None:
+            from .connection import ConnectionManager
+            self._connection_manager = ConnectionManager(self.config)
+        return self._connection_manager
+    
+    @property
+    def file_transfer(self):
+        if self._file_transfer is None:
+            from .transfer import FileTransfer
+            self._file_transfer = FileTransfer(self.config, self.connection_manager)
+        return self._file_transfer
+    
     def execute(self, args):
         """Execute CLI commands"""
+        args = self._take_progress_option(args)
         if not args:
             self.print_help()
             return
         
         command = args[0].lower()
         
-        if command == "connect":
-            self.handle_connect(args[1:])
-        elif command == "send":
-            self.handle_send(args[1:])
-        elif command == "receive":
-            self.handle_receive(args[1:])
-        elif command == "disconnect":
-            self.handle_disconnect()
-        elif command == "status":
-            self.handle_status()
-        elif command == "help" or command == "-h" or command == "--help":
-            self.print_help()
-        else:
+        handler = self.COMMANDS.get(command)
+        if handler is None:
             logger.error(f"Unknown command: {command}")
             self.print_help()
+            return
+        getattr(self, handler)(args[1:])
+    
+    def _take_progress_option(self, args):
+        """Apply --progress=MODE (or --progress MODE) given anywhere and return the other args"""
+        remaining = []
+        mode = None
+        args = iter(args)
+        for arg in args:
+            if arg == '--progress':
+                mode = next(args, '')
+            elif arg.startswith('--progress='):
+                mode = arg.split('=', 1)[1]
+            else:
+                remaining.append(arg)
+        
+        if mode is not None:
+            if mode not in PROGRESS_MODES:
+                raise Exception(f"Unknown progress mode '{mode}' (choose from {', '.join(PROGRESS_MODES)})")
+            set_progress_mode(mode)
+            if mode == 'json':
+                # Events own stdout so scripts can parse it line by line
+                log_to_stderr()
+        return remaining
+    
+    def _first_time_setup(self):
+        """Create the config and download directories before the first run that receives"""
+        if not self.config.is_initialized():
+            logger.info("First time setup...")
+            self.config.initialize()
     
     def handle_connect(self, args):
         """Handle connection command"""
-        logger.info("🔍 Searching for nearby Pig3on devices...")
+        from .discovery import select_devices
+        
+        parser = argparse.ArgumentParser(prog='pig3on connect', add_help=False)
+        parser.add_argument('peer', nargs='?')
+        parser.add_argument('--scan', action='store_true')
+        
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            logger.error("Usage: pig3on connect [PEER] [--scan]")
+            return
+        
+        # A running daemon keeps the session for later commands
+        daemon = self.daemon.available()
+        
+        # Listeners announce themselves, so a recent sighting usually saves the scan
+        devices = [] if options.scan else self.connection_manager.cached_devices()
+        if options.peer:
+            devices, _ = select_devices([options.peer], devices)
+        cached = bool(devices)
         
-        # Scan for devices
-        devices = self.connection_manager.scan_devices()
+        if cached:
+            logger.info("⚡ Using recently seen devices ('pig3on connect --scan' to search again)")
+        else:
+            logger.info("🔍 Searching for nearby Pig3on devices...")
+            if daemon:
+                devices = self.daemon.request('scan')['devices']
+            else:
+                devices = self.connection_manager.scan_devices()
+            if options.peer:
+                devices, _ = select_devices([options.peer], devices)
         
         if not devices:
-            logger.warning("No devices found. Make sure the other device is running Pig3on.")
+            if options.peer:
+                logger.warning(f"{options.peer} not found. Make sure it is running Pig3on.")
+            else:
+                logger.warning("No devices found. Make sure the other device is running Pig3on.")
             return
         
         logger.info(f"\n📱 Found {len(devices)} device(s):")
@@ -72,51 +155,347 @@ class CLI:
         
         # Attempt connection
         logger.info(f"\n🔗 Connecting to {device['name']}...")
-        if self.connection_manager.connect(device):
+        if daemon:
+            connected = self.daemon.request('connect', device=device)['ok']
+        else:
+            connected = self.connection_manager.connect(device)
+        
+        if connected:
             logger.info("✅ Successfully paired and connected!")
+            if not daemon:
+                logger.info("💡 The session ends with this command; run 'pig3on daemon' to keep it")
+        elif cached:
+            # Gone since it last announced itself; look again
+            logger.warning(f"{device['name']} did not answer; scanning...")
+            self.connection_manager.registry.forget(device)
+            self.handle_connect(args + ['--scan'])
         else:
             logger.error("❌ Connection failed")
     
     def handle_send(self, args):
         """Handle file send command"""
-        if not args:
-            logger.error("Usage: pig3on send <file_path>")
+        from .batch import expand_sources
+        from .scheduler import PRIORITIES, Shaper
+        
+        parser = argparse.ArgumentParser(prog='pig3on send', add_help=False)
+        parser.add_argument('paths', nargs='*')
+        parser.add_argument('--streams', type=int, default=self.config.transfer_streams)
+        parser.add_argument('--compress', default=self.config.compression,
+                            choices=['zlib', 'lzma', 'bz2', 'off'])
+        parser.add_argument('--to', default=None)
+        parser.add_argument('--swarm', action='store_true')
+        parser.add_argument('--priority', default='normal', choices=PRIORITIES)
+        parser.add_argument('--limit', type=parse_size, default=0)
+        parser.add_argument('--detach', action='store_true')
+        
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            options = None
+        
+        if not options or not options.paths or options.streams < 1 or options.limit < 0:
+            logger.error("Usage: pig3on send <file|dir|glob>... [--streams N] [--compress CODEC] "
+                         "[--to PEER,...] [--swarm] [--priority urgent|normal|bulk] "
+                         "[--limit RATE] [--detach]")
             return
         
-        file_path = Path(args[0])
+        paths = list(expand_sources(options.paths))
+        missing = [path for path in paths if not path.exists()]
         
-        if not file_path.exists():
-            logger.error(f"File not found: {file_path}")
+        if not paths or missing:
+            logger.error(f"File not found: {missing[0] if missing else options.paths[0]}")
             return
         
-        if not self.connection_manager.is_connected():
+        targets = [target for target in (options.to or '').split(',') if target]
+        
+        if self.daemon.available():
+            # The daemon resolves nothing relative to our working directory
+            reply = self.daemon.request('send', paths=[str(path.resolve()) for path in paths],
+                                        streams=options.streams, compression=options.compress,
+                                        peers=targets, swarm=options.swarm,
+                                        priority=options.priority, limit=options.limit,
+                                        detach=options.detach)
+            if reply.get('error'):
+                logger.error(reply['error'])
+            elif options.detach:
+                return
+            sent = reply['ok']
+        elif options.detach:
+            logger.error("--detach queues the send in the daemon; start one with 'pig3on daemon &'")
+            return
+        elif targets:
+            sent = self._fan_out(paths, targets, options.compress, options.swarm,
+                                 Shaper(self.config), options.priority, Shaper.limit(options.limit))
+        elif options.swarm:
+            logger.error("Swarm mode needs peers: --to PEER,... or --to all-discovered")
+            return
+        elif not self.connection_manager.is_connected():
             logger.error("Not connected to any device. Use 'pig3on connect' first.")
             return
+        else:
+            peer = self.connection_manager.peer_info.get('name')
+            self.connection_manager.set_throttle(
+                Shaper(self.config).throttle(peer, options.priority, Shaper.limit(options.limit)))
+            sent = self.file_transfer.send_paths(paths, streams=options.streams,
+                                                 compression=options.compress)
         
-        logger.info(f"📤 Sending: {file_path.name}")
-        
-        if self.file_transfer.send_file(file_path):
-            logger.info("✅ File sent successfully!")
+        single = len(paths) == 1 and paths[0].is_file()
+        if sent:
+            logger.info("✅ File sent successfully!" if single else "✅ All files sent successfully!")
         else:
-            logger.error("❌ File transfer failed")
+            logger.error("❌ File transfer failed" if single else "❌ Batch transfer failed")
+    
+    def _fan_out(self, paths, targets, compression, swarm, shaper, priority, limit):
+        """Pair with each target in this process and send to all of them from one read; limit is shared"""
+        from .connection import ConnectionManager
+        from .fanout import FanOut
+        from .swarm import SwarmSeed
+        
+        devices, missing = self.connection_manager.find_devices(targets)
+        for target in missing:
+            logger.error(f"Peer not found: {target}")
+        
+        connections = []
+        for device in devices:
+            logger.info(f"🔗 Connecting to {device['name']}...")
+            connection = ConnectionManager(self.config)
+            if connection.connect(device):
+                # Only after connect, so the link probe measures the network and not the limit
+                connection.set_throttle(shaper.throttle(device['name'], priority, limit))
+                connections.append(connection)
+            else:
+                logger.error(f"Could not pair with {device['name']}")
+        
+        if not connections:
+            logger.error("No peers to send to")
+            return False
+        
+        try:
+            if swarm:
+                distributor = SwarmSeed(self.config, paths)
+            else:
+                distributor = FanOut(self.config, paths, compression)
+            return distributor.send(connections) and not missing
+        finally:
+            for connection in connections:
+                connection.disconnect()
     
     def handle_receive(self, args):
         """Handle receive mode"""
+        parser = argparse.ArgumentParser(prog='pig3on receive', add_help=False)
+        parser.add_argument('--accept', default=self.config.accept_policy, choices=ACCEPT_POLICIES)
+        parser.add_argument('--max-sessions', type=int, default=self.config.max_sessions)
+        parser.add_argument('--max-per-peer', type=int, default=self.config.max_peer_sessions)
+        parser.add_argument('--metrics-port', type=int, default=self.config.metrics_port)
+        
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            options = None
+        
+        if not options or options.max_sessions < 1 or options.max_per_peer < 1 or options.metrics_port < 0:
+            logger.error("Usage: pig3on receive [--accept prompt|trusted|auto] "
+                         "[--max-sessions N] [--max-per-peer N] [--metrics-port PORT]")
+            return
+        
+        self._first_time_setup()
+        
+        # Options apply to this run only, so they go to the listener rather than the saved config
+        listener = self.connection_manager
+        listener.accept_policy = options.accept
+        listener.max_sessions = options.max_sessions
+        listener.max_peer_sessions = options.max_per_peer
+        
         logger.info("📥 Listening for incoming files...")
+        if options.metrics_port:
+            listener.metrics.serve(options.metrics_port)
+        logger.info("Press Ctrl+C to stop\n")
+        
+        listener.start_listening()
+    
+    def handle_trust(self, args):
+        """Show or edit the peers accepted without prompting"""
+        if len(args) == 2 and args[0] in ('add', 'remove'):
+            action, peer = args
+            trusted = self.config.trusted_peers
+            # Peers are trusted by address; a name is only looked up, as any host can claim it
+            address = peer if peer in trusted else self._peer_address(peer)
+            if address is None:
+                logger.error(f"Peer not found: {peer}; give its address instead")
+                return
+            if action == 'add' and address not in trusted:
+                trusted.append(address)
+            elif action == 'remove' and address in trusted:
+                trusted.remove(address)
+            self.config.save()
+            shown = address if address == peer else f"{peer} ({address})"
+            logger.info(f"✅ {'Trusted' if action == 'add' else 'No longer trusted'}: {shown}")
+        elif args:
+            logger.error("Usage: pig3on trust [add|remove <name|address>]")
+            return
+        
+        if self.config.trusted_peers:
+            logger.info(f"Trusted Peers: {', '.join(self.config.trusted_peers)}")
+        else:
+            logger.info("No trusted peers")
+    
+    def _peer_address(self, peer):
+        """The address of a peer given by address or by the name it announces, or None"""
+        import ipaddress
+        
+        try:
+            return str(ipaddress.ip_address(peer))
+        except ValueError:
+            pass
+        devices, missing = self.connection_manager.find_devices([peer])
+        return None if missing else devices[0]['address']
+    
+    def handle_daemon(self, args):
+        """Run the background daemon, or stop a running one"""
+        parser = argparse.ArgumentParser(prog='pig3on daemon', add_help=False)
+        parser.add_argument('--receive', action='store_true')
+        parser.add_argument('--stop', action='store_true')
+        parser.add_argument('--metrics-port', type=int, default=self.config.metrics_port)
+        parser.add_argument('--limit', type=parse_size, default=self.config.rate_limit)
+        
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            options = None
+        
+        if not options or options.limit < 0:
+            logger.error("Usage: pig3on daemon [--receive | --stop] [--metrics-port PORT] [--limit RATE]")
+            return
+        
+        if options.stop:
+            if self.daemon.available() and self.daemon.request('stop')['ok']:
+                logger.info("✅ Daemon stopped")
+            else:
+                logger.warning("No daemon running")
+            return
+        
+        from .daemon import Daemon
+        
+        self._first_time_setup()
         logger.info("Press Ctrl+C to stop\n")
+        # Passed along rather than set on the config, which later saves would persist
+        Daemon(self.config, rate_limit=options.limit).serve(receive=options.receive,
+                                                            metrics_port=options.metrics_port)
+    
+    def handle_bench(self, args):
+        """Run the loopback benchmark suite, compare plain and encrypted throughput, or time start-up"""
+        from .bench import (IMPORT_BUDGET, MAX_CHUNK, MIN_CHUNK, REGRESSION_THRESHOLD, compare_suite,
+                            encryption_benchmark, load_suite, parse_size, parse_sizes, plan_suite,
+                            report_encryption, report_startup, report_suite, run_suite, save_suite,
+                            startup_benchmark, suite_document)
+        from utils.crypto import AEAD_AVAILABLE
+        
+        parser = argparse.ArgumentParser(prog='pig3on bench', add_help=False)
+        parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes('1K,1M,64M,1G'))
+        parser.add_argument('--counts', type=parse_sizes, default=parse_sizes('100,1000'))
+        parser.add_argument('--file-size', type=parse_size, default=parse_size('16K'))
+        parser.add_argument('--chunks', type=parse_sizes, default=parse_sizes('64K,256K,1M'))
+        parser.add_argument('--chunk-file', type=parse_size, default=parse_size('64M'))
+        parser.add_argument('--dedup', type=parse_sizes, default=parse_sizes('64M'))
+        parser.add_argument('--runs', type=int, default=None)
+        parser.add_argument('--subprocess', action='store_true')
+        parser.add_argument('--dir')
+        parser.add_argument('--json')
+        parser.add_argument('--compare')
+        parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+        parser.add_argument('--encryption', action='store_true')
+        parser.add_argument('--size', type=parse_size, default=parse_size('256M'))
+        parser.add_argument('--startup', action='store_true')
+        parser.add_argument('--budget', type=float, default=IMPORT_BUDGET)
+        
+        try:
+            options = parser.parse_args(args)
+        except SystemExit:
+            options = None
+        
+        if options and options.runs is None:
+            # Start-up runs take milliseconds; more of them steady the median
+            options.runs = 10 if options.startup else 3
+        
+        if (not options or options.size < 1 or options.runs < 1 or options.file_size < 1
+                or options.chunk_file < 1
+                or min(options.sizes + options.counts + options.dedup, default=1) < 1
+                or not all(MIN_CHUNK <= chunk <= MAX_CHUNK for chunk in options.chunks)):
+            logger.error("Usage: pig3on bench [--sizes 1K,1M,64M,1G] [--counts 100,1000] "
+                         "[--file-size 16K] [--chunks 64K,256K,1M] [--chunk-file 64M] [--dedup 64M] [--runs N] "
+                         "[--subprocess] [--dir DIR] [--json FILE] [--compare BASELINE] "
+                         "[--threshold PCT]")
+            logger.error("       pig3on bench --encryption [--size 256M] [--runs N]")
+            logger.error("       pig3on bench --startup [--runs N] [--budget MS]")
+            return
+        
+        if options.startup:
+            logger.info(f"⏱️  Timing CLI start-up, median of {options.runs}...")
+            over = report_startup(startup_benchmark(runs=options.runs), options.budget)
+            if over:
+                raise Exception(f"Imports over the {options.budget:g} ms budget: {', '.join(over)}")
+            logger.info(f"\n✅ Every command imports within {options.budget:g} ms")
+            return
+        
+        if options.encryption:
+            logger.info("⏱️  Benchmarking loopback transfers...")
+            results = encryption_benchmark(options.size, options.runs)
+            report_encryption(results, options.size, options.runs)
+            return
         
-        self.connection_manager.start_listening()
+        # Read the baseline first so a bad path fails before the long run
+        baseline = load_suite(options.compare) if options.compare else None
+        
+        scenarios = plan_suite(options.sizes, options.counts, options.file_size,
+                               options.chunks, options.chunk_file, options.dedup)
+        mode = 'subprocess' if options.subprocess else 'in-process'
+        logger.info(f"⏱️  Benchmarking {len(scenarios)} loopback scenario(s), "
+                    f"median of {options.runs}, receiver {mode}...")
+        results = run_suite(scenarios, options.runs, options.subprocess, options.dir)
+        report_suite(results)
+        
+        settings = {'runs': options.runs, 'receiver': mode,
+                    'compression': 'off',
+                    'encryption': self.config.encryption if AEAD_AVAILABLE else 'off',
+                    'durability': self.config.durability}
+        document = suite_document(results, settings)
+        if options.json:
+            save_suite(document, options.json)
+            if options.json != '-':
+                logger.info(f"\n💾 Results saved to {options.json}")
+        
+        if baseline:
+            regressions = compare_suite(document, baseline, options.threshold)
+            if regressions:
+                raise Exception(f"{len(regressions)} scenario(s) regressed beyond "
+                                f"{options.threshold:g}%: {', '.join(regressions)}")
+            logger.info("\n✅ No regressions")
     
-    def handle_disconnect(self):
+    def handle_disconnect(self, args=()):
         """Handle disconnect command"""
-        if self.connection_manager.disconnect():
+        if self.daemon.available():
+            disconnected = self.daemon.request('disconnect')['disconnected']
+            if disconnected:
+                logger.info(f"✅ Disconnected from {', '.join(disconnected)}")
+            else:
+                logger.warning("Not connected to any device")
+        elif self.connection_manager.disconnect():
             logger.info("✅ Disconnected")
         else:
             logger.warning("Not connected to any device")
     
-    def handle_status(self):
+    def handle_status(self, args=()):
         """Show connection status"""
-        status = self.connection_manager.get_status()
+        if self.daemon.available():
+            self._print_daemon_status(self.daemon.request('status'))
+            return
+        
+        # Nothing outlives a command without the daemon, so only a connection made
+        # by this process could be up; don't load the network code to find none
+        if self._connection_manager:
+            status = self._connection_manager.get_status()
+        else:
+            status = {'device_name': self.config.device_name, 'connected': False}
         
         logger.info("\n📊 Pig3on Status")
         logger.info("=" * 40)
@@ -126,10 +505,80 @@ class CLI:
         if status['connected']:
             logger.info(f"Peer: {status['peer_name']}")
             logger.info(f"Connection Type: {status['connection_type']}")
+            if status.get('link'):
+                logger.info(f"Link: {status['link']}")
         
+        known = self.config.peer_links
+        if known:
+            logger.info(f"Tuned Peers: {', '.join(sorted(known))}")
+        
+        self._print_history()
         logger.info("=" * 40)
     
-    def print_help(self):
+    def _print_daemon_status(self, status):
+        """Show the daemon's live sessions and their queues"""
+        logger.info("\n📊 Pig3on Status (daemon)")
+        logger.info("=" * 40)
+        logger.info(f"Device Name: {status['device_name']}")
+        logger.info(f"Sessions: {len(status['sessions'])}")
+        
+        for session in status['sessions']:
+            state = 'connected' if session['connected'] else 'reconnects on next send'
+            logger.info(f"\n  {session['peer_name']} ({session['address']}), {state}")
+            if session.get('link'):
+                logger.info(f"    Link: {session['link']}")
+            logger.info(f"    Sending: {session['active'] or 'idle'}")
+            if session['queued']:
+                logger.info(f"    Queued: {', '.join(session['queued'])}")
+        
+        if status.get('scheduled'):
+            logger.info(f"\nScheduled: {len(status['scheduled'])} transfer(s)")
+            for line in status['scheduled']:
+                logger.info(f"  {line}")
+        
+        if status['receiving']:
+            logger.info(f"\nReceiving from: {len(status['incoming'])} peer(s)")
+            for session in status['incoming']:
+                logger.info(f"  {session['peer_name']}")
+        
+        known = self.config.peer_links
+        if known:
+            logger.info(f"\nTuned Peers: {', '.join(sorted(known))}")
+        
+        self._print_history()
+        logger.info("=" * 40)
+    
+    def _print_history(self):
+        """Show aggregates of the transfers recorded in the metrics history"""
+        from .metrics import read_history, summarize
+        
+        summary = summarize(read_history(self.config.history_file))
+        if not summary:
+            return
+        
+        logger.info(f"\nTransfer History (since {min(part['since'] for part in summary.values())}):")
+        for direction, label in (('send', 'Sent'), ('receive', 'Received')):
+            part = summary.get(direction)
+            if not part:
+                continue
+            failed = f" ({part['failed']} failed)" if part['failed'] else ""
+            logger.info(f"  {label}: {part['transfers']} transfers{failed}, {part['files']} files, "
+                        f"{part['bytes'] / (1024 * 1024):.1f} MB")
+            details = []
+            if part['median_mb_s'] is not None:
+                details.append(f"median {part['median_mb_s']:.1f} MB/s, best {part['best_mb_s']:.1f} MB/s")
+            if part['median_rtt_ms'] is not None:
+                details.append(f"RTT {part['median_rtt_ms']:.1f} ms")
+            if part['retransmits']:
+                details.append(f"{part['retransmits']} TCP retransmits")
+            if part['phases']:
+                total = sum(part['phases'].values())
+                details.append("time " + ", ".join(f"{phase} {seconds / total:.0%}"
+                                                   for phase, seconds in part['phases'].items()))
+            if details:
+                logger.info(f"    {'; '.join(details)}")
+    
+    def print_help(self, args=()):
         """Print help message"""
         help_text = """
 🕊️  Pig3on - P2P File Transfer System
@@ -138,23 +587,70 @@ USAGE:
     pig3on <command> [arguments]
 
 COMMANDS:
-    connect                 Scan and connect to nearby devices
+    connect [PEER]          Connect to a nearby device, recently seen ones first
+      --scan               Search the network even if peers were seen recently
     send <file>            Send a file to connected device
-    receive                Start listening for incoming files
+    send <dir|glob>...     Send directories and many files in one batch
+      --streams N          Split the file across N parallel connections
+      --compress CODEC     zlib (default), lzma, bz2 or off
+      --to PEER[,PEER...]  Send to these peers at once from a single read
+                           (all-discovered: every peer found by a scan)
+      --swarm              With --to: receivers also fetch pieces from each other
+      --priority CLASS     urgent, normal (default) or bulk; urgent sends get bandwidth first
+      --limit RATE         Cap this send, e.g. 20M for 20 MB/s
+      --detach             Queue the send in the daemon and return; survives restarts
+    receive                Start listening for incoming files from many peers at once
+      --accept POLICY      prompt (default), trusted (allowlist only) or auto
+      --max-sessions N     Peers served at once
+      --max-per-peer N     Sessions one address may hold at once
+      --metrics-port PORT  Serve Prometheus metrics at http://host:PORT/metrics
+    trust [add|remove <peer>]  Show or edit peers accepted without prompting
+    daemon                 Keep paired sessions open for later commands
+      --receive            Also listen for incoming files
+      --stop               Stop the running daemon
+      --metrics-port PORT  Serve Prometheus metrics at http://host:PORT/metrics
+      --limit RATE         Cap all sends, e.g. 20M (default: rate_limit in the config)
+    bench                  Measure loopback transfers: MB/s, files/s, TTFB, CPU and peak RSS
+      --sizes LIST         Single-file sizes (default 1K,1M,64M,1G; 256M and up are sparse)
+      --counts LIST        Directories of this many --file-size files (default 100,1000)
+      --chunks LIST        Chunk sizes tried on one --chunk-file sized file (default 64K,256K,1M)
+      --runs N             Median of N transfers per scenario (default 3)
+      --subprocess         Run the receiver in its own process
+      --json FILE          Save the results as JSON ('-' for stdout)
+      --compare FILE       Flag scenarios that regressed against saved results
+      --threshold PCT      Change allowed before a regression is flagged (default 10)
+      --encryption         Compare plain and encrypted throughput instead (--size 256M)
+      --startup            Time CLI start-up and check imports against --budget MS (default 50)
     disconnect             Disconnect from current peer
-    status                 Show connection status
+    status                 Show connection status and transfer history
     help                   Show this help message
 
+OPTIONS:
+    --progress MODE        bar (default), json (one JSON event per line on stdout,
+                           logs on stderr) or none
+
 EXAMPLES:
+    pig3on daemon &
     pig3on connect
+    pig3on connect lab01
     pig3on send document.pdf
     pig3on send image.png
+    pig3on send disk.img --streams 4
+    pig3on send disk.img --progress=json
+    pig3on send backup.tar --priority bulk --limit 5M --detach
+    pig3on send logs/ --compress lzma
+    pig3on send photos/ "*.log"
+    pig3on send release.tar --to lab01,lab02,lab03
+    pig3on send release.tar --to all-discovered
+    pig3on send disk.img --to all-discovered --swarm
     pig3on receive
+    pig3on receive --accept trusted --max-sessions 64
+    pig3on trust add build-server
     pig3on disconnect
 
 NOTES:
     - Both devices must have Pig3on installed
     - Ensure WiFi/Bluetooth is enabled
-    - Files are transferred in encrypted packets
+    - Transfers are encrypted (AES-GCM) when both peers have the cryptography package
         """
         print(help_text)
\ No newline at end of file
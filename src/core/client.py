@@ -0,0 +1,55 @@
+"""
+Daemon Client for Pig3on
+Hands CLI commands to a running daemon without loading the transfer code
+"""
+
+import json
+import socket
+import logging
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def daemon_address(config):
+    """Path of the daemon's control socket"""
+    return config.config_dir / 'daemon.sock'
+
+
+class DaemonClient:
+    """Sends CLI commands to a running daemon"""
+
+    def __init__(self, config):
+        self.address = daemon_address(config)
+
+    def available(self):
+        """Check whether a daemon is accepting commands"""
+        if not hasattr(socket, 'AF_UNIX') or not self.address.exists():
+            return False
+        try:
+            self._open().close()
+            return True
+        except OSError:
+            return False
+
+    def _open(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.address))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, command, **arguments):
+        """Run a command in the daemon, logging its output here; returns the final reply"""
+        with self._open() as sock:
+            sock.sendall(json.dumps({'command': command, **arguments}).encode() + b'\n')
+            with sock.makefile('rb') as f:
+                for line in f:
+                    message = json.loads(line)
+                    if message.get('done'):
+                        return message
+                    logger.log(getattr(logging, message.get('level', 'INFO'), logging.INFO),
+                               message['log'])
+        raise ConnectionError("Daemon closed the connection")
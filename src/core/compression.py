@@ -0,0 +1,241 @@
+"""
+Adaptive Compression for Pig3on
+Per-chunk compression that skips incompressible data and yields to a faster link
+"""
+
+import os
+import time
+import zlib
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import get_logger
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+logger = get_logger(__name__)
+
+# Codec name -> (compress, decompressor factory); bz2 and lzma are optional builds
+CODECS = {'zlib': (lambda data: zlib.compress(data, 1), zlib.decompressobj)}
+if bz2:
+    CODECS['bz2'] = (lambda data: bz2.compress(data, 1), bz2.BZ2Decompressor)
+if lzma:
+    CODECS['lzma'] = (lambda data: lzma.compress(data, preset=0), lzma.LZMADecompressor)
+
+# Formats that are already compressed; sampling would reject them anyway
+INCOMPRESSIBLE = {
+    '.7z', '.apk', '.avi', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg',
+    '.jpg', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.rar', '.tgz', '.webm',
+    '.webp', '.xlsx', '.xz', '.zip', '.zst',
+}
+
+SAMPLE_SIZE = 16 * 1024
+MIN_SAVING = 0.1        # A chunk must shrink by this fraction to be sent compressed
+MAX_BACKOFF = 64        # Most chunks sent raw after the link outpaces compression
+
+# Result of preparing one chunk: raw bytes, plus the compressed form if it paid off
+Chunk = namedtuple('Chunk', ['data', 'payload'])
+
+
+def offered_codecs(preferred):
+    """Codecs to offer a peer, the configured one first; empty when compression is off"""
+    if preferred not in CODECS:
+        return []
+    return [preferred] + [name for name in CODECS if name != preferred]
+
+
+def choose_codec(offered):
+    """First codec offered by the sender that this build supports"""
+    for name in offered or []:
+        if name in CODECS:
+            return name
+    return None
+
+
+def decompress(codec, data, limit):
+    """Decompress one chunk, refusing to expand it past limit bytes"""
+    decompressor = CODECS[codec][1]()
+    output = decompressor.decompress(data, limit + 1)
+    if len(output) > limit or not decompressor.eof:
+        raise ValueError("Malformed compressed chunk")
+    return output
+
+
+def read_range(path, offset, length):
+    """Read a byte range of a file on its own handle, so workers don't share file positions"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(length)
+    if len(data) != length:
+        raise OSError("File changed during transfer")
+    return data
+
+
+def send_chunk(channel, f, offset, length, chunk, flag, stream_id=0):
+    """Send a prepared chunk compressed, raw, or straight from the file when it wasn't prepared"""
+    if chunk is None:
+        channel.send_file_range(f, offset, length, stream_id=stream_id)
+    elif chunk.payload is not None:
+        channel.send_data(chunk.payload, offset, stream_id=stream_id, flags=flag)
+    else:
+        channel.send_data(chunk.data, offset, stream_id=stream_id)
+
+
+class Compressor:
+    """
+    Compresses file chunks ahead of the sender in a worker pool.
+    When the sender has to wait for a chunk, compression is slower than the
+    link, so the next chunks go out raw; the back-off halves on every chunk
+    that was ready in time.
+    """
+
+    def __init__(self, codec, workers=None):
+        self.codec = codec
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.lookahead = self.workers * 2
+        self._compress = CODECS[codec][0]
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        self._lock = threading.Lock()
+        self._backoff = 0
+        self._skip = 0
+        self._collected = 0
+
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compressed_chunks = 0
+        self.skipped_chunks = 0
+        self.cpu_time = 0.0
+
+    def pipeline(self, items, chunk_range):
+        """
+        Yield (item, chunk) in order while up to `lookahead` later items are
+        prepared in the pool. chunk_range(item) gives (path, offset, length),
+        or None for items without data; chunk is None when the item should be
+        sent straight from the file.
+        """
+        pending = deque()
+        items = iter(items)
+
+        def fill():
+            for item in items:
+                pending.append((item, self._submit(chunk_range(item))))
+                if len(pending) >= self.lookahead:
+                    return
+
+        fill()
+        while pending:
+            item, future = pending.popleft()
+            chunk = self._collect(future)
+            fill()
+            yield item, chunk
+
+    def submit(self, path, data):
+        """Start compressing data already read from path; returns a handle for collect()"""
+        if not self._wanted(path, len(data)):
+            return None
+        return self._pool.submit(self._encode, data)
+
+    def collect(self, handle, data):
+        """The Chunk for data submitted earlier, waiting for the pool if it isn't ready"""
+        if handle is None:
+            return Chunk(data, None)
+        return self._collect(handle)
+
+    def account(self, length, chunk):
+        """Record how a chunk of `length` raw bytes went on the wire"""
+        self.raw_bytes += length
+        if chunk is not None and chunk.payload is not None:
+            self.wire_bytes += len(chunk.payload)
+            self.compressed_chunks += 1
+        else:
+            self.wire_bytes += length
+
+    def prepare(self, path, offset, length):
+        """Read a chunk, compressing it unless it is incompressible or compression is backing off"""
+        if not self._wanted(path, length):
+            return Chunk(read_range(path, offset, length), None)
+        return self._prepare(path, offset, length)
+
+    def stalled(self):
+        """The sender waited on compression: the CPU, not the link, is the bottleneck"""
+        with self._lock:
+            self._backoff = min(MAX_BACKOFF, max(1, self._backoff * 2))
+            self._skip = self._backoff
+
+    def kept_up(self):
+        """A compressed chunk was ready when the sender needed it"""
+        with self._lock:
+            self._backoff //= 2
+
+    def _wanted(self, path, length):
+        if length == 0 or os.path.splitext(str(path))[1].lower() in INCOMPRESSIBLE:
+            return False
+        with self._lock:
+            if self._skip > 0:
+                self._skip -= 1
+                return False
+        return True
+
+    def _submit(self, chunk_range):
+        if chunk_range is None:
+            return None
+        path, offset, length = chunk_range
+        if not self._wanted(path, length):
+            return None
+        return self._pool.submit(self._prepare, path, offset, length)
+
+    def _collect(self, future):
+        if future is None:
+            return None
+
+        if future.done():
+            self.kept_up()
+        elif self._collected >= self.workers:
+            self.stalled()
+
+        self._collected += 1
+        return future.result()
+
+    def _prepare(self, path, offset, length):
+        """Read a chunk and compress it if a sample suggests it is worth it"""
+        return self._encode(read_range(path, offset, length))
+
+    def _encode(self, data):
+        length = len(data)
+        started = time.thread_time()
+        payload = None
+
+        # Sampling the middle of the chunk avoids being fooled by headers
+        sample_start = (length - SAMPLE_SIZE) // 2
+        sample = data[sample_start:sample_start + SAMPLE_SIZE] if length > SAMPLE_SIZE * 2 else None
+        if sample is None or len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING):
+            payload = self._compress(data)
+            if len(payload) > length * (1 - MIN_SAVING):
+                payload = None
+
+        with self._lock:
+            self.cpu_time += time.thread_time() - started
+            if payload is None:
+                self.skipped_chunks += 1
+        return Chunk(data, payload)
+
+    def report(self, format_size):
+        """Log the compression ratio and time spent compressing"""
+        if not self.raw_bytes:
+            return
+        ratio = self.raw_bytes / max(1, self.wire_bytes)
+        logger.info(f"🗜️  Compression ({self.codec}): {format_size(self.raw_bytes)} → "
+                    f"{format_size(self.wire_bytes)} ({ratio:.1f}x) in {self.cpu_time:.2f}s CPU, "
+                    f"{self.skipped_chunks} incompressible chunk(s) sent raw")
+
+    def close(self):
+        """Stop the worker pool, abandoning chunks prepared ahead"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -5,20 +5,66 @@ Configuration Manager for Pig3on
 import os
 import json
 import socket
+import threading
 from pathlib import Path
 
+ACCEPT_POLICIES = ('prompt', 'trusted', 'auto')
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_size(text):
+    """Parse sizes like 512K, 256M or 1G into bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    number = text[:len(text) - len(unit)]
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size: {text}")
+
 class Config:
     VERSION = "1.0.0"
     
+    _save_lock = threading.Lock()  # Sessions served concurrently may save at once
+    
     def __init__(self):
         self.version = self.VERSION
         self.config_dir = Path.home() / '.pig3on'
         self.config_file = self.config_dir / 'config.json'
+        self.chunk_dir = self.config_dir / 'chunks'
+        self.peers_file = self.config_dir / 'peers.json'
+        self.history_file = self.config_dir / 'history.jsonl'
+        self.queue_file = self.config_dir / 'queue.json'
         self.download_dir = Path.home() / 'Downloads' / 'Pig3on'
         
         # Network settings
         self.discovery_port = 37777
         self.transfer_port = 37778
+        self.peer_ttl = 60  # Seconds a peer stays in the registry after last being heard from
+        
+        # Transfer settings
+        self.transfer_window = 0  # Packets in flight; 0 = auto
+        self.transfer_streams = 1  # Parallel connections per file
+        self.chunk_store_limit = 0  # Bytes of deduplicated chunks kept; 0 = off (no dedup)
+        self.compression = 'zlib'  # zlib, lzma, bz2 or off
+        self.encryption = 'aead'  # aead (needs the cryptography package) or off
+        self.durability = 'end'  # none, end (fsync before publishing) or periodic (fsync while writing too)
+        self.peer_links = {}  # Peer name -> measured link profile
+        
+        # Scheduler settings
+        self.rate_limit = 0  # Bytes/s across all sends; 0 = unlimited
+        self.peer_rate_limit = 0  # Bytes/s to any one peer; 0 = unlimited
+        self.peer_rate_limits = {}  # Peer name -> bytes/s, overriding peer_rate_limit
+        self.max_active_transfers = 4  # Queued sends of a priority or above the daemon runs at once
+        
+        # Receive server settings
+        self.accept_policy = 'prompt'  # prompt, trusted (allowlist only) or auto
+        self.trusted_peers = []  # Peer addresses accepted without asking
+        self.max_sessions = 32  # Peers served at once
+        self.max_peer_sessions = 4  # Sessions from one address at once
+        
+        # Metrics settings
+        self.metrics_port = 0  # Serve Prometheus metrics while receiving or running the daemon; 0 = off
+        self.metrics_file = ''  # Prometheus text file rewritten after each transfer; '' = off
         
         # Device settings
         self.device_name = self._get_device_name()
@@ -51,11 +97,33 @@ class Config:
             'device_name': self.device_name,
             'discovery_port': self.discovery_port,
             'transfer_port': self.transfer_port,
+            'peer_ttl': self.peer_ttl,
+            'transfer_window': self.transfer_window,
+            'transfer_streams': self.transfer_streams,
+            'chunk_store_limit': self.chunk_store_limit,
+            'compression': self.compression,
+            'encryption': self.encryption,
+            'durability': self.durability,
+            'peer_links': self.peer_links,
+            'rate_limit': self.rate_limit,
+            'peer_rate_limit': self.peer_rate_limit,
+            'peer_rate_limits': self.peer_rate_limits,
+            'max_active_transfers': self.max_active_transfers,
+            'accept_policy': self.accept_policy,
+            'trusted_peers': self.trusted_peers,
+            'max_sessions': self.max_sessions,
+            'max_peer_sessions': self.max_peer_sessions,
+            'metrics_port': self.metrics_port,
+            'metrics_file': self.metrics_file,
             'download_dir': str(self.download_dir)
         }
         
-        with open(self.config_file, 'w') as f:
-            json.dump(config_data, f, indent=2)
+        with self._save_lock:
+            self.config_dir.mkdir(parents=True, exist_ok=True)
+            temp_file = self.config_file.with_name(self.config_file.name + '.tmp')
+            with open(temp_file, 'w') as f:
+                json.dump(config_data, f, indent=2)
+            os.replace(temp_file, self.config_file)
     
     def load(self):
         """Load configuration from file"""
@@ -66,11 +134,33 @@ class Config:
             self.device_name = config_data.get('device_name', self.device_name)
             self.discovery_port = config_data.get('discovery_port', self.discovery_port)
             self.transfer_port = config_data.get('transfer_port', self.transfer_port)
+            self.peer_ttl = config_data.get('peer_ttl', self.peer_ttl)
+            self.transfer_window = config_data.get('transfer_window', self.transfer_window)
+            self.transfer_streams = config_data.get('transfer_streams', self.transfer_streams)
+            self.chunk_store_limit = config_data.get('chunk_store_limit', self.chunk_store_limit)
+            self.compression = config_data.get('compression', self.compression)
+            self.encryption = config_data.get('encryption', self.encryption)
+            self.durability = config_data.get('durability', self.durability)
+            self.peer_links = config_data.get('peer_links', self.peer_links)
+            self.rate_limit = config_data.get('rate_limit', self.rate_limit)
+            self.peer_rate_limit = config_data.get('peer_rate_limit', self.peer_rate_limit)
+            self.peer_rate_limits = config_data.get('peer_rate_limits', self.peer_rate_limits)
+            self.max_active_transfers = config_data.get('max_active_transfers', self.max_active_transfers)
+            self.accept_policy = config_data.get('accept_policy', self.accept_policy)
+            self.trusted_peers = config_data.get('trusted_peers', self.trusted_peers)
+            self.max_sessions = config_data.get('max_sessions', self.max_sessions)
+            self.max_peer_sessions = config_data.get('max_peer_sessions', self.max_peer_sessions)
+            self.metrics_port = config_data.get('metrics_port', self.metrics_port)
+            self.metrics_file = config_data.get('metrics_file', self.metrics_file)
             self.download_dir = Path(config_data.get('download_dir', self.download_dir))
             
         except Exception as e:
             print(f"Failed to load config: {e}")
     
+    def is_trusted(self, address):
+        """Check whether a peer's address is on the allowlist; the name it sends could be anyone's"""
+        return address in self.trusted_peers
+    
     def update(self, **kwargs):
         """Update configuration"""
         for key, value in kwargs.items():
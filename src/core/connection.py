@@ -5,63 +5,97 @@ Handles WiFi and Bluetooth connections
 
 import socket
 import threading
+import queue
 import time
 import json
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from utils.logger import get_logger
-from utils.crypto import CryptoHelper
+from utils.crypto import AEAD_AVAILABLE, CryptoHelper
+from .discovery import (ALL_DISCOVERED, ANNOUNCE_INTERVAL, PeerRegistry, ProbeSchedule,
+                        device_key, open_probe_socket, open_responder_socket, select_devices,
+                        send_everywhere)
+from .metrics import metrics_for
+from .protocol import (FEATURES, LEGACY_VERSION, PROTOCOL_VERSION, SUPPORTED_VERSIONS,
+                       ProtocolError, create_channel, negotiate_features, negotiate_version,
+                       receive_exact, receive_hello, send_hello)
+from .resume import PartialDownload
+from .swarm import SwarmRegistry, serve_pieces
+from .tuning import PROBE_TIMEOUT, LinkProfile, answer_probe, probe_link
 
 logger = get_logger(__name__)
 
 class ConnectionManager:
+    HELLO_TIMEOUT = 1.0  # Seconds to wait for a versioned HELLO before assuming a legacy peer
+    LISTEN_BACKLOG = 64
+    HANDSHAKE_WORKERS = 8  # Connections identified and vetted at once
+    MAX_PENDING = 64  # Connections waiting for a handshake worker before new ones are dropped
+    
     def __init__(self, config):
         self.config = config
         self.crypto = CryptoHelper()
         self.socket = None
+        self.channel = None
+        self.protocol_version = LEGACY_VERSION
+        self.peer_features = set()
+        self.spent = False  # A legacy peer already took its one file on this connection
+        self.link = None
         self.server_socket = None
         self.connected = False
         self.peer_info = None
         self.connection_type = None
         self.listening = False
+        self.discoverable = True  # Answer scans and announce ourselves while listening
+        self.accept_policy = config.accept_policy  # Overridden per run by `pig3on receive`, never saved
+        self.max_sessions = config.max_sessions
+        self.max_peer_sessions = config.max_peer_sessions
         self._listen_thread = None
+        self._stream_joins = {}  # token -> (peer address, queue of joined channels, session)
+        self._joins_lock = threading.Lock()
+        self.sessions = []  # Paired sessions served by this listener
+        self._slots = {}  # Peer address -> sessions admitted or being paired
+        self._pending = 0
+        self._sessions_lock = threading.Lock()
+        self._prompt_lock = threading.Lock()
+        self.swarms = SwarmRegistry()  # Swarms whose pieces we serve to other receivers
+        self.registry = PeerRegistry(config.peers_file, config.peer_ttl)
+        self.metrics = metrics_for(config)  # Counters and transfer history shared in this process
+        self.throttle = None  # Paces data sent on this session's channels, e.g. a scheduler's buckets
         
     def scan_devices(self, timeout=5):
-        """Scan for nearby Pig3on devices using UDP broadcast"""
+        """Probe for nearby Pig3on devices, returning once the answers stop changing"""
         devices = []
         
         try:
-            # Create UDP socket for broadcasting
-            scan_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            scan_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            scan_socket.settimeout(1)
+            scan_socket = open_probe_socket()
             
-            # Broadcast discovery message
+            # Probe by broadcast and multicast, retransmitting for lossy links
             message = json.dumps({
                 'type': 'DISCOVER',
                 'name': self.config.device_name,
                 'version': self.config.version
             }).encode()
             
-            scan_socket.sendto(message, ('<broadcast>', self.config.discovery_port))
-            
-            # Listen for responses
-            start_time = time.time()
-            seen_addresses = set()
+            schedule = ProbeSchedule(timeout)
+            seen = set()
             
-            while time.time() - start_time < timeout:
+            while not schedule.finished():
+                if schedule.probe_due():
+                    send_everywhere(scan_socket, message, self.config.discovery_port)
+                    schedule.probed()
+                
+                scan_socket.settimeout(schedule.wait_time())
                 try:
                     data, addr = scan_socket.recvfrom(1024)
+                    response = json.loads(data.decode())
                     
-                    if addr[0] not in seen_addresses:
-                        response = json.loads(data.decode())
-                        
-                        if response.get('type') == 'DISCOVER_RESPONSE':
-                            devices.append({
-                                'name': response.get('name', 'Unknown'),
-                                'address': addr[0],
-                                'port': response.get('port', self.config.transfer_port)
-                            })
-                            seen_addresses.add(addr[0])
+                    if response.get('type') == 'DISCOVER_RESPONSE':
+                        device = self._announced_device(response, addr)
+                        if device_key(device) not in seen:
+                            devices.append(device)
+                            seen.add(device_key(device))
+                            schedule.answered()
                             
                 except socket.timeout:
                     continue
@@ -69,12 +103,36 @@ class ConnectionManager:
                     logger.debug(f"Scan error: {e}")
                     
             scan_socket.close()
+            self.registry.record(devices)
             
         except Exception as e:
             logger.error(f"Device scan failed: {e}")
         
         return devices
     
+    def cached_devices(self):
+        """Peers heard from recently, without scanning"""
+        return self.registry.live()
+    
+    def find_devices(self, targets):
+        """
+        Devices for the named targets, from the registry when it knows all of
+        them and by scanning otherwise; returns (devices, missing targets)
+        """
+        if ALL_DISCOVERED not in targets:
+            devices, missing = select_devices(targets, self.cached_devices())
+            if not missing:
+                return devices, []
+        return select_devices(targets, self.scan_devices())
+    
+    def _announced_device(self, message, addr):
+        return {
+            'name': message.get('name', 'Unknown'),
+            'address': addr[0],
+            'port': message.get('port', self.config.transfer_port),
+            'protocol': message.get('protocol', LEGACY_VERSION)
+        }
+    
     def start_listening(self):
         """Start listening for connections"""
         if self.listening:
@@ -94,48 +152,49 @@ class ConnectionManager:
     
     def _listen_loop(self):
         """Background listening loop"""
+        PartialDownload.cleanup_stale(self.config.download_dir)
+        
         # Start discovery responder
-        discovery_thread = threading.Thread(target=self._discovery_responder, daemon=True)
-        discovery_thread.start()
+        if self.discoverable:
+            discovery_thread = threading.Thread(target=self._discovery_responder, daemon=True)
+            discovery_thread.start()
         
         # Start connection listener
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.server_socket.bind(('', self.config.transfer_port))
-            self.server_socket.listen(1)
+            self.server_socket.listen(self.LISTEN_BACKLOG)
             self.server_socket.settimeout(1)
             
-            logger.info(f"Listening on port {self.config.transfer_port}")
+            logger.info(f"Listening on port {self.config.transfer_port} "
+                        f"(accept policy: {self.accept_policy})")
+            
+            # Handshakes, prompts and sessions run off this thread so accepting never stalls
+            handshakes = ThreadPoolExecutor(max_workers=self.HANDSHAKE_WORKERS)
             
             while self.listening:
                 try:
                     client_socket, addr = self.server_socket.accept()
-                    logger.info(f"\n📞 Incoming connection from {addr[0]}")
-                    
-                    # Request pairing confirmation
-                    response = input("Accept connection? (yes/no): ").lower()
                     
-                    if response in ['yes', 'y']:
-                        client_socket.send(b'ACCEPT')
-                        self.socket = client_socket
-                        self.connected = True
-                        self.peer_info = {'address': addr[0]}
-                        self.connection_type = 'WiFi'
-                        logger.info("✅ Paired successfully!")
-                        
-                        # Handle incoming transfers
-                        self._handle_incoming_transfers()
-                    else:
-                        client_socket.send(b'REJECT')
+                    with self._sessions_lock:
+                        overloaded = self._pending >= self.MAX_PENDING
+                        if not overloaded:
+                            self._pending += 1
+                    if overloaded:
                         client_socket.close()
-                        logger.info("Connection rejected")
+                        logger.warning(f"Too many pending connections, dropped {addr[0]}")
+                        continue
+                    
+                    handshakes.submit(self._handshake, client_socket, addr)
                         
                 except socket.timeout:
                     continue
                 except Exception as e:
                     if self.listening:
                         logger.error(f"Listen error: {e}")
+            
+            handshakes.shutdown(wait=False)
                         
         except Exception as e:
             logger.error(f"Failed to start listener: {e}")
@@ -143,34 +202,316 @@ class ConnectionManager:
             if self.server_socket:
                 self.server_socket.close()
     
+    def _handshake(self, client_socket, addr):
+        """Identify a new connection and admit it as a stream join or a paired session"""
+        try:
+            # Versioned peers introduce themselves before pairing
+            try:
+                hello = receive_hello(client_socket, timeout=self.HELLO_TIMEOUT)
+            except (ProtocolError, ValueError) as e:
+                logger.warning(f"Invalid handshake from {addr[0]}: {e}")
+                client_socket.close()
+                return
+            
+            # Extra data streams join their paired session without prompting
+            if hello and hello.get('join'):
+                self._accept_stream(client_socket, addr, hello)
+                return
+            
+            # Other receivers of a swarm fetch pieces without pairing
+            if hello and hello.get('swarm'):
+                self._accept_swarm(client_socket, addr, hello)
+                return
+            
+            name = hello.get('name', 'Unknown') if hello else 'Unknown'
+            logger.info(f"\n📞 Incoming connection from {name} ({addr[0]})")
+            
+            refusal = self._reserve_slot(addr[0])
+            if not refusal and not self._admit(name, addr[0]):
+                self._release_slot(addr[0])
+                refusal = "Connection rejected"
+            if refusal:
+                client_socket.send(b'REJECT')
+                client_socket.close()
+                logger.info(refusal)
+                self.metrics.count('pig3on_connections_total', direction='incoming', result='rejected')
+                return
+            
+            session = self._new_session()
+            if not session._pair_incoming(client_socket, addr, hello):
+                self._release_slot(addr[0])
+                self.metrics.count('pig3on_connections_total', direction='incoming', result='failed')
+                return
+            
+            self.metrics.count('pig3on_connections_total', direction='incoming', result='paired')
+            with self._sessions_lock:
+                self.sessions.append(session)
+                self.metrics.gauge('pig3on_sessions_active', len(self.sessions))
+            threading.Thread(target=self._serve_session, args=(session, addr[0]), daemon=True).start()
+        except Exception as e:
+            client_socket.close()
+            logger.error(f"Handshake with {addr[0]} failed: {e}")
+        finally:
+            with self._sessions_lock:
+                self._pending -= 1
+    
+    def _reserve_slot(self, address):
+        """Claim a session slot for a peer; returns why it was refused, if it was"""
+        with self._sessions_lock:
+            if sum(self._slots.values()) >= self.max_sessions:
+                return f"Serving {self.max_sessions} sessions already, connection rejected"
+            if self._slots.get(address, 0) >= self.max_peer_sessions:
+                return f"{address} already has {self.max_peer_sessions} sessions, connection rejected"
+            self._slots[address] = self._slots.get(address, 0) + 1
+        return None
+    
+    def _release_slot(self, address):
+        with self._sessions_lock:
+            self._slots[address] -= 1
+            if not self._slots[address]:
+                del self._slots[address]
+    
+    def _admit(self, name, address):
+        """Apply the accept policy: trusted peers always, then auto, allowlist-only or a prompt"""
+        policy = self.accept_policy
+        if self.config.is_trusted(address) or policy == 'auto':
+            return True
+        if policy == 'trusted':
+            logger.info(f"{name} ({address}) is not a trusted peer")
+            return False
+        
+        # One prompt at a time; trusted peers are admitted meanwhile
+        with self._prompt_lock:
+            response = input(f"Accept connection from {name} ({address})? (yes/no/always): ").lower()
+        
+        if response == 'always':
+            self.config.trusted_peers.append(address)
+            try:
+                self.config.save()
+            except OSError as e:
+                logger.debug(f"Could not save trusted peer: {e}")
+            return True
+        return response in ['yes', 'y']
+    
+    def _new_session(self):
+        """Connection state for one accepted peer; its stream joins arrive through this listener"""
+        session = ConnectionManager(self.config)
+        session._stream_joins = self._stream_joins
+        session._joins_lock = self._joins_lock
+        session.swarms = self.swarms
+        return session
+    
+    def _pair_incoming(self, client_socket, addr, hello):
+        """Complete pairing with an admitted peer and adopt the connection as this session"""
+        client_socket.send(b'ACCEPT')
+        
+        version = LEGACY_VERSION
+        features = set()
+        if hello:
+            supported = self._features()
+            if not hello.get('key'):
+                supported = [feature for feature in supported if feature != 'aead']
+            version = negotiate_version(hello.get('protocols'))
+            features = negotiate_features(hello.get('features'), supported)
+            reply = {
+                'type': 'HELLO',
+                'protocol': version,
+                'features': supported,
+                'name': self.config.device_name
+            }
+            if 'aead' in features:
+                reply['key'] = self.crypto.key_share()
+                self.crypto.agree(hello['key'], initiator=False)
+            send_hello(client_socket, reply)
+        
+        self._set_session(client_socket, version, features)
+        self.peer_info = {
+            'address': addr[0],
+            'name': hello.get('name', 'Unknown') if hello else 'Unknown'
+        }
+        
+        # The connecting side measures the link; we learn its result
+        if 'tune' in features:
+            try:
+                client_socket.settimeout(PROBE_TIMEOUT)
+                self._set_link(answer_probe(self.channel))
+                client_socket.settimeout(None)
+            except Exception as e:
+                logger.error(f"Link probe failed: {e}")
+                self.disconnect()
+                return False
+        else:
+            self._set_link(self._known_link())
+        
+        logger.info(f"✅ Paired with {self.peer_info['name']}!")
+        self._log_encryption()
+        return True
+    
+    def _serve_session(self, session, address):
+        """Receive a session's transfers, then free its slot"""
+        try:
+            session._handle_incoming_transfers()
+        finally:
+            with self._sessions_lock:
+                self.sessions.remove(session)
+                self.metrics.gauge('pig3on_sessions_active', len(self.sessions))
+            self._release_slot(address)
+    
+    def _accept_stream(self, client_socket, addr, hello):
+        """Hand an extra data connection to the transfer waiting for it"""
+        with self._joins_lock:
+            paired_address, joins, session = self._stream_joins.get(hello['join'], (None, None, None))
+        
+        if joins is None or addr[0] != paired_address:
+            client_socket.send(b'REJECT')
+            client_socket.close()
+            logger.debug(f"Rejected unexpected stream from {addr[0]}")
+            return
+        
+        client_socket.send(b'ACCEPT')
+        send_hello(client_socket, {'type': 'HELLO', 'protocol': PROTOCOL_VERSION})
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel = session._secure(create_channel(client_socket, PROTOCOL_VERSION))
+        joins.put((hello.get('stream', 0), channel))
+    
+    def _accept_swarm(self, client_socket, addr, hello):
+        """Serve swarm pieces on its own thread to another receiver of a swarm we are fetching"""
+        identifier = hello['swarm']
+        refusal = None
+        if not self.swarms.admits(identifier, addr[0]):
+            refusal = "not a receiver of a swarm being fetched"
+        refusal = refusal or self._reserve_slot(addr[0])
+        if refusal:
+            client_socket.send(b'REJECT')
+            client_socket.close()
+            logger.debug(f"Swarm peer {addr[0]} refused: {refusal}")
+            return
+        
+        # Swarm peers aren't paired, so they agree a key of their own
+        crypto = CryptoHelper()
+        reply = {'type': 'HELLO', 'protocol': PROTOCOL_VERSION}
+        if hello.get('key') and 'aead' in self._features():
+            reply['key'] = crypto.key_share()
+            crypto.agree(hello['key'], initiator=False)
+        
+        client_socket.send(b'ACCEPT')
+        send_hello(client_socket, reply)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel = create_channel(client_socket, PROTOCOL_VERSION)
+        if crypto.sealer:
+            channel.secure(crypto.sealer.lane(), crypto.opener)
+        threading.Thread(target=self._serve_swarm, args=(channel, addr[0], identifier),
+                         daemon=True).start()
+    
+    def _serve_swarm(self, channel, address, identifier):
+        try:
+            # Only the swarm the peer was admitted for, and only while we still fetch it
+            serve_pieces(channel, lambda requested: self.swarms.get(identifier)
+                         if requested == identifier else None)
+        except Exception as e:
+            logger.debug(f"Swarm peer {address} left: {e}")
+        finally:
+            channel.socket.close()
+            self._release_slot(address)
+    
+    def expect_streams(self, token):
+        """Register a striped transfer and return the queue its stream channels arrive on"""
+        joins = queue.Queue()
+        with self._joins_lock:
+            self._stream_joins[token] = (self.peer_info['address'], joins, self)
+        return joins
+    
+    def release_streams(self, token):
+        """Stop accepting streams for a finished striped transfer"""
+        with self._joins_lock:
+            self._stream_joins.pop(token, None)
+    
+    def open_stream(self, token, index):
+        """Open an extra data connection to the paired peer for a striped transfer"""
+        address = self.peer_info['address']
+        port = self.peer_info.get('port', self.config.transfer_port)
+        channel, _ = self._open_channel(address, port, {'join': token, 'stream': index})
+        channel.throttle = self.throttle
+        return self._secure(channel)
+    
+    def open_swarm_source(self, address, port, identifier):
+        """Open a connection to another receiver of a swarm to fetch pieces from it"""
+        crypto = CryptoHelper()
+        introduction = {'swarm': identifier}
+        if 'aead' in self._features():
+            introduction['key'] = crypto.key_share()
+        channel, reply = self._open_channel(address, port, introduction)
+        if reply.get('key') and introduction.get('key'):
+            crypto.agree(reply['key'], initiator=True)
+            channel.secure(crypto.sealer.lane(), crypto.opener)
+        return channel
+    
+    def _open_channel(self, address, port, introduction):
+        """Connect to a listener with a HELLO that skips pairing; returns the channel and its HELLO"""
+        sock = socket.create_connection((address, port), timeout=10)
+        try:
+            send_hello(sock, {
+                'type': 'HELLO',
+                'protocols': [PROTOCOL_VERSION],
+                **introduction
+            })
+            if receive_exact(sock, len(b'ACCEPT')) != b'ACCEPT':
+                raise ConnectionError("Stream rejected by peer")
+            reply = receive_hello(sock)
+        except Exception:
+            sock.close()
+            raise
+        
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return create_channel(sock, PROTOCOL_VERSION), reply
+    
     def _discovery_responder(self):
-        """Respond to discovery broadcasts"""
+        """Respond to discovery probes, announce ourselves and note peers' announcements"""
         try:
-            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            udp_socket.bind(('', self.config.discovery_port))
-            udp_socket.settimeout(1)
+            udp_socket = open_responder_socket(self.config.discovery_port)
+            announcer = open_probe_socket()
+            instance = secrets.token_hex(8)  # Recognises our own announcements looping back
+            
+            presence = {
+                'name': self.config.device_name,
+                'port': self.config.transfer_port,
+                'version': self.config.version,
+                'protocol': PROTOCOL_VERSION,
+                'instance': instance
+            }
+            response = json.dumps({'type': 'DISCOVER_RESPONSE', **presence}).encode()
+            announcement = json.dumps({'type': 'ANNOUNCE', **presence}).encode()
+            next_announcement = 0
             
             while self.listening:
+                if time.monotonic() >= next_announcement:
+                    send_everywhere(announcer, announcement, self.config.discovery_port)
+                    next_announcement = time.monotonic() + ANNOUNCE_INTERVAL
+                
+                udp_socket.settimeout(max(0.01, min(1, next_announcement - time.monotonic())))
                 try:
                     data, addr = udp_socket.recvfrom(1024)
                     message = json.loads(data.decode())
+                    kind = message.get('type')
                     
-                    if message.get('type') == 'DISCOVER':
-                        response = json.dumps({
-                            'type': 'DISCOVER_RESPONSE',
-                            'name': self.config.device_name,
-                            'port': self.config.transfer_port,
-                            'version': self.config.version
-                        }).encode()
-                        
+                    if kind == 'DISCOVER':
                         udp_socket.sendto(response, addr)
+                    elif kind in ('ANNOUNCE', 'LEAVE') and message.get('instance') != instance:
+                        device = self._announced_device(message, addr)
+                        if kind == 'ANNOUNCE':
+                            self.registry.record([device])
+                        else:
+                            self.registry.forget(device)
                         
                 except socket.timeout:
                     continue
                 except Exception as e:
                     logger.debug(f"Discovery responder error: {e}")
-                    
+            
+            # Let registries drop us now rather than when we expire
+            send_everywhere(announcer, json.dumps({'type': 'LEAVE', **presence}).encode(),
+                            self.config.discovery_port)
+            announcer.close()
             udp_socket.close()
             
         except Exception as e:
@@ -186,25 +527,121 @@ class ConnectionManager:
             logger.info(f"Connecting to {device['address']}:{device['port']}...")
             self.socket.connect((device['address'], device['port']))
             
-            # Wait for pairing response
-            response = self.socket.recv(1024).decode()
+            # Only peers that advertised framing support get a HELLO;
+            # legacy listeners would misread it as a transfer
+            versioned = device.get('protocol', LEGACY_VERSION) >= PROTOCOL_VERSION
+            if versioned:
+                supported = self._features()
+                hello = {
+                    'type': 'HELLO',
+                    'protocols': list(SUPPORTED_VERSIONS),
+                    'features': supported,
+                    'name': self.config.device_name
+                }
+                if 'aead' in supported:
+                    hello['key'] = self.crypto.key_share()
+                send_hello(self.socket, hello)
+                response = receive_exact(self.socket, len(b'ACCEPT')).decode()
+            else:
+                # Wait for pairing response
+                response = self.socket.recv(1024).decode()
             
             if response == 'ACCEPT':
-                self.connected = True
+                version = LEGACY_VERSION
+                features = set()
+                if versioned:
+                    reply = receive_hello(self.socket)
+                    version = negotiate_version([reply.get('protocol', LEGACY_VERSION)])
+                    features = negotiate_features(reply.get('features'), supported)
+                    if 'aead' in features:
+                        self.crypto.agree(reply['key'], initiator=True)
+                
+                self._set_session(self.socket, version, features)
                 self.peer_info = device
-                self.connection_type = 'WiFi'
+                self._log_encryption()
+                
+                # Measure the link to tune packets, window and buffers for it
+                if 'tune' in features:
+                    self._set_link(probe_link(self.channel))
+                else:
+                    self._set_link(self._known_link())
+                self.metrics.count('pig3on_connections_total', direction='outgoing', result='paired')
                 return True
             else:
                 logger.warning("Connection rejected by peer")
                 self.socket.close()
+                self.metrics.count('pig3on_connections_total', direction='outgoing', result='rejected')
                 return False
                 
         except Exception as e:
             logger.error(f"Connection failed: {e}")
             if self.socket:
                 self.socket.close()
+            self.metrics.count('pig3on_connections_total', direction='outgoing', result='failed')
             return False
     
+    def _set_session(self, sock, version, features=()):
+        """Mark the connection as paired using the negotiated protocol"""
+        # Frame headers and payloads go out as separate writes; don't let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        self.protocol_version = version
+        self.peer_features = set(features)
+        self.spent = False
+        self.channel = self._secure(create_channel(sock, version))
+        self.channel.throttle = self.throttle
+        self.connected = True
+        self.connection_type = 'WiFi'
+    
+    def _features(self):
+        """Features we offer; encryption needs the cryptography package and isn't turned off"""
+        if self.config.encryption == 'off':
+            return [feature for feature in FEATURES if feature != 'aead']
+        return list(FEATURES)
+    
+    def set_throttle(self, throttle):
+        """Pace what this session sends with throttle(count), or stop pacing with None"""
+        self.throttle = throttle
+        if self.channel:
+            self.channel.throttle = throttle
+    
+    def _secure(self, channel):
+        """Encrypt a channel of this session if the peers agreed a key"""
+        if 'aead' in self.peer_features:
+            channel.secure(self.crypto.sealer.lane(), self.crypto.opener)
+        return channel
+    
+    def _log_encryption(self):
+        if 'aead' in self.peer_features:
+            logger.info(f"🔐 Encrypted session, verification code {self.crypto.code}")
+        elif self.protocol_version >= PROTOCOL_VERSION and not AEAD_AVAILABLE:
+            logger.warning("Session is not encrypted: install the 'cryptography' package to encrypt transfers")
+        else:
+            logger.warning("Session is not encrypted")
+    
+    def _set_link(self, link):
+        """Adopt a link profile for the session and remember it for the peer"""
+        self.link = link
+        if link:
+            link.apply(self.socket)
+            logger.debug(f"Link tuned: {link.describe()}")
+            self.remember_link()
+    
+    def _known_link(self):
+        """Link profile persisted from an earlier session with the current peer"""
+        data = self.config.peer_links.get(self.peer_info.get('name')) if self.peer_info else None
+        return LinkProfile.from_dict(data) if data else None
+    
+    def remember_link(self):
+        """Persist the current link profile under the peer's name"""
+        if not self.link or not self.peer_info:
+            return
+        self.config.peer_links[self.peer_info.get('name', 'Unknown')] = self.link.to_dict()
+        try:
+            self.config.save()
+        except OSError as e:
+            logger.debug(f"Could not save link profile: {e}")
+    
     def _handle_incoming_transfers(self):
         """Handle incoming file transfers"""
         from .transfer import FileTransfer
@@ -217,6 +654,15 @@ class ConnectionManager:
             except Exception as e:
                 logger.error(f"Transfer error: {e}")
                 break
+        
+        # Close the session so the sender notices and can reconnect to resume
+        self.disconnect()
+    
+    def renew(self):
+        """Pair again with the peer we connected to; legacy receivers serve one file per connection"""
+        device = self.peer_info
+        self.disconnect()
+        return bool(device) and self.connect(device)
     
     def disconnect(self):
         """Disconnect from peer"""
@@ -227,6 +673,10 @@ class ConnectionManager:
             if self.socket:
                 self.socket.close()
             self.connected = False
+            self.channel = None
+            self.crypto = CryptoHelper()
+            self.peer_features = set()
+            self.link = None
             self.peer_info = None
             self.connection_type = None
             return True
@@ -244,5 +694,7 @@ class ConnectionManager:
             'device_name': self.config.device_name,
             'connected': self.connected,
             'peer_name': self.peer_info.get('name', 'Unknown') if self.peer_info else None,
-            'connection_type': self.connection_type
+            'connection_type': self.connection_type,
+            'protocol': self.protocol_version if self.connected else None,
+            'link': self.link.describe() if self.connected and self.link else None
         }
\ No newline at end of file
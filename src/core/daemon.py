@@ -0,0 +1,576 @@
+"""
+Background Daemon for Pig3on
+Holds paired sessions between commands and serves CLI clients over a Unix socket
+"""
+
+import os
+import json
+import queue
+import socket
+import logging
+import threading
+from pathlib import Path
+from utils.logger import get_logger
+from .batch import walk_sources
+from .client import DaemonClient, daemon_address
+from .connection import ConnectionManager
+from .engine import TransferEngine
+from .fanout import FanOut
+from .metrics import metrics_for
+from .scheduler import Scheduler
+from .swarm import SwarmSeed
+from .transfer import FileTransfer
+
+logger = get_logger(__name__)
+
+
+class _LogRelay(logging.Handler):
+    """Forwards log records from threads working for a client back to that client"""
+
+    def __init__(self):
+        super().__init__()
+        self.sinks = {}     # Thread ident -> callable(level name, message)
+
+    def emit(self, record):
+        sink = self.sinks.get(record.thread)
+        if sink:
+            sink(record.levelname, record.getMessage())
+
+
+class _Job:
+    """A queued send and the client waiting for it"""
+
+    def __init__(self, job_id, paths, streams, compression, sink, run=None, throttle=None,
+                 on_done=None):
+        self.id = job_id
+        self.paths = paths
+        self.streams = streams
+        self.compression = compression
+        self.sink = sink
+        self.run = run      # Sends on the session's connection instead of send_paths
+        self.throttle = throttle    # Paces the send, from the scheduler's token buckets
+        self.on_done = on_done
+        self.ok = False
+        self.done = threading.Event()
+
+    def finish(self):
+        if self.on_done:
+            self.on_done()
+        self.done.set()
+
+    def describe(self):
+        names = ', '.join(os.path.basename(path.rstrip('/')) for path in self.paths[:3])
+        more = f" (+{len(self.paths) - 3})" if len(self.paths) > 3 else ""
+        return f"#{self.id} {names}{more}"
+
+
+class _Session:
+    """
+    A peer the daemon is paired with, working through its queued jobs.
+    When the peer speaks the multiplexed protocol, plain sends become
+    streams of one engine session on the connection, so a job submitted
+    behind a large upload starts at once beside it. Striped sends and
+    fan-outs need the connection to themselves and wait for the streams.
+    """
+
+    IDLE_CHECK = 0.5    # Seconds between checks for an engine with nothing left to send
+
+    def __init__(self, config, device, relay):
+        self.config = config
+        self.device = device
+        self.connection = ConnectionManager(config)
+        self.transfer = FileTransfer(config, self.connection)
+        self.relay = relay
+        self.jobs = queue.Queue()
+        self.waiting = []
+        self.active = None
+        self.streaming = []     # Jobs whose files are in flight as engine streams
+        self._engine = None
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def submit(self, job):
+        with self._lock:
+            self.waiting.append(job)
+        self.jobs.put(job)
+
+    def stop(self):
+        """Finish the job in progress, drop the rest and disconnect"""
+        with self._lock:
+            dropped, self.waiting = self.waiting, []
+        for job in dropped:
+            job.finish()
+        self.jobs.put(None)
+        self.connection.disconnect()
+
+    def multiplexes(self, job):
+        """Whether job can go as engine streams beside other jobs"""
+        return job.run is None and job.streams == 1 and 'mux' in self.connection.peer_features
+
+    def busy(self):
+        """Whether another job would have to wait for the work in hand"""
+        with self._lock:
+            jobs = self.waiting + ([self.active] if self.active else [])
+            if not jobs and not self.streaming:
+                return False
+            return not all(self.multiplexes(job) for job in jobs) or \
+                'mux' not in self.connection.peer_features
+
+    def _work(self):
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.IDLE_CHECK if self._engine else None)
+            except queue.Empty:
+                self._end_streams(idle_only=True)
+                continue
+            if job is None:
+                self._end_streams()
+                return
+            with self._lock:
+                if job not in self.waiting:
+                    continue    # Dropped by stop()
+                self.waiting.remove(job)
+                self.active = job
+
+            ident = threading.get_ident()
+            self.relay.sinks[ident] = job.sink
+            streamed = False
+            try:
+                if self._engine and not self._engine.running:
+                    self._end_streams()     # Ended by a connection error
+                # Peers drop idle connections when they restart; pair again transparently
+                if not self.connection.is_connected():
+                    logger.info(f"🔗 Reconnecting to {self.device['name']}...")
+                    if not self.connection.connect(self.device):
+                        raise ConnectionError(f"Could not reconnect to {self.device['name']}")
+                if self.multiplexes(job):
+                    self._stream(job)
+                    streamed = True
+                else:
+                    self._end_streams()
+                    self.connection.set_throttle(job.throttle)
+                    if job.run:
+                        job.ok = job.run(self.connection)
+                    else:
+                        job.ok = self.transfer.send_paths(job.paths, job.streams, job.compression)
+            except Exception as e:
+                logger.error(f"❌ Send failed: {e}")
+            finally:
+                self.relay.sinks.pop(ident, None)
+                self.connection.set_throttle(None)
+                with self._lock:
+                    self.active = None
+                if not streamed:
+                    job.finish()
+
+    def _stream(self, job):
+        """Add a job's files to the engine session, starting one if none is running"""
+        if self._engine is None:
+            engine = TransferEngine(self.config, self.connection)
+            engine.start(job.compression)
+            self._engine = engine
+
+        entries = list(walk_sources([Path(path) for path in job.paths]))
+        files = [path for path, _, is_dir in entries if not is_dir]
+        with self._lock:
+            beside = len(self.streaming)
+            self.streaming.append(job)
+        logger.info(f"📤 Sending {job.describe()}" + (f" beside {beside} other job(s)" if beside else ""))
+
+        record = metrics_for(self.config).transfer('send', job.describe(), self.connection)
+        record.method = 'mux'
+        futures = [self._engine.submit(path, relative + '/' if is_dir else relative, job.throttle)
+                   for path, relative, is_dir in entries]
+        left = [len(futures)]
+        counted = threading.Lock()
+
+        def settled(_):
+            with counted:
+                left[0] -= 1
+                if left[0]:
+                    return
+            self._streamed(job, futures, files, record)
+
+        for future in futures:
+            future.add_done_callback(settled)
+        if not futures:
+            self._streamed(job, futures, files, record)
+
+    def _streamed(self, job, futures, files, record):
+        """Account a job whose streams have all ended; runs on the engine's thread"""
+        job.ok = bool(futures) and all(future.result() for future in futures)
+        record.ok = job.ok
+        record.files = len(files)
+        record.bytes = sum(path.stat().st_size for path in files if path.exists())
+        metrics_for(self.config).finish(record)
+
+        message = f"✅ Sent {job.describe()}" if job.ok else f"❌ Send failed: {job.describe()}"
+        logger.log(logging.INFO if job.ok else logging.ERROR, message)
+        if job.sink:
+            # The engine's thread has no relay of its own
+            job.sink('INFO' if job.ok else 'ERROR', message)
+        with self._lock:
+            self.streaming.remove(job)
+        job.finish()
+
+    def _end_streams(self, idle_only=False):
+        """
+        Wait for the engine's streams to end and hand the connection back to
+        plain transfers; with idle_only, only if no job is streaming.
+        """
+        engine = self._engine
+        if engine is None:
+            return
+        with self._lock:
+            if idle_only and self.streaming:
+                return
+        self._engine = None
+        try:
+            engine.finish()
+        except Exception as e:
+            logger.error(f"❌ Multiplexed session failed: {e}")
+
+    def status(self):
+        """Live state for `pig3on status`"""
+        with self._lock:
+            active = [job.describe() for job in self.streaming + ([self.active] if self.active else [])]
+            waiting = [job.describe() for job in self.waiting]
+        status = self.connection.get_status()
+        status.update({'peer_name': self.device['name'], 'address': self.device['address'],
+                       'active': ', '.join(active) or None, 'queued': waiting})
+        return status
+
+
+class Daemon:
+    """
+    Keeps paired sessions open between CLI invocations. Clients send one
+    JSON request per connection and get back the log lines produced while
+    it ran, followed by a final reply with 'done' set. Sends go through the
+    scheduler's persistent queue, so ones not yet finished are picked up
+    again when the daemon restarts.
+    """
+
+    BACKLOG = 16
+
+    def __init__(self, config, rate_limit=None):
+        self.config = config
+        self.address = daemon_address(config)
+        self.sessions = {}      # Peer name -> _Session
+        self.listener = None
+        self.running = False
+        self._relay = _LogRelay()
+        self._lock = threading.Lock()
+        self.scheduler = Scheduler(config, rate_limit)
+        self._jobs = {}         # Job id -> _Job a client waits on, until dispatched
+        self._server = None
+        self._commands = {
+            'scan': self._scan,
+            'connect': self._connect,
+            'send': self._send,
+            'disconnect': self._disconnect,
+            'status': self._status,
+            'stop': self._stop,
+        }
+
+    def serve(self, receive=False, metrics_port=None):
+        """
+        Serve clients until stopped, optionally receiving from peers as well;
+        metrics_port defaults to the config's.
+        """
+        if DaemonClient(self.config).available():
+            raise Exception(f"A daemon is already running on {self.address}")
+
+        self.config.config_dir.mkdir(parents=True, exist_ok=True)
+        if self.address.exists():
+            self.address.unlink()   # Left behind by a daemon that didn't shut down
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(str(self.address))
+        os.chmod(self.address, 0o600)
+        self._server.listen(self.BACKLOG)
+        self._server.settimeout(1)
+        logging.getLogger('pig3on').addHandler(self._relay)
+
+        metrics_port = self.config.metrics_port if metrics_port is None else metrics_port
+        if metrics_port:
+            metrics_for(self.config).serve(metrics_port)
+        if receive:
+            self.listener = ConnectionManager(self.config)
+            self.listener.listening = True
+            threading.Thread(target=self.listener._listen_loop, daemon=True).start()
+
+        self.running = True
+        logger.info(f"🕊️  Daemon ready on {self.address}")
+        self.scheduler.start(self._dispatch, self._busy)
+        try:
+            while self.running:
+                try:
+                    client, _ = self._server.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._handle_client, args=(client,), daemon=True).start()
+        finally:
+            self._shutdown()
+
+    def _shutdown(self):
+        # Jobs cut short from here on stay queued for the next start
+        self.scheduler.stop()
+        for session in list(self.sessions.values()):
+            session.stop()
+        if self.listener:
+            self.listener.listening = False
+        logging.getLogger('pig3on').removeHandler(self._relay)
+        self._server.close()
+        try:
+            self.address.unlink()
+        except FileNotFoundError:
+            pass
+        logger.info("Daemon stopped")
+
+    def _handle_client(self, client):
+        """Run one client request, relaying its log output as it happens"""
+        write_lock = threading.Lock()
+        connected = [True]
+
+        def reply(message):
+            with write_lock:
+                client.sendall(json.dumps(message).encode() + b'\n')
+
+        def relay(level, message):
+            if not connected[0]:
+                return
+            try:
+                reply({'log': message, 'level': level})
+            except OSError:
+                connected[0] = False    # Client went away; the work carries on
+
+        ident = threading.get_ident()
+        self._relay.sinks[ident] = relay
+        try:
+            with client.makefile('rb') as f:
+                request = json.loads(f.readline())
+            handler = self._commands.get(request.get('command'))
+            if handler is None:
+                raise Exception(f"Unknown daemon command {request.get('command')}")
+            result = handler(request, relay)
+        except Exception as e:
+            result = {'ok': False, 'error': str(e)}
+        finally:
+            self._relay.sinks.pop(ident, None)
+
+        try:
+            reply({'done': True, **result})
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def _session_for(self, peer):
+        """The session a command addresses: the named peer, or the only one"""
+        with self._lock:
+            if peer:
+                session = self.sessions.get(peer)
+                if session is None:
+                    raise Exception(f"Not connected to {peer}")
+                return session
+            if not self.sessions:
+                raise Exception("Not connected to any device. Use 'pig3on connect' first.")
+            if len(self.sessions) > 1:
+                raise Exception(f"Connected to {len(self.sessions)} peers; name one of: "
+                                f"{', '.join(sorted(self.sessions))}")
+            return next(iter(self.sessions.values()))
+
+    def _scan(self, request, relay):
+        devices = ConnectionManager(self.config).scan_devices(request.get('timeout', 5))
+        return {'ok': True, 'devices': devices}
+
+    def _connect(self, request, relay):
+        device = request['device']
+        with self._lock:
+            session = self.sessions.get(device['name'])
+        if session and session.connection.is_connected() and \
+                session.device['address'] == device['address']:
+            logger.info(f"Already paired with {device['name']}")
+            return {'ok': True}
+
+        replacement = _Session(self.config, device, self._relay)
+        if not replacement.connection.connect(device):
+            return {'ok': False}
+        replacement.start()
+        with self._lock:
+            session, self.sessions[device['name']] = self.sessions.get(device['name']), replacement
+        if session:
+            session.stop()
+        return {'ok': True}
+
+    def _send(self, request, relay):
+        peers = request.get('peers') or []
+        swarm = request.get('swarm')
+        if len(peers) > 1 or swarm or any(peer not in self.sessions for peer in peers):
+            # Several peers share one read, so they are one job
+            device, unreachable = self._devices_for(peers)
+            fan_out = 'swarm' if swarm else 'copy'
+        else:
+            device = self._session_for(peers[0] if peers else None).device
+            unreachable = []
+            fan_out = None
+        detach = request.get('detach')
+        with self._lock:
+            entry = self.scheduler.add(request['paths'], device, request.get('streams', 1),
+                                       request.get('compression'), request.get('priority', 'normal'),
+                                       request.get('limit', 0), fan_out)
+            job = self._jobs[entry['id']] = self._job_for(entry, None if detach else relay)
+        self.scheduler.wake()
+        if detach:
+            logger.info(f"📋 Queued {job.describe()} ({entry['priority']}); "
+                        f"it is sent even if the daemon restarts")
+            return {'ok': True}
+        job.done.wait()
+        return {'ok': job.ok and not unreachable}
+
+    def _job_for(self, entry, sink):
+        """The job that runs a queued entry, shaped by its priority and limit"""
+        throttle = None
+        if not entry.get('fan_out'):
+            # Fan-outs shape each peer's part as it starts
+            shaper = self.scheduler.shaper
+            throttle = shaper.throttle(entry['device']['name'], entry['priority'],
+                                       shaper.limit(entry['limit']))
+        return _Job(entry['id'], entry['paths'], entry['streams'], entry['compression'], sink,
+                    throttle=throttle, on_done=lambda: self.scheduler.finished(entry['id']))
+
+    def _dispatch(self, entry):
+        """Hand a job from the scheduler to its peer's session, pairing again if there is none"""
+        with self._lock:
+            job = self._jobs.pop(entry['id'], None) or self._job_for(entry, None)
+        if entry.get('fan_out'):
+            # Pairing and waiting on every peer would hold up the scheduler
+            threading.Thread(target=self._fan_out, args=(entry, job), daemon=True).start()
+            return
+
+        device = entry['device']
+        with self._lock:
+            session = self.sessions.get(device['name'])
+            if session is None:
+                # Queued before a restart; the session pairs when the job runs
+                session = self.sessions[device['name']] = _Session(self.config, device, self._relay)
+                session.start()
+        session.submit(job)
+
+    def _busy(self, peer, running):
+        """Whether a job for peer would wait on its session's work in hand, e.g. a fan-out"""
+        with self._lock:
+            session = self.sessions.get(peer)
+        if session is None:
+            return running  # Not paired yet, so whether jobs can share the connection is unknown
+        return session.busy()
+
+    def _fan_out(self, entry, job):
+        """Run a queued fan-out: send to its peers from one read (or seed a swarm), then finish its job"""
+        ident = threading.get_ident()
+        self._relay.sinks[ident] = job.sink
+        try:
+            sessions = self._sessions_for(entry['devices'])
+            if entry['fan_out'] == 'swarm':
+                distributor = SwarmSeed(self.config, entry['paths'])
+            else:
+                distributor = FanOut(self.config, entry['paths'], entry['compression'])
+            distributor.begin([session.connection for session in sessions])
+
+            # One bucket for the send's own limit, so --limit caps it across all peers together
+            shaper = self.scheduler.shaper
+            limit = shaper.limit(entry['limit'])
+            parts = [_Job(entry['id'], entry['paths'], 1, entry['compression'], job.sink,
+                          run=distributor.send_to,
+                          throttle=shaper.throttle(session.device['name'], entry['priority'], limit))
+                     for session in sessions]
+            try:
+                for session, part in zip(sessions, parts):
+                    self._queue(session, part)
+                for part in parts:
+                    part.done.wait()
+            finally:
+                distributor.close()
+            distributor.report()
+            job.ok = all(part.ok for part in parts) and len(sessions) == len(entry['devices'])
+        except Exception as e:
+            logger.error(f"❌ Send failed: {e}")
+        finally:
+            self._relay.sinks.pop(ident, None)
+            job.finish()
+
+    def _devices_for(self, peers):
+        """
+        Devices for the named peers (or every paired one), discovering any not
+        in a session; returns (devices, names that couldn't be found)
+        """
+        with self._lock:
+            if not peers:
+                peers = list(self.sessions)
+            devices = {name: self.sessions[name].device for name in peers if name in self.sessions}
+        wanted = [peer for peer in peers if peer not in devices]
+        unreachable = []
+        if wanted:
+            found, unreachable = ConnectionManager(self.config).find_devices(wanted)
+            for name in unreachable:
+                logger.error(f"Peer not found: {name}")
+            for device in found:
+                devices.setdefault(device['name'], device)
+        if not devices:
+            raise Exception("No peers to send to")
+        return list(devices.values()), unreachable
+
+    def _sessions_for(self, devices):
+        """Paired sessions for devices, pairing where needed; peers that can't be paired are left out"""
+        sessions = []
+        for device in devices:
+            with self._lock:
+                session = self.sessions.get(device['name'])
+            if session is None:
+                if not self._connect({'device': device}, None)['ok']:
+                    logger.error(f"Could not pair with {device['name']}")
+                    continue
+                with self._lock:
+                    session = self.sessions[device['name']]
+            sessions.append(session)
+        if not sessions:
+            raise Exception("No peers to send to")
+        return sessions
+
+    def _queue(self, session, job):
+        if session.active or session.waiting:
+            logger.info(f"⏳ Queued {job.describe()} behind {len(session.waiting) + 1} job(s)")
+        session.submit(job)
+
+    def _disconnect(self, request, relay):
+        peer = request.get('peer')
+        with self._lock:
+            names = [peer] if peer else list(self.sessions)
+            dropped = [self.sessions.pop(name) for name in names if name in self.sessions]
+        for session in dropped:
+            session.stop()
+        for name in names:
+            for entry in self.scheduler.drop(name):
+                logger.info(f"Dropped queued transfer #{entry['id']} to {name}")
+                with self._lock:
+                    job = self._jobs.pop(entry['id'], None)
+                if job:
+                    job.done.set()
+        return {'ok': bool(dropped), 'disconnected': [session.device['name'] for session in dropped]}
+
+    def _status(self, request, relay):
+        with self._lock:
+            sessions = [session.status() for session in self.sessions.values()]
+        incoming = []
+        if self.listener:
+            incoming = [session.get_status() for session in list(self.listener.sessions)]
+        return {'ok': True, 'device_name': self.config.device_name, 'sessions': sessions,
+                'receiving': self.listener is not None, 'incoming': incoming,
+                'scheduled': self.scheduler.describe()}
+
+    def _stop(self, request, relay):
+        self.running = False
+        return {'ok': True}
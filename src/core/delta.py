@@ -0,0 +1,181 @@
+"""
+Delta Transfer for Pig3on
+rsync-style block matching against a copy the receiver already has
+"""
+
+import zlib
+import struct
+import hashlib
+
+ADLER_MOD = 65521
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_BLOCKS = 1 << 16   # Keeps the signature table around 1 MB
+
+# Weak rolling checksum, strong digest
+SIGNATURE = struct.Struct('!I16s')
+
+SEGMENT_SIZE = 4 * 1024 * 1024  # Bytes of the new file scanned per read
+RESYNC_INTERVAL = 16             # While nothing matches, only roll through every Nth block
+
+
+def choose_block_size(size):
+    """Block size that keeps the signature table bounded"""
+    block_size = MIN_BLOCK_SIZE
+    while block_size < MAX_BLOCK_SIZE and size > block_size * MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def strong_digest(data):
+    """Strong block digest used to confirm weak checksum hits"""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def block_signatures(f, size, block_size):
+    """Packed (weak, strong) signature for every block of an existing file"""
+    table = bytearray()
+    buffer = bytearray(block_size)
+    f.seek(0)
+    remaining = size
+    while remaining > 0:
+        view = memoryview(buffer)[:min(block_size, remaining)]
+        read = f.readinto(view)
+        if not read:
+            break
+        block = view[:read]
+        table += SIGNATURE.pack(zlib.adler32(block), strong_digest(block))
+        remaining -= read
+    return bytes(table)
+
+
+class DeltaEncoder:
+    """Turns a new file into COPY instructions and literal runs against the receiver's blocks"""
+
+    def __init__(self, table, block_size, old_size):
+        self.block_size = block_size
+        self.old_size = old_size
+        self.strong = []
+        self.weak = {}
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(table)):
+            self.strong.append(strong)
+            self.weak.setdefault(weak, []).append(index)
+
+    def _block_length(self, index):
+        return min(self.block_size, self.old_size - index * self.block_size)
+
+    def _match(self, weak, window, expected):
+        """Index of an old block matching window, preferring the one that extends the last copy"""
+        candidates = self.weak.get(weak)
+        if not candidates:
+            return None
+        strong = strong_digest(window)
+        if expected in candidates and self.strong[expected] == strong:
+            return expected
+        for index in candidates:
+            if self.strong[index] == strong and self._block_length(index) == len(window):
+                return index
+        return None
+
+    def encode(self, f, on_copy, on_literal, on_data=None):
+        """
+        Scan the new file once. Calls on_copy(offset, block, count) for runs of
+        reusable old blocks and on_literal(data, offset) for new bytes, both in
+        target offset order. on_data(data, offset) sees every byte as it is read.
+        """
+        block_size = self.block_size
+        buf = b''
+        base = 0            # File offset of buf[0]
+        pos = 0             # Scan position, relative to buf
+        literal_start = 0   # Start of pending literal bytes, relative to buf
+        copy = None         # [target offset, first block, count] being extended
+        misses = 0          # Bytes scanned since the last match
+        a = b = None        # Rolling Adler-32 state for buf[pos:pos + block_size]
+
+        f.seek(0)
+        eof = False
+        view = memoryview(buf)
+
+        while True:
+            # Keep at least one block (plus a byte to roll in) ahead of pos
+            if not eof and len(buf) - pos <= block_size:
+                data = f.read(SEGMENT_SIZE)
+                if data and on_data:
+                    on_data(data, base + len(buf))
+                eof = len(data) < SEGMENT_SIZE
+                view.release()
+                buf = buf[literal_start:] + data
+                view = memoryview(buf)
+                base += literal_start
+                pos -= literal_start
+                literal_start = 0
+                continue
+
+            window_end = min(pos + block_size, len(buf))
+            if pos >= window_end:
+                break
+
+            if a is None:
+                weak = zlib.adler32(view[pos:window_end])
+                a, b = weak & 0xffff, weak >> 16
+            else:
+                weak = (b << 16) | a
+
+            index = None
+            if weak in self.weak:
+                expected = copy[1] + copy[2] if copy else 0
+                index = self._match(weak, view[pos:window_end], expected)
+
+            if index is not None:
+                # Flush literal bytes that precede the match
+                if literal_start < pos:
+                    self._emit_literal(view, literal_start, pos, base, on_literal)
+
+                target = base + pos
+                if copy and copy[1] + copy[2] == index and copy[0] + copy[2] * block_size == target:
+                    copy[2] += 1
+                else:
+                    if copy:
+                        on_copy(*copy)
+                    copy = [target, index, 1]
+
+                pos = window_end
+                literal_start = pos
+                misses = 0
+                a = b = None
+                continue
+
+            if copy:
+                on_copy(*copy)
+                copy = None
+
+            # Roll byte by byte to realign after insertions; while nothing has matched
+            # for a while, only roll through every RESYNC_INTERVAL-th block
+            rolling = misses < block_size or (misses // block_size) % RESYNC_INTERVAL == 0
+            if rolling and window_end < len(buf) and window_end - pos == block_size:
+                out_byte = buf[pos]
+                a = (a - out_byte + buf[window_end]) % ADLER_MOD
+                b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+                pos += 1
+                misses += 1
+            else:
+                pos = window_end
+                misses += block_size
+                a = b = None
+
+            if pos - literal_start >= MAX_BLOCK_SIZE:
+                self._emit_literal(view, literal_start, pos, base, on_literal)
+                literal_start = pos
+
+        if copy:
+            on_copy(*copy)
+        if literal_start < len(buf):
+            self._emit_literal(view, literal_start, len(buf), base, on_literal)
+        view.release()
+
+    def _emit_literal(self, view, start, end, base, on_literal):
+        while start < end:
+            chunk_end = min(end, start + MAX_BLOCK_SIZE)
+            on_literal(view[start:chunk_end], base + start)
+            start = chunk_end
@@ -0,0 +1,213 @@
+"""
+Peer Discovery for Pig3on
+Multicast presence announcements, adaptive scans and a registry of recently seen peers
+"""
+
+import os
+import json
+import time
+import socket
+import struct
+import threading
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+MULTICAST_GROUP = '239.255.77.78'   # Administratively scoped; stays on the local network
+MULTICAST_TTL = 1
+ANNOUNCE_INTERVAL = 5.0     # Seconds between a listener's presence announcements
+PROBE_INTERVAL = 0.05       # First retransmission; doubles up to PROBE_MAX_INTERVAL
+PROBE_MAX_INTERVAL = 1.0
+MIN_PROBES = 3              # Lossy WiFi drops single datagrams; ask a few times before settling
+SETTLE_TIME = 0.2           # Quiet period after the last new answer before a scan returns
+
+ALL_DISCOVERED = 'all-discovered'
+
+
+def select_devices(targets, devices):
+    """Pick discovered devices named (or addressed) by targets; returns (chosen, missing targets)"""
+    if ALL_DISCOVERED in targets:
+        return list(devices), []
+    chosen = []
+    missing = []
+    for target in targets:
+        match = next((device for device in devices
+                      if target in (device['name'], device['address'])), None)
+        if match:
+            chosen.append(match)
+        else:
+            missing.append(target)
+    return chosen, missing
+
+
+def device_key(device):
+    return f"{device['address']}:{device['port']}"
+
+
+def open_responder_socket(port):
+    """UDP socket answering broadcast probes that has also joined the announcement group"""
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    udp_socket.bind(('', port))
+    _join_group(udp_socket)
+    return udp_socket
+
+
+def open_probe_socket():
+    """UDP socket for sending probes by broadcast and multicast"""
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    return udp_socket
+
+
+def send_everywhere(udp_socket, message, port):
+    """Send a datagram by broadcast and to the multicast group; True if either went out"""
+    sent = False
+    for address in ('<broadcast>', MULTICAST_GROUP):
+        try:
+            udp_socket.sendto(message, (address, port))
+            sent = True
+        except OSError as e:
+            logger.debug(f"Could not send to {address}: {e}")
+    return sent
+
+
+def _join_group(udp_socket):
+    try:
+        membership = struct.pack('4s4s', socket.inet_aton(MULTICAST_GROUP),
+                                 socket.inet_aton('0.0.0.0'))
+        udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+    except OSError as e:
+        # No multicast route (e.g. no network yet); broadcast probes still work
+        logger.debug(f"Multicast unavailable: {e}")
+
+
+class ProbeSchedule:
+    """
+    When to retransmit a scan probe and when the scan may stop: probes go
+    out at exponentially growing intervals, and once some device has
+    answered and nothing new has arrived for SETTLE_TIME the results are
+    considered stable. With nobody answering the scan runs to its timeout.
+    """
+
+    def __init__(self, timeout):
+        self.start = time.monotonic()
+        self.deadline = self.start + timeout
+        self.next_probe = self.start
+        self.interval = PROBE_INTERVAL
+        self.probes = 0
+        self.last_new = self.start
+        self.found = 0
+
+    def probe_due(self):
+        return time.monotonic() >= self.next_probe
+
+    def probed(self):
+        self.probes += 1
+        self.next_probe = time.monotonic() + self.interval
+        self.interval = min(self.interval * 2, PROBE_MAX_INTERVAL)
+
+    def answered(self):
+        self.found += 1
+        self.last_new = time.monotonic()
+
+    def finished(self):
+        now = time.monotonic()
+        if now >= self.deadline:
+            return True
+        return self.found > 0 and self.probes >= MIN_PROBES and now - self.last_new >= SETTLE_TIME
+
+    def wait_time(self):
+        """Seconds to block for an answer before something else is due"""
+        now = time.monotonic()
+        until = min(self.next_probe, self.deadline)
+        if self.found and self.probes >= MIN_PROBES:
+            until = min(until, self.last_new + SETTLE_TIME)
+        return max(0.001, until - now)
+
+
+class PeerRegistry:
+    """
+    Peers seen recently, by scans or their own announcements, kept in a
+    JSON file so that later commands can connect without scanning. Entries
+    expire ttl seconds after they were last heard from. Several processes
+    may share the file, so saves merge with what is on disk.
+    """
+
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._peers = None      # "address:port" -> device dict with 'seen'
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                peers = json.load(f)
+            return peers if isinstance(peers, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _entries(self):
+        if self._peers is None:
+            self._peers = self._load()
+        return self._peers
+
+    def record(self, devices):
+        """Note devices as seen just now, saving at once if any are new"""
+        now = time.time()
+        with self._lock:
+            peers = self._entries()
+            new = any(device_key(device) not in peers for device in devices)
+            for device in devices:
+                peers[device_key(device)] = {**device, 'seen': now}
+            # Refreshes from frequent announcements are written out at most once per SAVE_INTERVAL
+            if new or now - self._saved >= self.SAVE_INTERVAL:
+                self._save_locked()
+
+    def forget(self, device):
+        """Drop a device that has gone away"""
+        with self._lock:
+            self._entries().pop(device_key(device), None)
+            self._save_locked(dropped=device_key(device))
+
+    def live(self):
+        """Unexpired peers, most recently seen first"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            # Pick up what other processes have heard since
+            fresh = [peer for peer in self._merged().values() if peer.get('seen', 0) >= cutoff]
+        fresh.sort(key=lambda peer: peer['seen'], reverse=True)
+        return [{key: value for key, value in peer.items() if key != 'seen'} for peer in fresh]
+
+    def _merged(self, dropped=None):
+        """Our entries combined with the file's, keeping the newer sighting of each peer"""
+        merged = self._load()
+        merged.pop(dropped, None)
+        for key, peer in self._entries().items():
+            if peer.get('seen', 0) >= merged.get(key, {}).get('seen', 0):
+                merged[key] = peer
+        self._peers = merged
+        return merged
+
+    def _save_locked(self, dropped=None):
+        cutoff = time.time() - self.ttl
+        merged = {key: peer for key, peer in self._merged(dropped).items()
+                  if peer.get('seen', 0) >= cutoff}
+        self._peers = merged
+        self._saved = time.time()
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            with open(temp_file, 'w') as f:
+                json.dump(merged, f, indent=2)
+            os.replace(temp_file, self.path)
+        except OSError as e:
+            logger.debug(f"Could not save peer registry: {e}")
@@ -0,0 +1,552 @@
+"""
+Transfer Engine for Pig3on
+Multiplexes concurrent transfers over the paired connection with asyncio
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from utils.logger import get_logger
+from .batch import safe_destination, walk_sources
+from .compression import (CODECS, Chunk, Compressor, choose_codec, decompress, offered_codecs,
+                          read_range)
+from .integrity import StreamHasher
+from utils.crypto import SEAL_OVERHEAD
+from .protocol import (FLAG_COMPRESSED, FRAME_CONTROL, FRAME_DATA, HEADER, MAX_CONTROL_SIZE,
+                       MAX_PAYLOAD_SIZE, ProtocolError, decode_header)
+
+logger = get_logger(__name__)
+
+
+async def _receive_exact(loop, sock, num_bytes):
+    """Receive exactly num_bytes from a non-blocking socket"""
+    data = bytearray(num_bytes)
+    view = memoryview(data)
+    received = 0
+    while received < num_bytes:
+        count = await loop.sock_recv_into(sock, view[received:])
+        if not count:
+            raise ConnectionError("Connection closed")
+        received += count
+    return data
+
+
+async def _receive_frame(loop, sock, channel):
+    """
+    Receive one frame as (type, flags, stream id, offset, payload). Control
+    payloads are opened and decoded; data payloads are left for the caller
+    to open with channel.open, which is safe on worker threads.
+    """
+    frame_type, flags, stream_id, offset, length = decode_header(
+        await _receive_exact(loop, sock, HEADER.size))
+    limit = MAX_CONTROL_SIZE if frame_type == FRAME_CONTROL else MAX_PAYLOAD_SIZE
+    if length > limit + (SEAL_OVERHEAD if channel.opener else 0):
+        raise ProtocolError("Frame too large")
+    payload = await _receive_exact(loop, sock, length)
+    if frame_type == FRAME_CONTROL:
+        flags, payload = channel.open(frame_type, flags, stream_id, offset, payload)
+        payload = json.loads(bytes(payload))
+    elif frame_type != FRAME_DATA:
+        raise ProtocolError(f"Unknown frame type {frame_type}")
+    return frame_type, flags, stream_id, offset, payload
+
+
+class _OutgoingStream:
+    """Sender-side state of one file being multiplexed"""
+
+    def __init__(self, stream_id, path, relative, future, credit, throttle=None):
+        self.id = stream_id
+        self.path = path
+        self.relative = relative
+        self.future = future
+        self.credit = credit
+        self.throttle = throttle        # Paces this stream's data, e.g. by its job's priority
+        self.size = 0
+        self.ready = deque()            # Prepared (offset, chunk, frame); a None chunk ends the file
+        self.space = asyncio.Event()    # Set while the producer may prepare more
+        self.space.set()
+        self.hasher = StreamHasher()
+        self.producer = None
+
+
+class TransferEngine:
+    """
+    Runs transfers as logical streams over the session connection. Each
+    stream may have STREAM_WINDOW bytes unacknowledged before it waits for
+    CREDIT from the receiver, and streams with data and credit take turns
+    one chunk at a time, so a small file is never stuck behind a large one.
+    Files may be submitted while others are in flight, each stream paced by
+    a throttle of its own.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+    STREAM_WINDOW = 4 * 1024 * 1024   # Bytes each stream may send ahead of the receiver's writes
+    CREDIT_STEP = 1024 * 1024         # Receiver returns credit in steps of this many bytes
+    MAX_STREAMS = 16                  # Streams open at once; later submissions wait their turn
+    READ_AHEAD = 2                    # Chunks prepared ahead per stream
+    OPEN_AHEAD = 8                    # Received chunks being decrypted at once
+
+    def __init__(self, config, connection_manager):
+        self.config = config
+        self.connection = connection_manager
+        self._loop = None
+        self._thread = None
+        self._pool = None
+        self._pacing = None         # Threads streams wait on their throttles in
+        self._channel = None
+        self._compressor = None
+        self._queued = deque()      # (path, relative, future, throttle) not yet opened
+        self._streams = {}          # id -> _OutgoingStream with data left to send
+        self._awaiting = {}         # id -> _OutgoingStream sent, waiting for DONE
+        self._next_id = 0
+        self._turn = 0
+        self._wake = None
+        self._closing = False
+        self._timeout = None
+        self._error = None
+        self.sent_bytes = 0
+        self.sent_chunks = 0
+        self.totals = (0, 0)        # Files and bytes moved by the last send or serve
+
+    # Sending
+
+    def start(self, compression=None):
+        """Switch the session into multiplexed mode and start the engine thread"""
+        channel = self.connection.channel
+        request = {'type': 'MUX', 'window': self.STREAM_WINDOW}
+        if 'compress' in self.connection.peer_features:
+            codecs = offered_codecs(compression or self.config.compression)
+            if codecs:
+                request['compression'] = codecs
+        channel.send_control(request)
+
+        ready = channel.receive_control()
+        if ready.get('status') != 'READY':
+            raise Exception(ready.get('message', 'Peer not ready to receive'))
+
+        codec = ready.get('compression')
+        self._compressor = Compressor(codec) if codec in CODECS else None
+        self._channel = channel
+        self._pool = ThreadPoolExecutor(max_workers=self._compressor.workers
+                                        if self._compressor else 2)
+        self._pacing = ThreadPoolExecutor(max_workers=self.MAX_STREAMS)
+        self._loop = asyncio.new_event_loop()
+        self._timeout = self.connection.socket.gettimeout()
+        self.connection.socket.setblocking(False)
+
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+
+    @property
+    def running(self):
+        """Whether the engine still takes submissions"""
+        return self._thread is not None and self._thread.is_alive() and not self._closing
+
+    def submit(self, path, relative=None, throttle=None):
+        """
+        Queue a file (or directory entry) for sending; returns a Future of its
+        outcome. throttle paces the stream instead of the channel's.
+        """
+        future = Future()
+        self._loop.call_soon_threadsafe(self._enqueue, Path(path),
+                                        relative or Path(path).name, future, throttle)
+        return future
+
+    def finish(self):
+        """Wait for every submitted transfer, then hand the connection back"""
+        try:
+            self._loop.call_soon_threadsafe(self._close_when_idle)
+        except RuntimeError:
+            pass    # The session already ended with an error
+        try:
+            while self._thread.is_alive():
+                self._thread.join(0.5)  # Short steps so Ctrl+C reaches the main thread
+        finally:
+            self.connection.socket.settimeout(self._timeout)
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pacing.shutdown(wait=False, cancel_futures=True)
+            if self._compressor:
+                self._compressor.close()
+        if self._error:
+            raise self._error
+
+    def send(self, paths, compression=None):
+        """Send files and directories as concurrent streams; returns True if all arrived intact"""
+        self.start(compression)
+        start_time = time.time()
+        results = []
+        files = 0
+        try:
+            for path, relative, is_dir in walk_sources(paths):
+                # A trailing slash marks directory entries
+                results.append((relative, self.submit(path, relative + '/' if is_dir else relative)))
+                files += not is_dir
+        finally:
+            self.finish()
+
+        failed = [relative for relative, future in results if not future.result()]
+        self.totals = (files, self.sent_bytes)
+        elapsed = time.time() - start_time
+        logger.info(f"🔀 Sent {len(results)} entries ({self.sent_bytes} bytes) over "
+                    f"multiplexed streams in {elapsed:.1f}s")
+        if self._compressor:
+            self._compressor.report(lambda size: f"{size} bytes")
+        for relative in failed:
+            logger.error(f"Failed on peer: {relative}")
+        return not failed
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._wake = asyncio.Event()
+        self._loop.call_soon(started.set)
+        try:
+            self._loop.run_until_complete(self._session())
+        except Exception as e:
+            self._error = e
+            for stream in list(self._streams.values()) + list(self._awaiting.values()):
+                if not stream.future.done():
+                    stream.future.set_result(False)
+            for _, _, future, _ in self._queued:
+                future.set_result(False)
+        finally:
+            self._loop.close()
+
+    def _enqueue(self, path, relative, future, throttle):
+        self._queued.append((path, relative, future, throttle))
+        self._wake.set()
+
+    def _close_when_idle(self):
+        self._closing = True
+        self._wake.set()
+
+    async def _session(self):
+        sock = self.connection.socket
+        reader = asyncio.ensure_future(self._read_replies(sock))
+        try:
+            await self._write_streams(sock)
+            await self._send_control(sock, {'type': 'MUX_END'})
+            await reader
+        finally:
+            reader.cancel()
+
+    async def _write_streams(self, sock):
+        """Open queued streams and interleave their chunks fairly until everything is sent"""
+        waited = False
+        while True:
+            while self._queued and len(self._streams) < self.MAX_STREAMS:
+                await self._open(sock, *self._queued.popleft())
+
+            stream = self._next_ready()
+            if stream is None:
+                if self._closing and not self._queued and not self._streams and not self._awaiting:
+                    return
+                if (self._compressor and self.sent_chunks >= self._compressor.workers and
+                        any(not s.ready and s.credit > 0 for s in self._streams.values())):
+                    # Streams that may send are waiting on the pool: compression is the bottleneck
+                    self._compressor.stalled()
+                self._wake.clear()
+                await self._wake.wait()
+                if self._error:
+                    raise self._error
+                waited = True
+                continue
+
+            offset, chunk, frame = stream.ready.popleft()
+            stream.space.set()
+            if chunk is None:
+                await self._close_stream(sock, stream, offset)
+                continue
+            if self._compressor and not waited:
+                self._compressor.kept_up()
+            waited = False
+
+            length = len(chunk.data)
+            await self._send(sock, frame)
+            stream.credit -= length
+            self.sent_chunks += 1
+            if self._compressor:
+                self._compressor.account(length, chunk)
+
+    def _next_ready(self):
+        """Round-robin over streams that have a prepared chunk and credit to send it"""
+        streams = list(self._streams.values())
+        for step in range(len(streams)):
+            stream = streams[(self._turn + step) % len(streams)]
+            if not stream.ready:
+                continue
+            offset, chunk, _ = stream.ready[0]
+            if chunk is None or stream.credit >= len(chunk.data):
+                self._turn = (self._turn + step + 1) % len(streams)
+                return stream
+        return None
+
+    async def _open(self, sock, path, relative, future, throttle):
+        stream_id = self._next_id
+        self._next_id += 1
+
+        if relative.endswith('/'):
+            await self._send_control(sock, {'type': 'OPEN', 'stream': stream_id,
+                                            'path': relative.rstrip('/'), 'dir': True})
+            future.set_result(True)
+            return
+
+        try:
+            size = path.stat().st_size
+        except OSError as e:
+            logger.warning(f"Skipping unreadable file {path}: {e}")
+            future.set_result(False)
+            return
+
+        stream = _OutgoingStream(stream_id, path, relative, future, self.STREAM_WINDOW,
+                                 throttle or self._channel.throttle)
+        stream.size = size
+        self._streams[stream_id] = stream
+        await self._send_control(sock, {'type': 'OPEN', 'stream': stream_id, 'path': relative,
+                                        'size': size})
+        stream.producer = asyncio.ensure_future(self._produce(stream))
+
+    async def _produce(self, stream):
+        """Read (and compress and seal) a stream's chunks in the pool, a couple ahead of the writer"""
+        try:
+            for offset in range(0, stream.size, self.CHUNK_SIZE):
+                length = min(self.CHUNK_SIZE, stream.size - offset)
+                chunk, frame = await self._loop.run_in_executor(
+                    self._pool, self._prepare, stream, offset, length)
+                if stream.throttle:
+                    # Paced here rather than by the writer, so a stream waiting on its
+                    # bucket never holds up the others
+                    await self._loop.run_in_executor(self._pacing, stream.throttle, len(frame))
+                stream.hasher.update(chunk.data, offset)
+                await self._push(stream, (offset, chunk, frame))
+            await self._push(stream, (stream.size, None, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._push(stream, (str(e), None, None))
+
+    def _prepare(self, stream, offset, length):
+        """Build a chunk's data frame on a pool thread"""
+        if self._compressor:
+            chunk = self._compressor.prepare(stream.path, offset, length)
+        else:
+            chunk = Chunk(read_range(stream.path, offset, length), None)
+        if chunk.payload is not None:
+            frame = self._channel.frame(FRAME_DATA, chunk.payload, stream.id, offset, FLAG_COMPRESSED)
+        else:
+            frame = self._channel.frame(FRAME_DATA, chunk.data, stream.id, offset)
+        return chunk, frame
+
+    async def _push(self, stream, item):
+        """Hand a prepared chunk to the writer, waiting while the stream is READ_AHEAD chunks ahead"""
+        while len(stream.ready) >= self.READ_AHEAD:
+            stream.space.clear()
+            await stream.space.wait()
+        stream.ready.append(item)
+        self._wake.set()
+
+    async def _close_stream(self, sock, stream, result):
+        del self._streams[stream.id]
+        if isinstance(result, str):
+            # The file couldn't be read to the end
+            logger.warning(f"Aborting {stream.relative}: {result}")
+            await self._send_control(sock, {'type': 'ABORT', 'stream': stream.id, 'message': result})
+            stream.future.set_result(False)
+            return
+        await self._send_control(sock, {'type': 'CLOSE', 'stream': stream.id,
+                                        'checksum': stream.hasher.hexdigest()})
+        self._awaiting[stream.id] = stream
+        self.sent_bytes += stream.size
+
+    async def _read_replies(self, sock):
+        """Apply CREDIT and DONE messages from the receiver until it ends the session"""
+        try:
+            while True:
+                frame_type, _, _, _, message = await _receive_frame(self._loop, sock, self._channel)
+                if frame_type != FRAME_CONTROL:
+                    raise ProtocolError("Unexpected data from receiver")
+
+                kind = message.get('type')
+                if kind == 'CREDIT':
+                    stream = self._streams.get(message['stream'])
+                    if stream:
+                        stream.credit += message['bytes']
+                elif kind == 'DONE':
+                    stream = self._awaiting.pop(message['stream'], None)
+                    stream = stream or self._streams.pop(message['stream'], None)
+                    if stream:
+                        if stream.producer:
+                            stream.producer.cancel()
+                        ok = message.get('status') == 'SUCCESS'
+                        if not ok:
+                            logger.error(f"❌ {stream.relative}: {message.get('message')}")
+                        stream.future.set_result(ok)
+                elif kind == 'MUX_END':
+                    return
+                else:
+                    raise Exception(message.get('message', f"Unexpected message {kind}"))
+                self._wake.set()
+        except Exception as e:
+            self._error = e
+            self._wake.set()
+
+    async def _send(self, sock, data):
+        await self._loop.sock_sendall(sock, data)
+
+    async def _send_control(self, sock, message):
+        await self._send(sock, self._channel.frame(FRAME_CONTROL, json.dumps(message).encode()))
+
+    # Receiving
+
+    def serve(self, request):
+        """Receive a multiplexed session started by the peer's engine until it ends"""
+        codec = choose_codec(request.get('compression'))
+        ready = {'status': 'READY'}
+        if codec:
+            ready['compression'] = codec
+        self.connection.channel.send_control(ready)
+        logger.info("\n📥 Incoming multiplexed transfers")
+
+        sock = self.connection.socket
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        self._channel = self.connection.channel
+        if self._channel.opener:
+            self._pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        try:
+            return asyncio.run(self._serve(sock, codec))
+        finally:
+            sock.settimeout(timeout)
+            if self._pool:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self, sock, codec):
+        self._loop = asyncio.get_running_loop()
+        root = Path(self.config.download_dir)
+        root.mkdir(parents=True, exist_ok=True)
+        incoming = {}   # id -> [file, part path, destination, hasher, size, unacknowledged bytes]
+        received = 0
+        total_bytes = 0
+        frames = asyncio.Queue(self.OPEN_AHEAD)
+        reader = asyncio.ensure_future(self._receive_frames(sock, frames))
+
+        try:
+            while True:
+                frame_type, flags, stream_id, offset, payload = await frames.get()
+                if frame_type is None:
+                    raise payload
+                if isinstance(payload, asyncio.Future):
+                    flags, payload = await payload
+
+                if frame_type == FRAME_DATA:
+                    entry = incoming.get(stream_id)
+                    if entry is None:
+                        continue  # Data for a stream that was refused
+                    f, _, _, hasher, size, _ = entry
+                    if offset != hasher.position:
+                        raise Exception(f"Unexpected data at {offset} for stream {stream_id}")
+                    if flags & FLAG_COMPRESSED:
+                        if not codec:
+                            raise Exception("Compressed data without a negotiated codec")
+                        payload = decompress(codec, payload, size - offset)
+                    f.write(payload)
+                    hasher.update(payload, offset)
+
+                    # Return credit once it has been written
+                    entry[5] += len(payload)
+                    if entry[5] >= self.CREDIT_STEP:
+                        await self._send_control(sock, {'type': 'CREDIT', 'stream': stream_id,
+                                                        'bytes': entry[5]})
+                        entry[5] = 0
+                    continue
+
+                kind = payload.get('type')
+                stream_id = payload.get('stream')
+
+                if kind == 'OPEN':
+                    destination = safe_destination(root, payload['path'])
+                    if destination is None:
+                        logger.warning(f"Refusing unsafe path: {payload['path']}")
+                        await self._send_control(sock, {'type': 'DONE', 'stream': stream_id,
+                                                        'status': 'ERROR', 'message': 'Unsafe path'})
+                    elif payload.get('dir'):
+                        destination.mkdir(parents=True, exist_ok=True)
+                    else:
+                        destination.parent.mkdir(parents=True, exist_ok=True)
+                        part_path = destination.with_name(destination.name + '.part')
+                        incoming[stream_id] = [open(part_path, 'wb'), part_path, destination,
+                                               StreamHasher(), payload['size'], 0]
+
+                elif kind == 'CLOSE':
+                    entry = incoming.pop(stream_id, None)
+                    if entry is None:
+                        continue
+                    f, part_path, destination, hasher, size, _ = entry
+                    f.close()
+                    if hasher.position == size and hasher.hexdigest() == payload.get('checksum'):
+                        os.replace(part_path, destination)
+                        received += 1
+                        total_bytes += size
+                        logger.debug(f"Saved {destination}")
+                        reply = {'type': 'DONE', 'stream': stream_id, 'status': 'SUCCESS'}
+                    else:
+                        logger.error(f"❌ Verification failed: {destination.name}")
+                        part_path.unlink()
+                        reply = {'type': 'DONE', 'stream': stream_id, 'status': 'ERROR',
+                                 'message': 'Checksum mismatch'}
+                    await self._send_control(sock, reply)
+
+                elif kind == 'ABORT':
+                    entry = incoming.pop(stream_id, None)
+                    if entry is not None:
+                        entry[0].close()
+                        entry[1].unlink()
+
+                elif kind == 'MUX_END':
+                    await self._send_control(sock, {'type': 'MUX_END'})
+                    self.totals = (received, total_bytes)
+                    logger.info(f"✅ Received {received} files ({total_bytes} bytes) into: {root}")
+                    return True
+
+                else:
+                    logger.error(f"\n❌ Transfer error: {payload.get('message', f'Unexpected message {kind}')}")
+                    return False
+
+        except Exception as e:
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            return False
+        finally:
+            reader.cancel()
+            for f, part_path, _, _, _, _ in incoming.values():
+                f.close()
+                part_path.unlink()
+
+    async def _receive_frames(self, sock, frames):
+        """
+        Read frames ahead of the writer, decrypting data chunks on the pool
+        while later ones are still arriving. Stops after MUX_END, which hands
+        the connection back to the session.
+        """
+        try:
+            while True:
+                frame_type, flags, stream_id, offset, payload = await _receive_frame(
+                    self._loop, sock, self._channel)
+                if frame_type == FRAME_DATA:
+                    if self._pool:
+                        payload = self._loop.run_in_executor(self._pool, self._channel.open,
+                                                             frame_type, flags, stream_id, offset,
+                                                             payload)
+                    else:
+                        flags, payload = self._channel.open(frame_type, flags, stream_id, offset,
+                                                            payload)
+                await frames.put((frame_type, flags, stream_id, offset, payload))
+                if frame_type == FRAME_CONTROL and payload.get('type') == 'MUX_END':
+                    return
+        except Exception as e:
+            await frames.put((None, None, None, None, e))
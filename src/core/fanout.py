@@ -0,0 +1,303 @@
+"""
+Fan-out Sending for Pig3on
+Sends the same files to many peers from a single read of the disk
+"""
+
+import time
+import threading
+from collections import deque
+from pathlib import Path
+from utils.logger import get_logger
+from .batch import walk_sources
+from .compression import CODECS, Chunk, Compressor, read_range
+from .engine import TransferEngine
+from .integrity import StreamHasher
+from .protocol import FLAG_COMPRESSED
+
+logger = get_logger(__name__)
+
+
+class SharedSource:
+    """
+    Walks the sources once, reading, hashing and compressing every chunk a
+    single time for all peers, who take the resulting items by index.
+    Chunk bytes are held for the newest BUFFER_CHUNKS items only and the
+    reader keeps at most that far ahead of the fastest peer; a peer that
+    falls further behind re-reads its chunks from disk instead of holding
+    the others back.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+    BUFFER_CHUNKS = 64      # 16 MB shared between peers
+
+    def __init__(self, paths, compression=None):
+        self.paths = [Path(path) for path in paths]
+        self.compressor = Compressor(compression) if compression in CODECS else None
+        self.items = []     # ('dir', relative) / ('open', relative, size) /
+                            # ['data', offset, length, chunk, path] / ('close', checksum) /
+                            # ('abort', message)
+        self.rereads = 0
+        self._retained = deque()
+        self._positions = {}    # Peer key -> index of the next item it will take
+        self._finished = False
+        self._abandoned = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+
+    def register(self, peer):
+        """Add a peer before start so the reader paces itself against it"""
+        with self._cond:
+            self._positions[peer] = 0
+
+    def start(self):
+        self._thread.start()
+
+    def leave(self, peer):
+        """A peer is done with the items; the reader stops once every peer has left"""
+        with self._cond:
+            self._positions.pop(peer, None)
+            self._abandoned = not self._positions
+            self._cond.notify_all()
+
+    def get(self, peer, index):
+        """The item at index, waiting for the reader; None after the last one"""
+        with self._cond:
+            while index >= len(self.items) and not self._finished:
+                self._cond.wait()
+            if index >= len(self.items):
+                return None
+            if self._positions.get(peer, 0) <= index:
+                self._positions[peer] = index + 1
+                self._cond.notify_all()
+            item = self.items[index]
+            if item[0] != 'data':
+                return item
+            _, offset, length, chunk, path = item
+
+        if chunk is None:
+            # Evicted before this peer got to it
+            self.rereads += 1
+            chunk = Chunk(read_range(path, offset, length), None)
+        return ('data', offset, length, chunk)
+
+    def close(self):
+        with self._cond:
+            self._abandoned = True
+            self._cond.notify_all()
+        if self.compressor:
+            self.compressor.close()
+
+    def _read(self):
+        try:
+            for path, relative, is_dir in walk_sources(self.paths):
+                if self._abandoned:
+                    return
+                if is_dir:
+                    self._append(('dir', relative))
+                    continue
+                try:
+                    self._read_file(path, relative)
+                except OSError as e:
+                    logger.warning(f"Aborting {relative}: {e}")
+                    self._append(('abort', str(e)))
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def _read_file(self, path, relative):
+        size = path.stat().st_size
+        self._append(('open', relative, size))
+        hasher = StreamHasher()
+        ranges = ((offset, min(self.CHUNK_SIZE, size - offset))
+                  for offset in range(0, size, self.CHUNK_SIZE))
+
+        if self.compressor:
+            prepared = self.compressor.pipeline(ranges, lambda item: (path, *item))
+        else:
+            prepared = ((item, None) for item in ranges)
+
+        for (offset, length), chunk in prepared:
+            if chunk is None:
+                chunk = Chunk(read_range(path, offset, length), None)
+            hasher.update(chunk.data, offset)
+            if self.compressor:
+                self.compressor.account(length, chunk)
+            if not self._append(['data', offset, length, chunk, path]):
+                return
+        self._append(('close', hasher.hexdigest()))
+
+    def _append(self, item):
+        """Publish an item once the fastest peer is close enough; False if every peer left"""
+        with self._cond:
+            while not self._abandoned and \
+                    len(self.items) - max(self._positions.values(), default=0) >= self.BUFFER_CHUNKS:
+                self._cond.wait()
+            if self._abandoned:
+                return False
+
+            self.items.append(item)
+            if item[0] == 'data':
+                self._retained.append(len(self.items) - 1)
+                if len(self._retained) > self.BUFFER_CHUNKS:
+                    self.items[self._retained.popleft()][3] = None
+            self._cond.notify_all()
+            return True
+
+
+class FanOut:
+    """Sends one SharedSource to many paired peers at once, each at its own pace"""
+
+    def __init__(self, config, paths, compression=None):
+        self.config = config
+        self.paths = paths
+        self.compression = compression
+        self.source = SharedSource(paths, compression)
+        self.results = []
+        self._lock = threading.Lock()
+
+    def begin(self, connections):
+        """Start reading, paced by the peers that will be sent to"""
+        for connection in connections:
+            self.source.register(connection)
+        self.source.start()
+
+    def send(self, connections):
+        """Send to every connection on its own thread; returns True if all peers succeeded"""
+        self.begin(connections)
+        threads = [threading.Thread(target=self.send_to, args=(connection,), daemon=True)
+                   for connection in connections]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)    # Short steps so Ctrl+C reaches the main thread
+        finally:
+            self.close()
+        self.report()
+        return all(result['ok'] for result in self.results)
+
+    def close(self):
+        """Stop the reader and release buffered chunks"""
+        self.source.close()
+
+    def send_to(self, connection):
+        """Send every item to one peer; returns True if it received everything intact"""
+        start_time = time.time()
+        result = {'peer': _peer_name(connection), 'ok': False, 'files': 0, 'bytes': 0, 'error': None}
+        try:
+            if 'mux' in connection.peer_features:
+                result.update(self._send_mux(connection))
+            else:
+                # Older peers get their own read of the files
+                self.source.leave(connection)
+                from .transfer import FileTransfer
+                result['ok'] = FileTransfer(self.config, connection).send_paths(
+                    self.paths, compression=self.compression)
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            self.source.leave(connection)
+
+        result['seconds'] = time.time() - start_time
+        with self._lock:
+            self.results.append(result)
+        return result['ok']
+
+    def _send_mux(self, connection):
+        """Speak the engine's multiplexed protocol, one stream per file, in source order"""
+        channel = connection.channel
+        compressor = self.source.compressor
+        request = {'type': 'MUX', 'window': TransferEngine.STREAM_WINDOW}
+        if compressor and 'compress' in connection.peer_features:
+            request['compression'] = [compressor.codec]
+        channel.send_control(request)
+
+        ready = channel.receive_control()
+        if ready.get('status') != 'READY':
+            raise Exception(ready.get('message', 'Peer not ready to receive'))
+        compressed = compressor is not None and ready.get('compression') == compressor.codec
+
+        state = {'stream': -1, 'credit': 0, 'sent': 0, 'bytes': 0, 'done': 0, 'failed': []}
+        index = 0
+        while True:
+            item = self.source.get(connection, index)
+            index += 1
+            if item is None:
+                break
+
+            kind = item[0]
+            if kind == 'dir':
+                state['stream'] += 1
+                channel.send_control({'type': 'OPEN', 'stream': state['stream'],
+                                      'path': item[1], 'dir': True})
+            elif kind == 'open':
+                state['stream'] += 1
+                state['credit'] = TransferEngine.STREAM_WINDOW
+                channel.send_control({'type': 'OPEN', 'stream': state['stream'],
+                                      'path': item[1], 'size': item[2]})
+                state['sent'] += 1
+                state['bytes'] += item[2]
+            elif kind == 'data':
+                _, offset, length, chunk = item
+                while state['credit'] < length:
+                    self._handle_reply(channel.receive_control(), state)
+                if compressed and chunk.payload is not None:
+                    channel.send_data(chunk.payload, offset, stream_id=state['stream'],
+                                      flags=FLAG_COMPRESSED)
+                else:
+                    channel.send_data(chunk.data, offset, stream_id=state['stream'])
+                state['credit'] -= length
+            elif kind == 'close':
+                channel.send_control({'type': 'CLOSE', 'stream': state['stream'],
+                                      'checksum': item[1]})
+            elif kind == 'abort':
+                channel.send_control({'type': 'ABORT', 'stream': state['stream'], 'message': item[1]})
+                state['sent'] -= 1
+                state['failed'].append(item[1])
+
+        channel.send_control({'type': 'MUX_END'})
+        while self._handle_reply(channel.receive_control(), state):
+            pass
+
+        failed = state['failed']
+        return {'ok': not failed and state['done'] == state['sent'], 'files': state['done'],
+                'bytes': state['bytes'], 'error': '; '.join(failed) or None}
+
+    def _handle_reply(self, message, state):
+        """Apply one reply from the receiver; False once it ends the session"""
+        kind = message.get('type')
+        if kind == 'CREDIT':
+            if message.get('stream') == state['stream']:
+                state['credit'] += message['bytes']
+        elif kind == 'DONE':
+            if message.get('status') == 'SUCCESS':
+                state['done'] += 1
+            else:
+                state['failed'].append(message.get('message', 'Transfer failed'))
+        elif kind == 'MUX_END':
+            return False
+        else:
+            raise Exception(message.get('message', f"Unexpected message {kind}"))
+        return True
+
+    def report(self):
+        """Log the per-peer outcome"""
+        logger.info(f"\n📡 Fan-out to {len(self.results)} peer(s):")
+        for result in sorted(self.results, key=lambda result: result['peer']):
+            if result['ok']:
+                rate = result['bytes'] / max(result['seconds'], 1e-6) / (1024 * 1024)
+                logger.info(f"  ✅ {result['peer']}: {result['files']} file(s), "
+                            f"{result['bytes']} bytes in {result['seconds']:.1f}s ({rate:.1f} MB/s)")
+            else:
+                logger.error(f"  {result['peer']}: {result['error'] or 'failed'}")
+        if self.source.rereads:
+            logger.info(f"  {self.source.rereads} chunk(s) re-read from disk for peers that fell behind")
+        if self.source.compressor:
+            self.source.compressor.report(lambda size: f"{size} bytes")
+
+
+def _peer_name(connection):
+    info = connection.peer_info or {}
+    return info.get('name') or info.get('address', 'Unknown')
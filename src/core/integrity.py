@@ -0,0 +1,43 @@
+"""
+Integrity helpers for Pig3on
+Incremental file hashing as data streams through a transfer
+"""
+
+import hashlib
+
+
+class StreamHasher:
+    """SHA256 over a file's bytes, fed in offset order while they pass through"""
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, start=0):
+        self._sha256 = hashlib.sha256()
+        self._buffer = None
+        self.position = start
+
+    def update(self, data, offset):
+        """Hash bytes located at offset, which must continue the stream"""
+        if offset != self.position:
+            raise ValueError(f"Hash out of order at {offset}, expected {self.position}")
+        self._sha256.update(data)
+        self.position += len(data)
+
+    def update_from_file(self, f, offset, count):
+        """Hash a range of an open file (normally still in the page cache)"""
+        if self._buffer is None:
+            self._buffer = bytearray(self.BLOCK_SIZE)
+
+        f.seek(offset)
+        end = offset + count
+        while offset < end:
+            view = memoryview(self._buffer)[:min(self.BLOCK_SIZE, end - offset)]
+            read = f.readinto(view)
+            if not read:
+                raise OSError("File changed during transfer")
+            self.update(view[:read], offset)
+            offset += read
+
+    def hexdigest(self):
+        """Digest of everything hashed so far"""
+        return self._sha256.hexdigest()
@@ -0,0 +1,295 @@
+"""
+Transfer Metrics for Pig3on
+Per-transfer records, a rotating JSON-lines history and a Prometheus text export
+"""
+
+import os
+import json
+import time
+import socket
+import struct
+import threading
+import statistics
+from pathlib import Path
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+HISTORY_LIMIT = 4 * 1024 * 1024     # Bytes a history file grows to before it is rotated
+HISTORY_KEEP = 2                    # Rotated history files kept besides the current one
+PHASES = ('hash', 'disk', 'network')
+
+# struct tcp_info up to tcpi_total_retrans (Linux)
+TCP_INFO = struct.Struct('8B24I')
+TCP_INFO_RTT = 23                   # Smoothed RTT in microseconds
+TCP_INFO_RETRANSMITS = 31
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def tcp_info(sock):
+    """The kernel's smoothed RTT (seconds) and retransmit count for sock, or None where unavailable"""
+    if sock is None or not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        raw = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    except OSError:
+        return None
+    if len(raw) < TCP_INFO.size:
+        return None
+    fields = TCP_INFO.unpack_from(raw)
+    return fields[TCP_INFO_RTT] / 1e6, fields[TCP_INFO_RETRANSMITS]
+
+
+def metrics_for(config):
+    """The process-wide Metrics for config's history, shared by every connection using it"""
+    with _registries_lock:
+        metrics = _registries.get(config.history_file)
+        if metrics is None:
+            metrics = _registries[config.history_file] = Metrics(config)
+        return metrics
+
+
+class TransferRecord:
+    """What one transfer did; FileTransfer fills it in as the transfer runs"""
+
+    def __init__(self, direction, name, peer, sock=None):
+        self.direction = direction      # send or receive
+        self.name = name
+        self.peer = peer
+        self.method = None              # windowed, striped, delta, dedup, batch, mux or swarm
+        self.files = 0
+        self.bytes = 0
+        self.ok = False
+        self.phases = {}                # Phase -> seconds, where the path measures them
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self._sock = sock
+        self._rtt = []
+        self._tcp = tcp_info(sock)
+
+    def sample_rtt(self, rtt):
+        """Add a round-trip time measured while the transfer ran"""
+        self._rtt.append(rtt)
+
+    def add_pipeline(self, pipeline, phases):
+        """Fold each pipeline stage's time into a phase, e.g. {'read': 'disk'}"""
+        for stage in pipeline.stages:
+            phase = phases.get(stage.name)
+            if phase:
+                self.phases[phase] = self.phases.get(phase, 0.0) + stage.busy + stage.waited
+
+    def finish(self):
+        """The record as a history entry"""
+        seconds = time.perf_counter() - self._clock
+        retransmits = None
+        end = tcp_info(self._sock)
+        if end:
+            self.sample_rtt(end[0])
+            if self._tcp:
+                retransmits = end[1] - self._tcp[1]
+
+        rtt = None
+        if self._rtt:
+            rtt = {'min': round(min(self._rtt) * 1000, 3),
+                   'median': round(statistics.median(self._rtt) * 1000, 3),
+                   'max': round(max(self._rtt) * 1000, 3),
+                   'samples': len(self._rtt)}
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'direction': self.direction,
+            'peer': self.peer,
+            'name': self.name,
+            'method': self.method,
+            'ok': self.ok,
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': round(seconds, 4),
+            'mb_s': round(self.bytes / seconds / (1024 * 1024), 2) if seconds > 0 else None,
+            'rtt_ms': rtt,
+            'retransmits': retransmits,
+            'phases': {phase: round(value, 4) for phase, value in self.phases.items()},
+        }
+
+
+class Metrics:
+    """
+    Counters for this process, plus the history every finished transfer
+    is appended to. The history rotates at HISTORY_LIMIT bytes and keeps
+    HISTORY_KEEP older files, so it stays bounded however long pig3on runs.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.history_file = Path(config.history_file)
+        self._lock = threading.Lock()
+        self._counters = {}     # (name, labels) -> value
+        self._gauges = {}
+
+    def transfer(self, direction, name, connection):
+        """Start recording a transfer on a connection"""
+        peer = connection.peer_info.get('name', 'Unknown') if connection.peer_info else None
+        return TransferRecord(direction, name, peer, connection.socket)
+
+    def finish(self, record):
+        """Account a finished transfer and append it to the history"""
+        entry = record.finish()
+        direction = (('direction', entry['direction']),)
+        result = direction + (('result', 'success' if entry['ok'] else 'failure'),)
+        with self._lock:
+            self._add('pig3on_transfers_total', result)
+            self._add('pig3on_transfer_bytes_total', direction, entry['bytes'])
+            self._add('pig3on_transfer_files_total', direction, entry['files'])
+            self._add('pig3on_transfer_seconds_total', direction, entry['seconds'])
+            for phase, seconds in entry['phases'].items():
+                self._add('pig3on_transfer_phase_seconds_total',
+                          direction + (('phase', phase),), seconds)
+            if entry['retransmits']:
+                self._add('pig3on_tcp_retransmits_total', direction, entry['retransmits'])
+            if entry['rtt_ms']:
+                self._gauges[('pig3on_rtt_seconds', ())] = entry['rtt_ms']['median'] / 1000
+            if entry['ok'] and entry['mb_s'] is not None:
+                self._gauges[('pig3on_last_transfer_bytes_per_second', direction)] = \
+                    entry['mb_s'] * 1024 * 1024
+
+        try:
+            self._append(entry)
+            if self.config.metrics_file:
+                self.write_prometheus(self.config.metrics_file)
+        except OSError as e:
+            logger.debug(f"Could not record transfer metrics: {e}")
+        return entry
+
+    def count(self, name, value=1, **labels):
+        """Add to a counter, e.g. count('pig3on_connections_total', result='accepted')"""
+        with self._lock:
+            self._add(name, tuple(sorted(labels.items())), value)
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def _add(self, name, labels, value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def prometheus(self):
+        """Counters and gauges in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self._counters), ('gauge', self._gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        lines.append(f"# TYPE {name} {kind}")
+                        typed.add(name)
+                    label_text = ','.join(f'{key}="{_escape(label)}"' for key, label in labels)
+                    text = str(int(value)) if float(value).is_integer() else repr(float(value))
+                    lines.append(f"{name}{{{label_text}}} {text}" if label_text else f"{name} {text}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """Replace path with the current metrics, e.g. for node_exporter's textfile collector"""
+        path = Path(path).expanduser()
+        temp = path.with_name(path.name + '.tmp')
+        temp.write_text(self.prometheus())
+        os.replace(temp, path)
+
+    def serve(self, port):
+        """Serve the metrics at http://<host>:port/metrics on a background thread"""
+        # Only the receiver and daemon serve; every other command would pay for the import
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"📈 Metrics at http://localhost:{port}/metrics")
+        return server
+
+    def _append(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self.history_file.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                if self.history_file.stat().st_size + len(line) > HISTORY_LIMIT:
+                    self._rotate()
+            except FileNotFoundError:
+                pass
+            with open(self.history_file, 'a') as f:
+                f.write(line)
+
+    def _rotate(self):
+        for index in range(HISTORY_KEEP, 0, -1):
+            older = self.history_file.with_name(f"{self.history_file.name}.{index}")
+            newer = (self.history_file if index == 1
+                     else self.history_file.with_name(f"{self.history_file.name}.{index - 1}"))
+            if newer.exists():
+                os.replace(newer, older)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def read_history(history_file):
+    """Every entry in the history, oldest first, skipping lines that don't parse"""
+    history_file = Path(history_file)
+    files = [history_file.with_name(f"{history_file.name}.{index}")
+             for index in range(HISTORY_KEEP, 0, -1)] + [history_file]
+    entries = []
+    for path in files:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
+    return entries
+
+
+def summarize(entries):
+    """Aggregate history entries per direction for `pig3on status`"""
+    summary = {}
+    for direction in ('send', 'receive'):
+        chosen = [entry for entry in entries if entry.get('direction') == direction]
+        if not chosen:
+            continue
+        done = [entry for entry in chosen if entry.get('ok')]
+        rates = [entry['mb_s'] for entry in done if entry.get('mb_s')]
+        rtts = [entry['rtt_ms']['median'] for entry in chosen if entry.get('rtt_ms')]
+        phases = {phase: sum(entry.get('phases', {}).get(phase, 0) for entry in chosen)
+                  for phase in PHASES}
+        summary[direction] = {
+            'transfers': len(chosen),
+            'failed': len(chosen) - len(done),
+            'files': sum(entry.get('files', 0) for entry in done),
+            'bytes': sum(entry.get('bytes', 0) for entry in done),
+            'seconds': sum(entry.get('seconds', 0) for entry in done),
+            'median_mb_s': statistics.median(rates) if rates else None,
+            'best_mb_s': max(rates) if rates else None,
+            'median_rtt_ms': statistics.median(rtts) if rtts else None,
+            'retransmits': sum(entry.get('retransmits') or 0 for entry in chosen),
+            'phases': phases if any(phases.values()) else None,
+            'since': chosen[0].get('time'),
+        }
+    return summary
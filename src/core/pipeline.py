@@ -0,0 +1,265 @@
+"""
+Staged I/O Pipeline for Pig3on
+Threads joined by bounded queues so disk, CPU and network work overlap
+"""
+
+import os
+import time
+import queue
+import select
+import threading
+import contextlib
+from collections import deque
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+QUEUE_DEPTH = 4                     # Items a stage may get ahead of the next one
+READ_AHEAD = 8 * 1024 * 1024        # Bytes the kernel is asked to fetch beyond the reader
+POLL_INTERVAL = 0.1                 # Seconds between checks for an aborted pipeline
+REPORT_AFTER = 1.0                  # Shorter runs only report at debug level
+
+_END = object()
+
+
+class Stopped(Exception):
+    """The pipeline was aborted while a stage was waiting"""
+
+
+def advise(fd, offset, length, advice):
+    """Pass an access pattern hint to the kernel where posix_fadvise exists"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+class BufferPool:
+    """
+    Packet buffers handed back after use. Streaming then keeps touching the
+    same memory, where a fresh allocation per packet would map and fault in
+    new pages every time. The queues bound how many are out at once.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._free = deque()
+
+    def take(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def give(self, buffer):
+        self._free.append(buffer)
+
+
+class FileReader:
+    """
+    Reads ranges of a file in ascending order on its own handle. The file
+    is marked sequential and the kernel is asked to fetch READ_AHEAD bytes
+    beyond the current range, so reads rarely wait for the disk.
+    """
+
+    def __init__(self, path):
+        self._f = open(path, 'rb', buffering=0)
+        self._hinted = 0
+        advise(self._f.fileno(), 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+
+    def read_into(self, buffer, offset, length):
+        """Fill the first length bytes of buffer from offset; returns a view of them"""
+        if offset + length > self._hinted - READ_AHEAD // 2:
+            start = max(offset, self._hinted)
+            self._hinted = offset + length + READ_AHEAD
+            advise(self._f.fileno(), start, self._hinted - start,
+                   getattr(os, 'POSIX_FADV_WILLNEED', 0))
+
+        view = memoryview(buffer)[:length]
+        done = 0
+        while done < length:
+            if hasattr(os, 'preadv'):
+                count = os.preadv(self._f.fileno(), [view[done:]], offset + done)
+            else:
+                self._f.seek(offset + done)
+                count = self._f.readinto(view[done:])
+            if not count:
+                raise OSError("File changed during transfer")
+            done += count
+        return view
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Stage:
+    """
+    One thread running work(items), a generator that consumes the previous
+    stage's output and yields its own. Time spent waiting for input, for
+    room in the next queue, or inside waiting() is kept apart from the time
+    the stage is busy, which shows where a pipeline is saturated.
+    """
+
+    def __init__(self, name, work, waits_on=None):
+        self.name = name
+        self.work = work
+        self.waits_on = waits_on    # What waiting() time is spent on, e.g. the peer
+        self.inbox = None
+        self.outbox = None
+        self.items = 0
+        self.elapsed = 0.0
+        self.starved = 0.0          # Waiting for the previous stage
+        self.blocked = 0.0          # Waiting for the next stage
+        self.waited = 0.0           # Waiting inside waiting()
+        self._pipeline = None
+        self._thread = None
+
+    @property
+    def busy(self):
+        return max(0.0, self.elapsed - self.starved - self.blocked - self.waited)
+
+    @contextlib.contextmanager
+    def waiting(self):
+        """Count the enclosed time as waiting on something outside the pipeline"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.waited += time.perf_counter() - started
+
+    def _inputs(self, source):
+        if self.inbox is None:
+            for item in source:
+                self._pipeline._check_stop()
+                yield item
+            return
+        while True:
+            started = time.perf_counter()
+            item = self._pipeline._get(self.inbox)
+            self.starved += time.perf_counter() - started
+            if item is _END:
+                return
+            yield item
+
+    def _run(self, source):
+        started = time.perf_counter()
+        try:
+            for output in self.work(self._inputs(source)):
+                self.items += 1
+                if self.outbox is not None:
+                    put_started = time.perf_counter()
+                    self._pipeline._put(self.outbox, output)
+                    self.blocked += time.perf_counter() - put_started
+            if self.outbox is not None:
+                self._pipeline._put(self.outbox, _END)
+        except Stopped:
+            pass
+        except Exception as e:
+            self._pipeline._fail(e)
+        finally:
+            self.elapsed = time.perf_counter() - started
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each on its own thread. The first
+    stage consumes source; a slow stage fills the queue in front of it and
+    holds back the stages before it rather than letting memory grow.
+    """
+
+    def __init__(self, *stages, source=(), depth=QUEUE_DEPTH):
+        self.stages = stages
+        self.source = source
+        self.error = None
+        self._stop = threading.Event()
+        for stage, following in zip(stages, stages[1:]):
+            following.inbox = stage.outbox = queue.Queue(depth)
+        for stage in stages:
+            stage._pipeline = self
+
+    def start(self):
+        for stage in self.stages:
+            stage._thread = threading.Thread(target=stage._run, args=(self.source,),
+                                             name=f"pipeline-{stage.name}", daemon=True)
+            stage._thread.start()
+
+    def join(self):
+        """Wait for every stage to finish its input; raises the first stage's error"""
+        for stage in self.stages:
+            while stage._thread.is_alive():
+                stage._thread.join(POLL_INTERVAL)
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """Stop every stage, dropping queued items, and wait for their threads"""
+        self._stop.set()
+        for stage in self.stages:
+            if stage._thread is not None:
+                stage._thread.join()
+
+    def check(self):
+        """Raise the error a stage failed with, or Stopped once the pipeline is aborted"""
+        if self.error is not None:
+            raise self.error
+        self._check_stop()
+
+    def wait_readable(self, sock):
+        """Block until sock has data, giving up if the pipeline is aborted"""
+        while not select.select([sock], [], [], POLL_INTERVAL)[0]:
+            self.check()
+
+    def report(self):
+        """Log how busy each stage was and which one limited throughput"""
+        elapsed = max((stage.elapsed for stage in self.stages), default=0)
+        if not elapsed:
+            return
+
+        loads = []
+        parts = []
+        for stage in self.stages:
+            share = stage.busy / elapsed
+            loads.append((share, stage.name))
+            part = f"{stage.name} {share:.0%}"
+            if stage.waits_on:
+                waited = stage.waited / elapsed
+                loads.append((waited, stage.waits_on))
+                part += f" (waiting on {stage.waits_on} {waited:.0%})"
+            parts.append(part)
+
+        bottleneck = max(loads)[1]
+        log = logger.info if elapsed >= REPORT_AFTER else logger.debug
+        log(f"⚙️  Pipeline busy: {', '.join(parts)} — limited by {bottleneck}")
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self._stop.set()
+
+    def _check_stop(self):
+        if self._stop.is_set():
+            raise Stopped()
+
+    def _get(self, inbox):
+        while True:
+            self._check_stop()
+            try:
+                return inbox.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _put(self, outbox, item):
+        while True:
+            self._check_stop()
+            try:
+                outbox.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
@@ -0,0 +1,292 @@
+"""
+Wire Protocol for Pig3on
+Binary data framing with JSON control messages
+"""
+
+import json
+import select
+import struct
+from collections import namedtuple
+from utils.crypto import AEAD_AVAILABLE, SEAL_OVERHEAD
+
+LEGACY_VERSION = 1      # Length-prefixed JSON, hex-encoded packet data
+PROTOCOL_VERSION = 2    # Binary frames, raw payload bytes
+SUPPORTED_VERSIONS = (LEGACY_VERSION, PROTOCOL_VERSION)
+
+MAGIC = b'P3'
+
+# Optional capabilities exchanged in HELLO; both peers must list one to use it.
+# 'aead' (encrypted frames) needs the optional cryptography package.
+FEATURES = ('stripes', 'batch', 'delta', 'dedup', 'compress', 'tune', 'mux', 'swarm') + \
+    (('aead',) if AEAD_AVAILABLE else ())
+
+# Frame types
+FRAME_CONTROL = 0x01    # Payload is a UTF-8 JSON object
+FRAME_DATA = 0x02       # Payload is raw file bytes at `offset`
+
+# Data frame flags
+FLAG_COMPRESSED = 0x0001    # Payload is compressed with the codec negotiated for the transfer
+FLAG_SEALED = 0x0002        # Payload is nonce + AES-GCM ciphertext + tag under the session key
+
+# magic, version, type, flags, stream id, offset, payload length
+HEADER = struct.Struct('!2sBBHIQI')
+
+# Header fields a sealed payload is bound to, so frames can't be moved or relabelled
+ASSOCIATED = struct.Struct('!BHIQ')
+
+MAX_CONTROL_SIZE = 16 * 1024 * 1024
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024  # Bounds the receive buffer
+
+Frame = namedtuple('Frame', ['type', 'flags', 'stream_id', 'offset', 'payload'])
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed or unsupported frame"""
+
+
+def receive_into(sock, view):
+    """Fill a writable buffer completely from the socket"""
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed")
+        received += count
+
+
+def receive_exact(sock, num_bytes):
+    """Receive exact number of bytes"""
+    data = bytearray(num_bytes)
+    receive_into(sock, memoryview(data))
+    return data
+
+
+def encode_header(frame_type, length, stream_id=0, offset=0, flags=0):
+    """Build a frame header"""
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, frame_type, flags, stream_id, offset, length)
+
+
+def encode_frame(frame_type, payload, stream_id=0, offset=0, flags=0):
+    """Build a frame header followed by its payload"""
+    return encode_header(frame_type, len(payload), stream_id, offset, flags) + payload
+
+
+def decode_header(header):
+    """Unpack and validate a frame header"""
+    magic, version, frame_type, flags, stream_id, offset, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported frame version {version}")
+    return frame_type, flags, stream_id, offset, length
+
+
+def negotiate_features(offered, supported=FEATURES):
+    """Capabilities supported by both peers"""
+    return set(offered or []) & set(supported)
+
+
+def negotiate_version(offered):
+    """Pick the highest protocol version both sides support"""
+    common = set(offered or [LEGACY_VERSION]) & set(SUPPORTED_VERSIONS)
+    return max(common) if common else LEGACY_VERSION
+
+
+def send_hello(sock, message):
+    """Send a handshake message as a control frame"""
+    sock.sendall(encode_frame(FRAME_CONTROL, json.dumps(message).encode()))
+
+
+def receive_hello(sock, timeout=None):
+    """
+    Receive a handshake control frame.
+    Returns None if nothing arrives within timeout (legacy peers stay silent).
+    """
+    if timeout is not None:
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if not readable:
+            return None
+
+    frame_type, _, _, _, length = decode_header(receive_exact(sock, HEADER.size))
+    if frame_type != FRAME_CONTROL or length > MAX_CONTROL_SIZE:
+        raise ProtocolError("Expected handshake control frame")
+
+    message = json.loads(receive_exact(sock, length))
+    if message.get('type') != 'HELLO':
+        raise ProtocolError("Expected HELLO")
+    return message
+
+
+class Channel:
+    """
+    Binary framed message channel over a connected socket.
+    Data payloads are received into one reusable buffer, so a returned
+    data frame is only valid until the next call to receive().
+    """
+
+    version = PROTOCOL_VERSION
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.sealer = None  # Lane of the session's outgoing cipher once encryption is agreed
+        self.opener = None  # The session's incoming cipher
+        self.throttle = None  # callable(count) that blocks until count more bytes may be sent
+        self._header = bytearray(HEADER.size)
+        self._buffer = bytearray(0)
+
+    def secure(self, sealer, opener):
+        """Seal every frame sent from here on and accept only sealed frames"""
+        self.sealer = sealer
+        self.opener = opener
+
+    def frame(self, frame_type, payload, stream_id=0, offset=0, flags=0):
+        """
+        Build a complete frame, sealing its payload on an encrypted channel.
+        Nonces travel in the frame, so worker threads may build frames ahead
+        of the sender in any order.
+        """
+        if self.sealer is None:
+            return encode_frame(frame_type, payload, stream_id, offset, flags)
+        flags |= FLAG_SEALED
+        payload = self.sealer.seal(payload, ASSOCIATED.pack(frame_type, flags, stream_id, offset))
+        return encode_frame(frame_type, payload, stream_id, offset, flags)
+
+    def open(self, frame_type, flags, stream_id, offset, payload):
+        """Authenticate and decrypt a received payload; returns (flags, payload) as sent"""
+        if self.opener is None:
+            return flags, payload
+        if not flags & FLAG_SEALED:
+            raise ProtocolError("Unencrypted frame on an encrypted session")
+        try:
+            payload = self.opener.open(payload, ASSOCIATED.pack(frame_type, flags, stream_id, offset))
+        except ValueError as e:
+            raise ProtocolError(str(e))
+        return flags & ~FLAG_SEALED, payload
+
+    def send_frame(self, frame):
+        """Send a frame built by frame()"""
+        if self.throttle:
+            self.throttle(len(frame))
+        self.socket.sendall(frame)
+
+    def send_control(self, message):
+        """Send a JSON control message"""
+        self.socket.sendall(self.frame(FRAME_CONTROL, json.dumps(message).encode()))
+
+    def send_data(self, data, offset, stream_id=0, flags=0):
+        """Send a chunk of file data located at offset"""
+        if self.throttle:
+            self.throttle(len(data))
+        if self.sealer is not None:
+            self.socket.sendall(self.frame(FRAME_DATA, data, stream_id, offset, flags))
+            return
+        self.socket.sendall(encode_header(FRAME_DATA, len(data), stream_id, offset, flags))
+        self.socket.sendall(data)
+
+    def send_file_range(self, f, offset, count, stream_id=0):
+        """Send count bytes of an open file as one data frame without copying through userspace"""
+        if self.sealer is not None:
+            # Encryption needs the bytes in userspace
+            f.seek(offset)
+            data = f.read(count)
+            if len(data) != count:
+                raise OSError("File changed during transfer")
+            self.send_data(data, offset, stream_id)
+            return
+        if self.throttle:
+            self.throttle(count)
+        self.socket.sendall(encode_header(FRAME_DATA, count, stream_id, offset))
+        if self.socket.sendfile(f, offset, count) != count:
+            raise OSError("File changed during transfer")
+
+    def receive(self, buffer=None):
+        """
+        Receive the next frame, decoding control payloads to dicts. A data
+        payload is read into buffer when given, so it outlives later receives.
+        """
+        receive_into(self.socket, memoryview(self._header))
+        frame_type, flags, stream_id, offset, length = decode_header(self._header)
+        overhead = SEAL_OVERHEAD if self.opener is not None else 0
+
+        if frame_type == FRAME_CONTROL:
+            if length > MAX_CONTROL_SIZE + overhead:
+                raise ProtocolError("Control message too large")
+            flags, payload = self.open(frame_type, flags, stream_id, offset,
+                                       self._read_payload(length))
+            payload = json.loads(bytes(payload))
+        elif frame_type == FRAME_DATA:
+            if length > MAX_PAYLOAD_SIZE + overhead:
+                raise ProtocolError("Data frame too large")
+            flags, payload = self.open(frame_type, flags, stream_id, offset,
+                                       self._read_payload(length, buffer))
+        else:
+            raise ProtocolError(f"Unknown frame type {frame_type}")
+
+        return Frame(frame_type, flags, stream_id, offset, payload)
+
+    def receive_control(self):
+        """Receive the next frame, which must be a control message"""
+        frame = self.receive()
+        if frame.type != FRAME_CONTROL:
+            raise ProtocolError("Expected control message")
+        return frame.payload
+
+    def _read_payload(self, length, buffer=None):
+        """Read a payload into the reusable buffer, or the caller's, and return a view of it"""
+        if buffer is None:
+            if len(self._buffer) < length:
+                # Earlier views may still be alive, so replace rather than resize
+                self._buffer = bytearray(length)
+            buffer = self._buffer
+        elif len(buffer) < length:
+            buffer = bytearray(length)
+        view = memoryview(buffer)[:length]
+        receive_into(self.socket, view)
+        return view
+
+
+class LegacyChannel(Channel):
+    """Version 1 channel: length-prefixed JSON with hex-encoded packet data"""
+
+    version = LEGACY_VERSION
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self._packet_num = 0
+
+    def send_control(self, message):
+        """Send JSON data"""
+        data = json.dumps(message).encode()
+        self.socket.sendall(len(data).to_bytes(4, 'big') + data)
+
+    def send_data(self, data, offset, stream_id=0, flags=0):
+        """Send packet as hex inside a JSON object"""
+        if self.throttle:
+            self.throttle(len(data))
+        self.send_control({'packet_num': self._packet_num, 'data': bytes(data).hex()})
+        self._packet_num += 1
+
+    def send_file_range(self, f, offset, count, stream_id=0):
+        """Read a range of an open file and send it as a hex packet"""
+        f.seek(offset)
+        data = f.read(count)
+        if len(data) != count:
+            raise OSError("File changed during transfer")
+        self.send_data(data, offset, stream_id)
+
+    def receive(self, buffer=None):
+        """Receive JSON data, unwrapping hex packets into data frames"""
+        length = int.from_bytes(receive_exact(self.socket, 4), 'big')
+        message = json.loads(receive_exact(self.socket, length))
+
+        if 'data' in message:
+            # Legacy packets carry no offset; receivers append in order
+            return Frame(FRAME_DATA, 0, 0, None, bytes.fromhex(message['data']))
+        return Frame(FRAME_CONTROL, 0, 0, 0, message)
+
+
+def create_channel(sock, version):
+    """Create the channel implementation for a negotiated version"""
+    if version >= PROTOCOL_VERSION:
+        return Channel(sock)
+    return LegacyChannel(sock)
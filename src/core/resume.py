@@ -0,0 +1,115 @@
+"""
+Partial Download Manager for Pig3on
+Keeps interrupted downloads as .part files so transfers can resume
+"""
+
+import os
+import json
+import time
+from pathlib import Path
+from utils.logger import get_logger
+from .storage import sync_directory
+
+logger = get_logger(__name__)
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or touching [start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class PartialDownload:
+    """A .part file plus a sidecar manifest of byte ranges already written to it"""
+
+    SUFFIX = '.part'
+    MANIFEST_SUFFIX = '.part.json'
+    STALE_AGE = 7 * 24 * 3600  # Drop partials untouched for a week
+
+    def __init__(self, download_dir, filename):
+        self.download_dir = Path(download_dir)
+        self.part_path = self.download_dir / (filename + self.SUFFIX)
+        self.manifest_path = self.download_dir / (filename + self.MANIFEST_SUFFIX)
+
+    def load(self, identity):
+        """
+        Return byte ranges already held for this source file.
+        A partial left by a different version of the file is discarded.
+        """
+        if not self.part_path.exists() or not self.manifest_path.exists():
+            return []
+
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Unreadable manifest {self.manifest_path}: {e}")
+            self.discard()
+            return []
+
+        if manifest.get('identity') != identity:
+            logger.info("Source file changed since the interrupted transfer, starting over")
+            self.discard()
+            return []
+
+        size = self.part_path.stat().st_size
+        return [[start, min(end, size)] for start, end in manifest.get('ranges', []) if start < size]
+
+    def save(self, identity, ranges):
+        """Atomically record which byte ranges of the .part file are written"""
+        manifest = {
+            'identity': identity,
+            'ranges': merge_ranges(ranges),
+            'updated': time.time()
+        }
+        temp_path = self.manifest_path.with_name(self.manifest_path.name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def complete(self, output_path, durability='none'):
+        """Publish the finished .part file under its final name, in one atomic rename"""
+        if durability != 'none':
+            # The data must be on disk before the name points at it
+            with open(self.part_path, 'rb') as f:
+                os.fsync(f.fileno())
+        os.replace(self.part_path, output_path)
+        self._remove(self.manifest_path)
+        if durability != 'none':
+            sync_directory(self.download_dir)
+
+    def discard(self):
+        """Delete the partial data and its manifest"""
+        self._remove(self.part_path)
+        self._remove(self.manifest_path)
+
+    def _remove(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def cleanup_stale(cls, download_dir, max_age=None):
+        """Remove partial downloads that are too old or have no manifest"""
+        max_age = cls.STALE_AGE if max_age is None else max_age
+        download_dir = Path(download_dir)
+        if not download_dir.exists():
+            return
+
+        now = time.time()
+        for part_path in download_dir.glob('*' + cls.SUFFIX):
+            partial = cls(download_dir, part_path.name[:-len(cls.SUFFIX)])
+            try:
+                age = now - partial.manifest_path.stat().st_mtime
+            except FileNotFoundError:
+                age = None
+
+            if age is None or age > max_age:
+                logger.debug(f"Removing stale partial download {part_path.name}")
+                partial.discard()
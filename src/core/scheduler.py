@@ -0,0 +1,322 @@
+"""
+Transfer Scheduler for Pig3on
+Token-bucket bandwidth shaping, priority classes and a queue of sends that survives restarts
+"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+PRIORITIES = ('urgent', 'normal', 'bulk')   # Most urgent first
+BURST_SECONDS = 0.5                 # A bucket holds this much of its rate
+MIN_BURST = 64 * 1024
+ACTIVE_WINDOW = 0.5                 # Seconds a class counts as sending after its last take
+POLL_INTERVAL = 1.0                 # Seconds between dispatch passes when nothing wakes the scheduler
+
+
+def peers_of(entry):
+    """Names of the peers a queued job sends to; fan-outs list several devices"""
+    return [device['name'] for device in entry.get('devices') or [entry['device']]]
+
+
+class TokenBucket:
+    """
+    Paces bytes to rate per second. take() may run the bucket into debt for
+    a large write and later callers wait it off, so frames of any size pass
+    unsplit. While a more urgent class is sending, less urgent callers only
+    get tokens it leaves over: they wait until the bucket is half full
+    rather than merely out of debt.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate        # Bytes per second
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._waiting = [0] * len(PRIORITIES)
+        self._last_take = [0.0] * len(PRIORITIES)
+        self._cond = threading.Condition()
+
+    def take(self, count, priority='normal'):
+        """Block until count bytes may be sent"""
+        rank = PRIORITIES.index(priority)
+        with self._cond:
+            self._waiting[rank] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    threshold = self.burst / 2 if self._outranked(rank, now) else 0
+                    if self._tokens >= threshold:
+                        self._tokens -= count
+                        self._last_take[rank] = now
+                        return
+                    # Look again once the more urgent class may have gone quiet
+                    self._cond.wait(min(ACTIVE_WINDOW, (threshold - self._tokens) / self.rate))
+            finally:
+                self._waiting[rank] -= 1
+                self._cond.notify_all()
+
+    def _outranked(self, rank, now):
+        return any(self._waiting[more] or now - self._last_take[more] < ACTIVE_WINDOW
+                   for more in range(rank))
+
+
+class Shaper:
+    """
+    The process's token buckets: one across all sends and one per peer, from
+    the config unless rate_limit overrides the global one.
+    """
+
+    def __init__(self, config, rate_limit=None):
+        self.config = config
+        rate_limit = config.rate_limit if rate_limit is None else rate_limit
+        self.total = TokenBucket(rate_limit) if rate_limit > 0 else None
+        self._peers = {}        # Peer name -> bucket, or None when unlimited
+        self._lock = threading.Lock()
+
+    def peer_rate(self, peer):
+        """Bytes per second allowed to one peer; 0 for no limit"""
+        return self.config.peer_rate_limits.get(peer, self.config.peer_rate_limit)
+
+    @staticmethod
+    def limit(rate):
+        """The bucket of one send's own limit, shared by every peer it goes to; None for no limit"""
+        return TokenBucket(rate) if rate > 0 else None
+
+    def throttle(self, peer, priority='normal', limit=None):
+        """
+        A callable(count) that blocks until count bytes may go to peer, taking
+        from limit (the send's bucket, from Shaper.limit) when set, then the
+        peer's and the global one; None if nothing limits the transfer.
+        """
+        with self._lock:
+            if peer not in self._peers:
+                rate = self.peer_rate(peer)
+                self._peers[peer] = TokenBucket(rate) if rate > 0 else None
+            buckets = [bucket for bucket in (limit, self._peers[peer], self.total) if bucket]
+        if not buckets:
+            return None
+
+        def take(count):
+            for bucket in buckets:
+                bucket.take(count, priority)
+        return take
+
+
+class TransferQueue:
+    """
+    Sends waiting for the daemon, saved to a JSON file on every change so
+    they outlive a restart. Jobs that were running when the daemon stopped
+    are pending again on the next load.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.jobs = []
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._load()
+
+    def next_id(self):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            return job_id
+
+    def add(self, paths, device, streams=1, compression=None, priority='normal', limit=0,
+            fan_out=None):
+        """
+        Queue a send to device, or with fan_out ('copy' or 'swarm') to a
+        list of devices from one read; returns its entry
+        """
+        entry = {
+            'id': self.next_id(),
+            'paths': list(paths),
+            'streams': streams,
+            'compression': compression,
+            'priority': priority,
+            'limit': limit,
+            'queued': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'state': 'pending',
+        }
+        if fan_out:
+            entry['devices'] = list(device)
+            entry['fan_out'] = fan_out
+        else:
+            entry['device'] = device
+        with self._lock:
+            self.jobs.append(entry)
+            self._save()
+        return entry
+
+    def pending(self):
+        """Pending jobs, most urgent first and oldest first within a class"""
+        with self._lock:
+            waiting = [entry for entry in self.jobs if entry['state'] == 'pending']
+        return sorted(waiting, key=lambda entry: (PRIORITIES.index(entry['priority']), entry['id']))
+
+    def mark(self, job_id, state):
+        with self._lock:
+            for entry in self.jobs:
+                if entry['id'] == job_id:
+                    entry['state'] = state
+            self._save()
+
+    def remove(self, job_id=None, peer=None):
+        """
+        Drop a job, or every job for a peer; fan-outs to other peers as well
+        only lose the peer, and only while pending. Returns the entries dropped.
+        """
+        with self._lock:
+            dropped = []
+            changed = False
+            for entry in self.jobs:
+                peers = peers_of(entry)
+                if entry['id'] == job_id or peers == [peer]:
+                    dropped.append(entry)
+                elif peer in peers and entry['state'] == 'pending':
+                    entry['devices'] = [device for device in entry['devices'] if device['name'] != peer]
+                    changed = True
+            if dropped:
+                self.jobs = [entry for entry in self.jobs if entry not in dropped]
+            if dropped or changed:
+                self._save()
+        return dropped
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable transfer queue {self.path}: {e}")
+            return
+        self.jobs = data.get('jobs', [])
+        for entry in self.jobs:
+            entry['state'] = 'pending'
+        self._next_id = max([data.get('next_id', 1)] + [entry['id'] + 1 for entry in self.jobs])
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp = self.path.with_name(self.path.name + '.tmp')
+        with open(temp, 'w') as f:
+            json.dump({'next_id': self._next_id, 'jobs': self.jobs}, f, indent=2)
+        os.replace(temp, self.path)
+
+
+class Scheduler:
+    """
+    Hands queued jobs to the daemon's sessions: most urgent first and at
+    most max_active_transfers at once, holding a peer's jobs back while its
+    session couldn't start them. Only jobs at least as urgent count against
+    the limit, so an urgent job starts beside running bulk ones (on the same
+    multiplexing session, if need be) and the shaper's buckets then give it
+    bandwidth first.
+    """
+
+    def __init__(self, config, rate_limit=None):
+        self.config = config
+        self.queue = TransferQueue(config.queue_file)
+        self.shaper = Shaper(config, rate_limit)
+        self._running = {}      # Job id -> entry
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._dispatch = None
+        self._busy = None
+
+    def start(self, dispatch, busy):
+        """
+        Dispatch from a background thread: dispatch(entry) starts a job and
+        busy(peer, running) tells whether a new job for the peer would have to
+        wait, running being whether one of ours is already under way there.
+        """
+        self._dispatch = dispatch
+        self._busy = busy
+        pending = self.queue.pending()
+        if pending:
+            logger.info(f"📋 Resuming {len(pending)} queued transfer(s)")
+        threading.Thread(target=self._run, name='scheduler', daemon=True).start()
+
+    def stop(self):
+        """Stop dispatching; jobs still queued or running stay in the queue for the next start"""
+        self._stopped.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def add(self, paths, device, streams=1, compression=None, priority='normal', limit=0,
+            fan_out=None):
+        """Queue a send (see TransferQueue.add); it is dispatched on the next pass"""
+        return self.queue.add(paths, device, streams, compression, priority, limit, fan_out)
+
+    def finished(self, job_id):
+        """Take a dispatched job out of the queue once it has succeeded or failed"""
+        if self._stopped.is_set():
+            return      # Interrupted by shutdown; send it again after the restart
+        with self._lock:
+            self._running.pop(job_id, None)
+        self.queue.remove(job_id)
+        self._wake.set()
+
+    def drop(self, peer):
+        """Forget the jobs still pending for a peer"""
+        with self._lock:
+            running = set(self._running)
+        return [entry for entry in self.queue.remove(peer=peer) if entry['id'] not in running]
+
+    def describe(self):
+        """Pending and running jobs for `pig3on status`"""
+        with self._lock:
+            running = set(self._running)
+        lines = []
+        for entry in sorted(list(self.queue.jobs), key=lambda entry: entry['id']):
+            names = ', '.join(os.path.basename(path.rstrip('/')) for path in entry['paths'][:3])
+            state = 'sending' if entry['id'] in running else 'pending'
+            limit = f", {entry['limit'] / (1024 * 1024):.1f} MB/s" if entry['limit'] else ""
+            swarm = ", swarm" if entry.get('fan_out') == 'swarm' else ""
+            lines.append(f"#{entry['id']} {names} → {', '.join(peers_of(entry))} "
+                         f"({entry['priority']}{limit}{swarm}, {state})")
+        return lines
+
+    def _ahead_of(self, entry):
+        """Running jobs at least as urgent as entry"""
+        rank = PRIORITIES.index(entry['priority'])
+        return sum(PRIORITIES.index(running['priority']) <= rank
+                   for running in self._running.values())
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            if not self._stopped.is_set():
+                self._dispatch_ready()
+
+    def _dispatch_ready(self):
+        ready = []
+        with self._lock:
+            for entry in self.queue.pending():
+                if self._ahead_of(entry) >= self.config.max_active_transfers:
+                    continue
+                sending = {peer for running in self._running.values() for peer in peers_of(running)}
+                if any(self._busy(peer, peer in sending) for peer in peers_of(entry)):
+                    continue
+                self._running[entry['id']] = entry
+                ready.append(entry)
+
+        for entry in ready:
+            self.queue.mark(entry['id'], 'active')
+            try:
+                self._dispatch(entry)
+            except Exception as e:
+                logger.error(f"Could not start queued transfer #{entry['id']}: {e}")
+                self.finished(entry['id'])
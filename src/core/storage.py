@@ -0,0 +1,204 @@
+"""
+Receiver Storage for Pig3on
+Space reservation, write-behind and durability for files being received
+"""
+
+import os
+import time
+import errno
+import queue
+import shutil
+import threading
+from collections import deque
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# none: never fsync; end: fsync before publishing; periodic: also fsync while writing
+DURABILITY_LEVELS = ('none', 'end', 'periodic')
+
+NO_SPACE = (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC))
+
+
+def _megabytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+def check_space(directory, needed):
+    """Fail before the transfer starts if the filesystem can't hold needed more bytes"""
+    try:
+        free = shutil.disk_usage(directory).free
+    except OSError:
+        return  # Can't tell; preallocation or the writes will find out
+    if needed > free:
+        raise Exception(f"Not enough disk space: {_megabytes(needed)} needed, "
+                        f"{_megabytes(free)} free in {directory}")
+
+
+def preallocate(f, size):
+    """Reserve space for the whole file so it can be written at any offset without fragmenting"""
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno in NO_SPACE:
+                raise Exception(f"Not enough disk space for {_megabytes(size)}")
+            # Filesystem without fallocate support
+    f.truncate(size)
+
+
+def write_at(f, data, offset):
+    """Write data at an absolute offset"""
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(f.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        f.seek(offset)
+        f.write(data)
+
+
+def sync_directory(path):
+    """Make a rename inside the directory durable (a no-op where directories can't be opened)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class WriteBehind:
+    """
+    Collects writes into large blocks and writes them out on a background
+    thread, so the caller never waits for the disk unless MAX_PENDING
+    blocks are already queued. Small writes at consecutive offsets are
+    copied into a shared block; writes of DIRECT_SIZE or more are already
+    large enough and are queued as they are. With 'periodic' durability the
+    writer also fsyncs every SYNC_INTERVAL seconds, which keeps dirty pages
+    from piling up and bounds what a crash can lose.
+    """
+
+    BLOCK_SIZE = 4 * 1024 * 1024
+    DIRECT_SIZE = 256 * 1024    # Writes this large skip the copy into a block
+    MAX_PENDING = 4             # Blocks queued for the disk before write() blocks
+    SYNC_INTERVAL = 1.0     # Seconds between fsyncs with periodic durability
+
+    def __init__(self, f, durability='end'):
+        self.f = f
+        self.durability = durability
+        self._free = deque()
+        self._pending = queue.Queue(self.MAX_PENDING)
+        self._block = None
+        self._fill = 0
+        self._start = 0         # File offset of the current block
+        self._error = None
+        self._last_sync = time.monotonic()
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_out, daemon=True)
+        self._thread.start()
+
+    def write(self, data, offset, release=None):
+        """
+        Queue data to be written at offset. A large write keeps data until
+        it is on its way to the disk and then calls release(); otherwise
+        data is copied and release() is called straight away.
+        """
+        self._check()
+        if len(data) >= self.DIRECT_SIZE:
+            if self._block is not None:
+                self._hand_off()
+            self._pending.put((data, len(data), offset, release))
+            return
+
+        view = memoryview(data)
+        while view:
+            if self._block is not None and (offset != self._start + self._fill
+                                            or self._fill == self.BLOCK_SIZE):
+                self._hand_off()
+            if self._block is None:
+                self._block = self._free.pop() if self._free else bytearray(self.BLOCK_SIZE)
+                self._start = offset
+            count = min(len(view), self.BLOCK_SIZE - self._fill)
+            self._block[self._fill:self._fill + count] = view[:count]
+            self._fill += count
+            offset += count
+            view = view[count:]
+        if release:
+            release()
+
+    def flush(self):
+        """Wait until everything written so far is in the file"""
+        if self._block is not None:
+            self._hand_off()
+        self._pending.join()
+        self._check()
+
+    def sync(self):
+        """Flush, then fsync unless durability is none"""
+        self.flush()
+        if self.durability != 'none':
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        """Flush and stop the writer thread; fsyncs unless durability is none"""
+        if self._closed:
+            return
+        try:
+            self.sync()
+        finally:
+            self._stop()
+
+    def abandon(self):
+        """Stop the writer thread without flushing what is still buffered"""
+        self._block = None
+        self._fill = 0
+        self._stop()
+
+    def _stop(self):
+        if not self._closed:
+            self._closed = True
+            self._pending.put(None)
+            self._thread.join()
+
+    def _hand_off(self):
+        self._pending.put((self._block, self._fill, self._start, None))
+        self._block = None
+        self._fill = 0
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _write_out(self):
+        while True:
+            item = self._pending.get()
+            try:
+                if item is None:
+                    return
+                block, fill, start, release = item
+                try:
+                    if self._error is None:
+                        write_at(self.f, memoryview(block)[:fill], start)
+                finally:
+                    if release:
+                        release()
+                    else:
+                        self._free.append(block)
+                if (self._error is None and self.durability == 'periodic'
+                        and time.monotonic() - self._last_sync >= self.SYNC_INTERVAL):
+                    os.fsync(self.f.fileno())
+                    self._last_sync = time.monotonic()
+            except OSError as e:
+                if e.errno in NO_SPACE:
+                    e = Exception("Disk full")
+                self._error = e
+            finally:
+                self._pending.task_done()
@@ -0,0 +1,133 @@
+"""
+Striped Transfer for Pig3on
+Splits one file into byte ranges sent over parallel connections
+"""
+
+import threading
+from utils.logger import get_logger
+from .integrity import StreamHasher
+from .protocol import FRAME_CONTROL
+from .storage import write_at
+
+logger = get_logger(__name__)
+
+
+def plan_stripes(file_size, streams, packet_size):
+    """Split a file into up to `streams` contiguous, packet-aligned [start, end) ranges"""
+    total_packets = (file_size + packet_size - 1) // packet_size
+    streams = max(1, min(streams, total_packets))
+    per_stripe = (total_packets + streams - 1) // streams
+
+    stripes = []
+    for first in range(0, total_packets, per_stripe):
+        start = first * packet_size
+        end = min((first + per_stripe) * packet_size, file_size)
+        stripes.append([start, end])
+    return stripes
+
+
+class StripeSender(threading.Thread):
+    """Sends one stripe of a file over its own connection"""
+
+    def __init__(self, channel, file_path, index, start, end, packet_size, on_packet):
+        super().__init__(daemon=True)
+        self.channel = channel
+        self.file_path = file_path
+        self.index = index
+        self.start_offset = start
+        self.end_offset = end
+        self.packet_size = packet_size
+        self.on_packet = on_packet
+        self.ok = False
+        self.error = None
+
+    def run(self):
+        try:
+            hasher = StreamHasher(self.start_offset)
+
+            with open(self.file_path, 'rb') as f:
+                offset = self.start_offset
+                while offset < self.end_offset:
+                    length = min(self.packet_size, self.end_offset - offset)
+                    self.channel.send_file_range(f, offset, length, stream_id=self.index)
+                    hasher.update_from_file(f, offset, length)
+                    offset += length
+                    self.on_packet(length)
+
+            self.channel.send_control({'type': 'COMPLETE', 'checksum': hasher.hexdigest()})
+
+            final = self.channel.receive_control()
+            self.ok = final.get('status') == 'SUCCESS'
+            if not self.ok:
+                self.error = final.get('message', 'Stripe verification failed')
+
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the stripe connection, interrupting any blocked send"""
+        try:
+            self.channel.socket.close()
+        except OSError:
+            pass
+
+
+class StripeReceiver(threading.Thread):
+    """Receives one stripe into a preallocated file and verifies its digest"""
+
+    def __init__(self, channel, part_path, index, start, end, on_packet):
+        super().__init__(daemon=True)
+        self.channel = channel
+        self.part_path = part_path
+        self.index = index
+        self.start_offset = start
+        self.end_offset = end
+        self.on_packet = on_packet
+        self.ok = False
+        self.error = None
+
+    def run(self):
+        try:
+            hasher = StreamHasher(self.start_offset)
+
+            with open(self.part_path, 'r+b', buffering=0) as f:
+                while True:
+                    frame = self.channel.receive()
+
+                    if frame.type == FRAME_CONTROL:
+                        message = frame.payload
+                        if message.get('type') != 'COMPLETE':
+                            raise Exception(message.get('message', 'Stripe aborted by sender'))
+
+                        self.ok = (hasher.position == self.end_offset and
+                                   hasher.hexdigest() == message.get('checksum'))
+                        if self.ok:
+                            self.channel.send_control({'status': 'SUCCESS'})
+                        else:
+                            self.error = f"Stripe {self.index} checksum mismatch"
+                            self.channel.send_control({'status': 'ERROR', 'message': self.error})
+                        return
+
+                    # Each stripe arrives in order on its own connection
+                    end = frame.offset + len(frame.payload)
+                    if (frame.stream_id != self.index or frame.offset != hasher.position
+                            or end > self.end_offset):
+                        raise Exception(f"Unexpected data at {frame.offset} on stripe {self.index}")
+
+                    write_at(f, frame.payload, frame.offset)
+                    hasher.update(frame.payload, frame.offset)
+                    self.on_packet(len(frame.payload))
+
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the stripe connection, interrupting any blocked receive"""
+        try:
+            self.channel.socket.close()
+        except OSError:
+            pass
@@ -0,0 +1,434 @@
+"""
+Swarm Distribution for Pig3on
+Receivers of a file fetch its pieces from each other as well as from the sender
+"""
+
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+from pathlib import Path
+from utils.logger import get_logger
+from .compression import read_range
+from .protocol import FRAME_CONTROL
+from .storage import preallocate, write_at
+
+logger = get_logger(__name__)
+
+PIECE_SIZE = 1024 * 1024
+MAX_PIECES = 4096       # Larger files get larger pieces, keeping the manifest small
+PIPELINE = 4            # Piece requests in flight per peer source
+SEED_PIPELINE = 2       # Fewer from the seed, so its uplink goes to pieces nobody else has
+HAVE_INTERVAL = 0.25    # Seconds between availability refreshes from a peer source
+IDLE_WAIT = 0.05        # Seconds a source with nothing to offer waits before looking again
+JOIN_WAIT = 2.0          # Seconds to keep retrying a receiver that hasn't joined the swarm yet
+
+
+def build_manifest(path):
+    """Piece layout and hashes of a file, read once"""
+    size = path.stat().st_size
+    piece_size = max(PIECE_SIZE, -(-size // MAX_PIECES))
+    hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(piece_size)
+            if not data:
+                break
+            hashes.append(hashlib.sha256(data).hexdigest())
+    return {'name': path.name, 'size': size, 'piece_size': piece_size, 'hashes': hashes}
+
+
+def swarm_id(manifest):
+    """Identifier of a swarm: the digest of its manifest"""
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def encode_pieces(pieces, count):
+    """Bitfield of held pieces as hex"""
+    bits = bytearray((count + 7) // 8)
+    for index in pieces:
+        bits[index // 8] |= 0x80 >> (index % 8)
+    return bits.hex()
+
+
+def decode_pieces(text, count):
+    """Set of piece indexes in a hex bitfield"""
+    bits = bytes.fromhex(text or '')
+    return {index for index in range(min(count, len(bits) * 8))
+            if bits[index // 8] & (0x80 >> (index % 8))}
+
+
+class SwarmFile:
+    """A distributed file, complete or not, whose verified pieces can be served to peers"""
+
+    def __init__(self, manifest, path, complete=False):
+        self.manifest = manifest
+        self.path = Path(path)
+        self.count = len(manifest['hashes'])
+        self.have = set(range(self.count)) if complete else set()
+        self._lock = threading.Lock()
+
+    def piece_range(self, index):
+        """(offset, length) of a piece"""
+        offset = index * self.manifest['piece_size']
+        return offset, min(self.manifest['piece_size'], self.manifest['size'] - offset)
+
+    def complete(self):
+        return len(self.have) == self.count
+
+    def held(self):
+        with self._lock:
+            return encode_pieces(self.have, self.count)
+
+    def read(self, index):
+        """Bytes of a held piece, or None"""
+        with self._lock:
+            if index not in self.have:
+                return None
+            path = self.path
+        return read_range(path, *self.piece_range(index))
+
+    def store(self, f, index, data):
+        """Write a piece after checking it against the manifest; False if it doesn't match"""
+        if hashlib.sha256(data).hexdigest() != self.manifest['hashes'][index]:
+            return False
+        write_at(f, data, self.piece_range(index)[0])
+        with self._lock:
+            self.have.add(index)
+        return True
+
+
+class SwarmRegistry:
+    """
+    Swarms this node is fetching, whose pieces it serves while the fetch
+    runs, and only to the other receivers the seed listed for them
+    """
+
+    def __init__(self):
+        self._swarms = {}   # Identifier -> (SwarmFile, addresses of its other receivers)
+        self._lock = threading.Lock()
+
+    def add(self, identifier, swarm, sources):
+        with self._lock:
+            self._swarms[identifier] = (swarm, {address for address, _ in sources})
+
+    def remove(self, identifier):
+        with self._lock:
+            self._swarms.pop(identifier, None)
+
+    def admits(self, identifier, address):
+        """Whether address is another receiver of a swarm we are fetching"""
+        with self._lock:
+            entry = self._swarms.get(identifier)
+        return entry is not None and address in entry[1]
+
+    def get(self, identifier):
+        with self._lock:
+            entry = self._swarms.get(identifier)
+        return entry[0] if entry else None
+
+
+def serve_pieces(channel, lookup):
+    """
+    Answer HAVE? and GET requests until the other side says BYE or
+    SWARM_DONE; returns (that message, pieces served)
+    """
+    served = 0
+    while True:
+        message = channel.receive_control()
+        kind = message.get('type')
+        swarm = lookup(message.get('swarm'))
+
+        if kind == 'HAVE?':
+            channel.send_control({'type': 'HAVE', 'pieces': swarm.held() if swarm else ''})
+        elif kind == 'GET':
+            piece = message['piece']
+            data = swarm.read(piece) if swarm else None
+            if data is None:
+                channel.send_control({'type': 'MISSING', 'piece': piece})
+            else:
+                channel.send_data(data, piece)
+                served += 1
+        elif kind in ('BYE', 'SWARM_DONE'):
+            return message, served
+        else:
+            raise Exception(f"Unexpected swarm message {kind}")
+
+
+class _Source:
+    """A place pieces can come from: the seed over the paired channel, or another receiver"""
+
+    def __init__(self, name, channel=None, address=None, seed=False):
+        self.name = name
+        self.channel = channel
+        self.address = address
+        self.seed = seed
+        self.have = set()
+        self.depth = SEED_PIPELINE if seed else PIPELINE
+        self.fetched = 0
+
+
+class SwarmFetcher:
+    """
+    Receives a swarm file by pulling pieces from the seed and from the other
+    receivers at once. Each source gets its own worker that requests the
+    rarest missing piece that source holds, so pieces spread through the
+    swarm quickly and the seed mostly sends what nobody else has yet.
+    """
+
+    def __init__(self, config, connection_manager):
+        self.config = config
+        self.connection = connection_manager
+        self._lock = threading.Lock()
+        self._needed = set()
+        self._availability = []
+        self._order = []
+        self._swarm = None
+        self._file = None
+        self._identifier = None
+
+    def fetch(self, message):
+        """Join a swarm announced by the seed; returns True once the file is complete"""
+        manifest = message['manifest']
+        self._identifier = swarm_id(manifest)
+        channel = self.connection.channel
+        if self._identifier != message.get('swarm'):
+            channel.send_control({'type': 'SWARM_DONE', 'status': 'ERROR', 'message': 'Bad manifest'})
+            return False
+
+        filename = Path(manifest['name']).name
+        root = Path(self.config.download_dir)
+        root.mkdir(parents=True, exist_ok=True)
+        destination = root / filename
+        part_path = destination.with_name(filename + '.swarm')
+        logger.info(f"\n🐝 Joining swarm for {filename} ({manifest['size']} bytes, "
+                    f"{len(message.get('sources', []))} other receiver(s))")
+
+        self._swarm = SwarmFile(manifest, part_path)
+        count = self._swarm.count
+        self._needed = set(range(count))
+        self._availability = [0] * count
+        self._order = [random.random() for _ in range(count)]    # Random tie-break spreads peers out
+
+        sources = [_Source('seed', channel=channel, seed=True)]
+        sources += [_Source(f"{address}:{port}", address=(address, port))
+                    for address, port in message.get('sources', [])]
+        self._add_have(sources[0], set(range(count)))
+
+        start_time = time.time()
+        with open(part_path, 'wb') as f:
+            preallocate(f, manifest['size'])
+            self._file = f
+            self.connection.swarms.add(self._identifier, self._swarm, message.get('sources', []))
+            try:
+                workers = [threading.Thread(target=self._work, args=(source,), daemon=True)
+                           for source in sources]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+            finally:
+                # Pieces are served only while we fetch; receivers still going carry on with the rest
+                self.connection.swarms.remove(self._identifier)
+
+        from_seed = sources[0].fetched
+        from_peers = sum(source.fetched for source in sources[1:])
+        if not self._swarm.complete():
+            logger.error(f"❌ Swarm incomplete: {count - len(self._swarm.have)} piece(s) missing")
+            channel.send_control({'type': 'SWARM_DONE', 'status': 'ERROR',
+                                  'message': 'Swarm incomplete'})
+            return False
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        part_path.replace(destination)
+        elapsed = time.time() - start_time
+        logger.info(f"✅ Saved to: {destination} ({from_seed} piece(s) from the seed, "
+                    f"{from_peers} from peers, {elapsed:.1f}s)")
+        channel.send_control({'type': 'SWARM_DONE', 'status': 'SUCCESS',
+                              'from_seed': from_seed, 'from_peers': from_peers})
+        return True
+
+    def _add_have(self, source, pieces):
+        """Fold a source's latest bitfield into the availability counts"""
+        with self._lock:
+            for index in pieces - source.have:
+                self._availability[index] += 1
+            for index in source.have - pieces:
+                self._availability[index] -= 1
+            source.have = pieces
+
+    def _pick(self, source):
+        """Claim the rarest missing piece this source holds"""
+        with self._lock:
+            candidates = self._needed & source.have
+            if not candidates:
+                return None
+            piece = min(candidates, key=lambda index: (self._availability[index], self._order[index]))
+            self._needed.discard(piece)
+            return piece
+
+    def _release(self, pieces):
+        with self._lock:
+            self._needed.update(index for index in pieces if index not in self._swarm.have)
+
+    def _done(self):
+        return self._swarm.complete()
+
+    def _open_source(self, source):
+        """Connect to another receiver, retrying while it may not have joined the swarm yet"""
+        deadline = time.time() + JOIN_WAIT
+        while True:
+            try:
+                return self.connection.open_swarm_source(*source.address, self._identifier)
+            except (OSError, ConnectionError):
+                if time.time() >= deadline or self._done():
+                    raise
+                time.sleep(HAVE_INTERVAL)
+
+    def _work(self, source):
+        in_flight = deque()     # Piece index, or None for a HAVE? request
+        channel = source.channel
+        try:
+            if channel is None:
+                channel = self._open_source(source)
+            last_have = 0
+
+            while not self._done():
+                if not source.seed and time.time() - last_have >= HAVE_INTERVAL \
+                        and None not in in_flight:
+                    channel.send_control({'type': 'HAVE?', 'swarm': self._identifier})
+                    in_flight.append(None)
+                    last_have = time.time()
+
+                while len([piece for piece in in_flight if piece is not None]) < source.depth:
+                    piece = self._pick(source)
+                    if piece is None:
+                        break
+                    channel.send_control({'type': 'GET', 'swarm': self._identifier, 'piece': piece})
+                    in_flight.append(piece)
+
+                if not in_flight:
+                    time.sleep(IDLE_WAIT)
+                    continue
+
+                frame = channel.receive()
+                expected = in_flight.popleft()
+                if frame.type == FRAME_CONTROL:
+                    message = frame.payload
+                    if message.get('type') == 'HAVE':
+                        self._add_have(source, decode_pieces(message['pieces'], self._swarm.count))
+                    elif message.get('type') == 'MISSING':
+                        self._release([expected])
+                    else:
+                        raise Exception(f"Unexpected swarm reply {message.get('type')}")
+                elif frame.offset != expected or not self._swarm.store(self._file, expected,
+                                                                       frame.payload):
+                    raise Exception(f"Piece {expected} from {source.name} failed verification")
+                else:
+                    source.fetched += 1
+
+            # Replies still owed must be read before the channel is handed back or closed
+            while in_flight:
+                channel.receive()
+                self._release([in_flight.popleft()])
+        except Exception as e:
+            logger.debug(f"Swarm source {source.name} dropped: {e}")
+            self._release([piece for piece in in_flight if piece is not None])
+        finally:
+            if not source.seed and channel is not None:
+                try:
+                    channel.send_control({'type': 'BYE'})
+                except OSError:
+                    pass
+                channel.socket.close()
+
+
+class SwarmSeed:
+    """
+    Starts a swarm for one file: hashes it once, tells every receiver the
+    manifest and where the other receivers are, then answers the piece
+    requests each receiver sends back over its paired connection.
+    """
+
+    def __init__(self, config, paths):
+        paths = [Path(path) for path in paths]
+        if len(paths) != 1 or not paths[0].is_file():
+            raise Exception("Swarm mode sends a single file")
+        self.config = config
+        self.path = paths[0]
+        self.manifest = None
+        self.identifier = None
+        self.results = []
+        self._swarm = None
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def begin(self, connections):
+        """Hash the file and note the receivers that will share pieces"""
+        self._connections = list(connections)
+        self.manifest = build_manifest(self.path)
+        self.identifier = swarm_id(self.manifest)
+        self._swarm = SwarmFile(self.manifest, self.path, complete=True)
+        logger.info(f"🐝 Seeding {self.path.name} to {len(self._connections)} peer(s) in "
+                    f"{self._swarm.count} piece(s)")
+
+    def send(self, connections):
+        """Seed to every connection on its own thread; returns True if all completed"""
+        self.begin(connections)
+        threads = [threading.Thread(target=self.send_to, args=(connection,), daemon=True)
+                   for connection in self._connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)    # Short steps so Ctrl+C reaches the main thread
+        self.report()
+        return all(result['ok'] for result in self.results)
+
+    def send_to(self, connection):
+        """Announce the swarm to one receiver and serve it until it has the whole file"""
+        info = connection.peer_info or {}
+        start_time = time.time()
+        result = {'peer': info.get('name') or info.get('address', 'Unknown'), 'ok': False,
+                  'served': 0, 'error': None}
+        try:
+            if 'swarm' not in connection.peer_features:
+                raise Exception("Peer does not support swarm transfers")
+            sources = [[other.peer_info['address'],
+                        other.peer_info.get('port', self.config.transfer_port)]
+                       for other in self._connections if other is not connection and other.peer_info]
+            connection.channel.send_control({'type': 'SWARM', 'swarm': self.identifier,
+                                             'manifest': self.manifest, 'sources': sources})
+            message, result['served'] = serve_pieces(connection.channel, self._lookup)
+            result['ok'] = message.get('status') == 'SUCCESS'
+            result['error'] = message.get('message')
+        except Exception as e:
+            result['error'] = str(e)
+
+        result['seconds'] = time.time() - start_time
+        with self._lock:
+            self.results.append(result)
+        return result['ok']
+
+    def _lookup(self, identifier):
+        return self._swarm if identifier == self.identifier else None
+
+    def report(self):
+        """Log each receiver's outcome and how much of the file came from the seed"""
+        total = self._swarm.count if self._swarm else 0
+        logger.info(f"\n🐝 Swarm of {len(self.results)} peer(s):")
+        for result in sorted(self.results, key=lambda result: result['peer']):
+            if result['ok']:
+                logger.info(f"  ✅ {result['peer']}: complete in {result['seconds']:.1f}s, "
+                            f"{result['served']}/{total} piece(s) from the seed")
+            else:
+                logger.error(f"  {result['peer']}: {result['error'] or 'failed'}")
+        served = sum(result['served'] for result in self.results)
+        if total:
+            logger.info(f"  Seed uploaded {served / total:.1f}x the file for "
+                        f"{len(self.results)} copies")
+
+    def close(self):
+        """Nothing is held between receivers; present so callers treat seeds like fan-outs"""
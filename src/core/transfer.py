@@ -4,37 +4,94 @@ Handles sending and receiving files with progress tracking
 """
 
 import os
-import json
 import time
+import queue
+import select
+import secrets
 import hashlib
+import threading
+from array import array
+from collections import deque
 from pathlib import Path
+from utils.crypto import SEAL_OVERHEAD
 from utils.logger import get_logger
 from utils.progress import ProgressBar
+from .integrity import StreamHasher
+from .pipeline import POLL_INTERVAL, BufferPool, FileReader, Pipeline, Stage
+from .protocol import FLAG_COMPRESSED, FRAME_CONTROL, FRAME_DATA, LEGACY_VERSION
+from .resume import PartialDownload
+from .storage import WriteBehind, check_space, preallocate
+
+# Striping, delta, dedup, compression, swarms, tuning and the batch and mux
+# engines are imported where a transfer negotiates them, so plain sends and
+# receives don't pay for the ones they never use
 
 logger = get_logger(__name__)
 
 class FileTransfer:
     PACKET_SIZE = 8192  # 8KB packets
+    MAX_PACKET_SIZE = 1024 * 1024  # 1MB cap keeps per-packet memory bounded
     TOTAL_PACKETS = 100  # Split file into 100 packets for progress
+    WINDOW_BYTES = 4 * 1024 * 1024  # Target bytes in flight for auto window
+    MIN_WINDOW = 2
+    MAX_WINDOW = 64
+    MANIFEST_INTERVAL = 2.0  # Seconds between partial download checkpoints
+    MAX_STREAMS = 16
+    STREAM_TIMEOUT = 10.0  # Seconds to wait for striped transfer connections
+    CHUNK_LIST_SIZE = 4096  # Chunk digests per CHUNK_LIST message
     
     def __init__(self, config, connection_manager):
         self.config = config
         self.connection = connection_manager
+        self.packet_size = None  # Fixed packet size, e.g. for benchmarks; None derives it
+        self.record = None  # Metrics of the transfer under way
+        self.progress_bars = []  # Bars of the transfer under way
         
-    def send_file(self, file_path):
-        """Send a file to connected peer"""
+    def send_file(self, file_path, streams=1, compression=None):
+        """Send a file to connected peer, optionally striped across parallel streams"""
         if not self.connection.is_connected():
             logger.error("Not connected")
             return False
         
+        # Legacy receivers stop reading after one file, so each further file needs a new pairing
+        if self.connection.spent:
+            logger.info("🔗 Pairing again for the next file...")
+            if not self.connection.renew():
+                logger.error("Could not reconnect to the peer")
+                return False
+        
+        recording = self._start_record('send', Path(file_path).name)
+        ok = False
         try:
-            file_path = Path(file_path)
-            file_size = file_path.stat().st_size
+            ok = self._send_file(Path(file_path), streams, compression)
+            return ok
+        finally:
+            self.connection.spent = self.connection.protocol_version == LEGACY_VERSION
+            if recording:
+                self._finish_record(ok)
+    
+    def _send_file(self, file_path, streams, compression):
+        """Negotiate and send one file over the path the receiver picks"""
+        try:
+            stat = file_path.stat()
+            file_size = stat.st_size
+            self.record.files += 1
+            self.record.bytes += file_size
+            self.record.method = 'windowed'
             
-            # Calculate packet size based on file size
-            packet_size = max(self.PACKET_SIZE, file_size // self.TOTAL_PACKETS)
+            # Calculate packet size from the measured link, or else from file size
+            link = self.connection.link
+            if self.packet_size:
+                packet_size = self.packet_size
+            elif link:
+                packet_size = link.packet_for(file_size)
+            else:
+                packet_size = min(self.MAX_PACKET_SIZE,
+                                  max(self.PACKET_SIZE, file_size // self.TOTAL_PACKETS))
             total_packets = (file_size + packet_size - 1) // packet_size
             
+            window = self._window_size(packet_size)
+            
             # Send file metadata
             metadata = {
                 'type': 'FILE_TRANSFER',
@@ -42,66 +99,213 @@ class FileTransfer:
                 'size': file_size,
                 'packet_size': packet_size,
                 'total_packets': total_packets,
-                'checksum': self._calculate_checksum(file_path)
+                'window': window,
+                'identity': {'size': file_size, 'mtime_ns': stat.st_mtime_ns}
             }
             
+            # Legacy receivers need the checksum up front; v2 peers get a
+            # streaming digest in the COMPLETE message instead
+            legacy = self._channel.version == LEGACY_VERSION
+            hasher = None if legacy else StreamHasher()
+            if legacy:
+                metadata['checksum'] = self._calculate_checksum(file_path)
+            elif streams > 1 and total_packets > 1:
+                from .striping import plan_stripes
+                # Receivers that don't support striping ignore this and get one stream
+                metadata['session'] = secrets.token_hex(8)
+                metadata['stripes'] = plan_stripes(file_size, streams, packet_size)
+            if 'delta' in self.connection.peer_features:
+                # Used only if the peer already holds an older copy
+                metadata['delta'] = True
+            if 'dedup' in self.connection.peer_features:
+                from .chunkstore import MIN_CHUNK_SIZE
+                if file_size > MIN_CHUNK_SIZE:
+                    # Lets the peer assemble chunks it already stores from earlier transfers
+                    metadata['dedup'] = True
+            if 'compress' in self.connection.peer_features:
+                from .compression import offered_codecs
+                # The receiver picks the first codec it also supports
+                codecs = offered_codecs(compression or self.config.compression)
+                if codecs:
+                    metadata['compression'] = codecs
+            
             self._send_json(metadata)
             
             # Wait for acknowledgment
             ack = self._receive_json()
             if ack.get('status') != 'READY':
-                logger.error("Peer not ready to receive")
+                reason = ack.get('message')
+                logger.error(f"Peer not ready to receive: {reason}" if reason
+                             else "Peer not ready to receive")
                 return False
             
-            # Send file in packets
-            progress = ProgressBar(total_packets, f"Uploading {file_path.name}")
+            if ack.get('streams'):
+                self.record.method = 'striped'
+                return self._send_striped(file_path, metadata)
+            if ack.get('delta'):
+                self.record.method = 'delta'
+                return self._send_delta(file_path, metadata, ack['delta'])
+            if ack.get('dedup'):
+                self.record.method = 'dedup'
+                return self._send_dedup(file_path, metadata, ack.get('compression'))
             
-            with open(file_path, 'rb') as f:
-                packet_num = 0
-                
-                while packet_num < total_packets:
+            # Packets the peer kept from an interrupted transfer are skipped
+            have = ack.get('have', [])
+            held = sum(end - start for start, end in have)
+            if held:
+                logger.info(f"↪️  Resuming: {held}/{total_packets} packets already on peer")
+            
+            codec = ack.get('compression')
+            compressor = None
+            if codec:
+                from .compression import CODECS, Compressor
+                compressor = Compressor(codec) if codec in CODECS else None
+            
+            # Keep re-deriving the window from ACK timing unless it is pinned in the config;
+            # a paced send would only measure its own rate limit
+            tuner = None
+            if (link and not legacy and self.config.transfer_window <= 0
+                    and self.connection.throttle is None):
+                from .tuning import WindowTuner
+                tuner = WindowTuner(link, self.connection.socket, packet_size, window,
+                                    on_rtt=self.record.sample_rtt)
+            
+            # Send file in packets, keeping up to `window` unacknowledged
+            progress = self._progress_bar(file_size, f"Uploading {file_path.name}")
+            channel = self._channel
+            acked = have[0][1] if have and have[0][0] == 0 else 0
+            in_flight = set()
+            window_open = threading.Condition()
+            
+            buffers = BufferPool(packet_size)
+            # Raw frames go out with sendfile from the page cache the read stage just
+            # filled; its buffer is only needed for hashing and is recycled at once
+            direct = not legacy and compressor is None and channel.sealer is None
+            
+            def read(packets):
+                """Read the packets still to send, with the kernel reading ahead"""
+                with FileReader(file_path) as reader:
+                    for packet in packets:
+                        offset = packet * packet_size
+                        buffer = buffers.take()
+                        yield packet, buffer, reader.read_into(
+                            buffer, offset, min(packet_size, file_size - offset))
+            
+            def process(items):
+                """Hash packets in order, compress them ahead in the pool and seal them"""
+                ahead = deque()
+                lookahead = compressor.lookahead if compressor else 0
+                with open(file_path, 'rb') as f:
+                    for packet, buffer, data in items:
+                        offset = packet * packet_size
+                        if hasher:
+                            # Covers skipped packets too, from local disk only
+                            if hasher.position < offset:
+                                hasher.update_from_file(f, hasher.position, offset - hasher.position)
+                            hasher.update(data, offset)
+                        if direct:
+                            buffers.give(buffer)
+                            yield packet, None, None, 0, None
+                            continue
+                        ahead.append((packet, buffer, data,
+                                      compressor.submit(file_path, data) if compressor else None))
+                        if len(ahead) > lookahead:
+                            yield encode(*ahead.popleft())
+                while ahead:
+                    yield encode(*ahead.popleft())
+            
+            def encode(packet, buffer, data, handle):
+                payload, flags = data, 0
+                if compressor:
+                    chunk = compressor.collect(handle, data)
+                    compressor.account(len(data), chunk)
+                    if chunk.payload is not None:
+                        payload, flags = chunk.payload, FLAG_COMPRESSED
+                frame = None
+                if channel.sealer is not None:
+                    frame = channel.frame(FRAME_DATA, payload, offset=packet * packet_size, flags=flags)
+                return packet, buffer, payload, flags, frame
+            
+            def send(items):
+                """Put packets on the wire as the window allows"""
+                with open(file_path, 'rb') as f:
+                    for packet, buffer, payload, flags, frame in items:
+                        with window_open:
+                            with sending.waiting():
+                                while len(in_flight) >= window:
+                                    window_open.wait(POLL_INTERVAL)
+                                    pipeline.check()
+                            in_flight.add(packet)
+                            if tuner:
+                                tuner.on_send(packet)
+                        offset = packet * packet_size
+                        if direct:
+                            channel.send_file_range(f, offset, min(packet_size, file_size - offset))
+                        elif frame is None:
+                            channel.send_data(payload, offset, flags=flags)
+                        else:
+                            channel.send_frame(frame)
+                        if buffer is not None:
+                            buffers.give(buffer)
+                        yield packet
+            
+            # Disk reads, hashing/compression/sealing and socket writes overlap
+            # on their own threads; this one processes ACKs
+            sending = Stage('send', send, waits_on='peer')
+            pipeline = Pipeline(Stage('read', read), Stage('process', process), sending,
+                                source=self._missing_packets(total_packets, have))
+            pipeline.start()
+            
+            try:
+                while acked < total_packets:
                     try:
-                        # Read packet
-                        data = f.read(packet_size)
-                        if not data:
-                            break
-                        
-                        # Send packet with header
-                        packet = {
-                            'packet_num': packet_num,
-                            'data': data.hex()
-                        }
-                        self._send_json(packet)
-                        
                         # Wait for acknowledgment
-                        ack = self._receive_json()
-                        if ack.get('status') != 'ACK':
-                            raise Exception("Packet not acknowledged")
-                        
-                        packet_num += 1
-                        progress.update(packet_num)
+                        pipeline.wait_readable(channel.socket)
+                        message = self._receive_json()
+                        with window_open:
+                            outstanding = set(in_flight)
+                            acked = self._process_ack(message, acked, in_flight)
+                            if tuner:
+                                window = tuner.on_ack(outstanding - in_flight)
+                            window_open.notify()
+                        progress.update(min(file_size, acked * packet_size))
                         
                     except KeyboardInterrupt:
+                        pipeline.abort()
                         self._send_json({'type': 'CANCEL'})
                         logger.error("\n❌ Transfer cancelled by user")
                         return False
                     except Exception as e:
+                        pipeline.abort()
                         self._send_json({'type': 'ERROR', 'message': str(e)})
                         logger.error(f"\n❌ Interference in data transfer: {e}")
                         return False
+                
+                pipeline.join()
+                if hasher and hasher.position < file_size:
+                    with open(file_path, 'rb') as f:
+                        hasher.update_from_file(f, hasher.position, file_size - hasher.position)
+            finally:
+                pipeline.abort()
+                if compressor:
+                    compressor.close()
             
             progress.finish()
+            pipeline.report()
+            self.record.add_pipeline(pipeline, {'read': 'disk', 'process': 'hash', 'send': 'network'})
+            if compressor:
+                compressor.report(self._format_size)
+            if tuner:
+                link.finish()
+                self.connection.remember_link()
             
             # Send completion signal
-            self._send_json({'type': 'COMPLETE'})
+            complete = {'type': 'COMPLETE'}
+            if hasher:
+                complete['checksum'] = hasher.hexdigest()
+            self._send_json(complete)
             
-            # Wait for final verification
-            final = self._receive_json()
-            if final.get('status') == 'SUCCESS':
-                return True
-            else:
-                logger.error(f"Transfer verification failed: {final.get('message')}")
-                return False
+            return self._await_verification()
             
         except ConnectionError:
             logger.error("❌ Connection lost during transfer")
@@ -110,20 +314,303 @@ class FileTransfer:
             logger.error(f"❌ Send failed: {e}")
             return False
     
+    def send_batch(self, paths, compression=None):
+        """Send many files and directories in one session"""
+        if not self.connection.is_connected():
+            logger.error("Not connected")
+            return False
+        
+        if 'batch' not in self.connection.peer_features:
+            # Older peers only take single files, so flatten the batch; send_file
+            # pairs again before each file after the first
+            logger.warning("Peer does not support batch transfers; sending files one by one")
+            from .batch import walk_sources
+            return all([self.send_file(path, compression=compression)
+                        for path, _, is_dir in walk_sources(paths)
+                        if not is_dir])
+        
+        name = Path(paths[0]).name if len(paths) == 1 else f"{len(paths)} paths"
+        recording = self._start_record('send', name)
+        ok = False
+        try:
+            if 'mux' in self.connection.peer_features:
+                # Files go as concurrent streams so small ones aren't stuck behind large ones
+                from .engine import TransferEngine
+                self.record.method = 'mux'
+                sender = TransferEngine(self.config, self.connection)
+            else:
+                from .batch import BatchTransfer
+                self.record.method = 'batch'
+                sender = BatchTransfer(self.config, self.connection, self.MAX_PACKET_SIZE)
+            ok = sender.send(paths, compression)
+            self.record.files, self.record.bytes = sender.totals
+            return ok
+        except ConnectionError:
+            logger.error("❌ Connection lost during transfer")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Send failed: {e}")
+            return False
+        finally:
+            if recording:
+                self._finish_record(ok)
+    
+    def send_paths(self, paths, streams=1, compression=None):
+        """Send what the user named: a single plain file keeps the resumable/striped path"""
+        paths = [Path(path) for path in paths]
+        if len(paths) == 1 and paths[0].is_file():
+            logger.info(f"📤 Sending: {paths[0].name}")
+            return self.send_file(paths[0], streams=streams, compression=compression)
+        
+        logger.info(f"📤 Sending {len(paths)} path(s)")
+        return self.send_batch(paths, compression=compression)
+    
+    def _send_striped(self, file_path, metadata):
+        """Send each stripe of the file over its own connection to the peer"""
+        from .striping import StripeSender
+        
+        stripes = metadata['stripes']
+        progress = self._progress_bar(metadata['size'],
+                                      f"Uploading {file_path.name} ({len(stripes)} streams)")
+        senders = []
+        
+        try:
+            for index, (start, end) in enumerate(stripes):
+                channel = self.connection.open_stream(metadata['session'], index)
+                senders.append(StripeSender(channel, file_path, index, start, end,
+                                            metadata['packet_size'], progress.advance))
+            
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                # Join in short steps so Ctrl+C reaches the main thread
+                while sender.is_alive():
+                    sender.join(0.5)
+            
+        except KeyboardInterrupt:
+            for sender in senders:
+                sender.close()
+            self._send_json({'type': 'CANCEL'})
+            logger.error("\n❌ Transfer cancelled by user")
+            return False
+        except Exception as e:
+            for sender in senders:
+                sender.close()
+            self._send_json({'type': 'ERROR', 'message': str(e)})
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            return False
+        
+        failed = [sender for sender in senders if not sender.ok]
+        if failed:
+            self._send_json({'type': 'ERROR', 'message': failed[0].error})
+            logger.error(f"\n❌ Interference in data transfer: {failed[0].error}")
+            return False
+        
+        progress.finish()
+        
+        # Every stripe was verified by the peer; ask it to publish the file
+        self._send_json({'type': 'COMPLETE'})
+        
+        return self._await_verification()
+    
+    def _send_delta(self, file_path, metadata, delta):
+        """Send only the parts of the file the peer's older copy lacks"""
+        from .delta import DeltaEncoder
+        
+        table = bytearray()
+        while len(table) < delta['table_size']:
+            frame = self._channel.receive()
+            if frame.type != FRAME_DATA or frame.offset != len(table):
+                raise Exception("Malformed signature table")
+            table += frame.payload
+        
+        encoder = DeltaEncoder(bytes(table), delta['block_size'], delta['size'])
+        hasher = StreamHasher()
+        progress = self._progress_bar(metadata['size'], f"Uploading {file_path.name} (delta)")
+        literal_bytes = [0]
+        
+        def on_copy(offset, block, count):
+            self._send_json({'type': 'COPY', 'offset': offset, 'block': block, 'count': count})
+        
+        def on_literal(data, offset):
+            self._channel.send_data(data, offset)
+            literal_bytes[0] += len(data)
+        
+        def on_data(data, offset):
+            hasher.update(data, offset)
+            progress.update(offset + len(data))
+        
+        try:
+            with open(file_path, 'rb') as f:
+                encoder.encode(f, on_copy, on_literal, on_data)
+        except KeyboardInterrupt:
+            self._send_json({'type': 'CANCEL'})
+            logger.error("\n❌ Transfer cancelled by user")
+            return False
+        except Exception as e:
+            self._send_json({'type': 'ERROR', 'message': str(e)})
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            return False
+        
+        progress.finish()
+        logger.info(f"🧩 Delta: sent {self._format_size(literal_bytes[0])} of "
+                    f"{self._format_size(metadata['size'])}")
+        
+        self._send_json({'type': 'COMPLETE', 'checksum': hasher.hexdigest()})
+        
+        return self._await_verification()
+    
+    def _send_dedup(self, file_path, metadata, codec=None):
+        """Announce the file's chunks, then send only those the peer's chunk store lacks"""
+        from .chunkstore import chunk_digest, iter_chunks
+        from .compression import CODECS, Compressor, send_chunk
+        
+        hasher = StreamHasher()
+        offsets = array('Q')
+        batch = []
+        compressor = Compressor(codec) if codec in CODECS else None
+        
+        try:
+            with open(file_path, 'rb') as f:
+                # One read pass chunks and hashes the file while the list streams out
+                for offset, data in iter_chunks(f):
+                    hasher.update(data, offset)
+                    offsets.append(offset)
+                    batch.append([chunk_digest(data), len(data)])
+                    if len(batch) >= self.CHUNK_LIST_SIZE:
+                        self._send_json({'type': 'CHUNK_LIST', 'chunks': batch, 'final': False})
+                        batch = []
+                self._send_json({'type': 'CHUNK_LIST', 'chunks': batch, 'final': True})
+                offsets.append(metadata['size'])
+                
+                need = self._receive_json()
+                if need.get('type') != 'CHUNK_NEED':
+                    raise Exception(need.get('message', 'Chunk list not acknowledged'))
+                
+                sent_bytes = 0
+                progress = self._progress_bar(metadata['size'], f"Uploading {file_path.name} (dedup)")
+                needed = (index for start, end in need['chunks'] for index in range(start, end))
+                if compressor:
+                    needed = compressor.pipeline(needed, lambda index: (
+                        file_path, offsets[index], offsets[index + 1] - offsets[index]))
+                else:
+                    needed = ((index, None) for index in needed)
+                
+                for index, chunk in needed:
+                    length = offsets[index + 1] - offsets[index]
+                    send_chunk(self._channel, f, offsets[index], length, chunk, FLAG_COMPRESSED)
+                    if compressor:
+                        compressor.account(length, chunk)
+                    sent_bytes += length
+                    progress.update(offsets[index + 1])
+        except KeyboardInterrupt:
+            self._send_json({'type': 'CANCEL'})
+            logger.error("\n❌ Transfer cancelled by user")
+            return False
+        except ConnectionError:
+            raise
+        except Exception as e:
+            self._send_json({'type': 'ERROR', 'message': str(e)})
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            return False
+        finally:
+            if compressor:
+                compressor.close()
+        
+        progress.finish()
+        logger.info(f"♻️  Dedup: sent {self._format_size(sent_bytes)} of "
+                    f"{self._format_size(metadata['size'])}")
+        if compressor:
+            compressor.report(self._format_size)
+        
+        self._send_json({'type': 'COMPLETE', 'checksum': hasher.hexdigest()})
+        
+        return self._await_verification()
+    
+    def _start_record(self, direction, name):
+        """Begin recording a transfer for the metrics history; False if one is already under way"""
+        if self.record is not None:
+            return False
+        self.record = self.connection.metrics.transfer(direction, name, self.connection)
+        return True
+    
+    def _finish_record(self, ok):
+        """Add the transfer's record to the metrics history"""
+        self.record.ok = bool(ok)
+        self.connection.metrics.finish(self.record)
+        self.record = None
+        # Bars of a failed transfer would otherwise stay on screen
+        for progress in self.progress_bars:
+            progress.close()
+        self.progress_bars = []
+    
+    def _progress_bar(self, total_bytes, description):
+        """Show a progress bar that is taken down when the transfer ends, even if it fails"""
+        progress = ProgressBar(total_bytes, description)
+        self.progress_bars.append(progress)
+        return progress
+    
+    def _await_verification(self):
+        """Wait for the receiver's final verification result"""
+        final = self._receive_json()
+        if final.get('status') == 'SUCCESS':
+            return True
+        else:
+            logger.error(f"Transfer verification failed: {final.get('message')}")
+            return False
+    
     def receive_file(self):
         """Receive a file from connected peer"""
+        ok = False
+        try:
+            ok = self._receive_file()
+            return ok
+        finally:
+            if self.record:
+                self._finish_record(ok)
+    
+    def _receive_file(self):
+        """Read the next transfer request and receive it"""
         try:
             # Receive metadata
             metadata = self._receive_json()
             
+            if metadata.get('type') in ('BATCH_TRANSFER', 'MUX'):
+                self._start_record('receive', 'batch')
+                if metadata['type'] == 'MUX':
+                    from .engine import TransferEngine
+                    self.record.method = 'mux'
+                    receiver = TransferEngine(self.config, self.connection)
+                    ok = receiver.serve(metadata)
+                else:
+                    from .batch import BatchTransfer
+                    self.record.method = 'batch'
+                    receiver = BatchTransfer(self.config, self.connection, self.MAX_PACKET_SIZE)
+                    ok = receiver.receive(metadata)
+                self.record.files, self.record.bytes = receiver.totals
+                return ok
+            
+            if metadata.get('type') == 'SWARM':
+                self._start_record('receive', metadata['manifest']['name'])
+                self.record.method = 'swarm'
+                self.record.files = 1
+                self.record.bytes = metadata['manifest']['size']
+                from .swarm import SwarmFetcher
+                return SwarmFetcher(self.config, self.connection).fetch(metadata)
+            
             if metadata.get('type') != 'FILE_TRANSFER':
                 return False
             
-            filename = metadata['filename']
+            filename = Path(metadata['filename']).name
             file_size = metadata['size']
+            self._start_record('receive', filename)
+            self.record.method = 'windowed'
+            self.record.files = 1
+            self.record.bytes = file_size
             packet_size = metadata['packet_size']
             total_packets = metadata['total_packets']
-            expected_checksum = metadata['checksum']
+            expected_checksum = metadata.get('checksum')
+            identity = metadata.get('identity')
             
             logger.info(f"\n📥 Incoming file: {filename} ({self._format_size(file_size)})")
             
@@ -131,66 +618,225 @@ class FileTransfer:
             output_path = Path(self.config.download_dir) / filename
             output_path.parent.mkdir(parents=True, exist_ok=True)
             
-            # Send ready signal
-            self._send_json({'status': 'READY'})
+            stripes = metadata.get('stripes')
+            if stripes and len(stripes) <= self.MAX_STREAMS and self._channel.version != LEGACY_VERSION:
+                self.record.method = 'striped'
+                return self._receive_striped(metadata, output_path)
+            
+            # Pick up what an interrupted transfer of the same file left behind;
+            # legacy senders send no identity and can't resume
+            partial = PartialDownload(output_path.parent, filename)
+            if identity:
+                held_bytes = partial.load(identity)
+            else:
+                partial.discard()
+                held_bytes = []
+            have = self._held_packets(held_bytes, packet_size, file_size)
+            
+            # An older copy of the file lets the sender transmit only what changed
+            if not held_bytes and metadata.get('delta') and output_path.is_file():
+                self.record.method = 'delta'
+                return self._receive_delta(metadata, output_path, partial)
             
-            # Receive file packets
-            progress = ProgressBar(total_packets, f"Downloading {filename}")
+            # Chunks kept from earlier transfers need not cross the wire again
+            if not held_bytes and metadata.get('dedup') and self.config.chunk_store_limit > 0:
+                self.record.method = 'dedup'
+                return self._receive_dedup(metadata, output_path, partial)
             
-            with open(output_path, 'wb') as f:
-                packet_num = 0
+            # Legacy senders wait for an ACK after every packet
+            legacy = self._channel.version == LEGACY_VERSION
+            ack_interval = max(1, metadata.get('window', 1) // 4)
+            codec = None
+            if not legacy and metadata.get('compression'):
+                from .compression import choose_codec, decompress
+                codec = choose_codec(metadata['compression'])
+            
+            mode = 'r+b' if held_bytes else 'w+b'
+            if held_bytes:
+                held = sum(end - start for start, end in have)
+                logger.info(f"↪️  Resuming: {held}/{total_packets} packets already downloaded")
+            
+            # Unbuffered: write-behind already hands the disk large blocks
+            with open(partial.part_path, mode, buffering=0) as f:
+                try:
+                    # Claim the whole file now, so a full disk fails the transfer before it starts
+                    check_space(output_path.parent, file_size - os.fstat(f.fileno()).st_size)
+                    preallocate(f, file_size)
+                except Exception as e:
+                    self._send_json({'status': 'ERROR', 'message': str(e)})
+                    if not held_bytes:
+                        f.close()
+                        partial.discard()
+                    raise
                 
-                while packet_num < total_packets:
-                    try:
-                        # Receive packet
-                        packet = self._receive_json()
+                cumulative = 0      # Every packet below this index is written
+                pending = set()     # Packets written beyond the cumulative point
+                for start, end in have:
+                    pending.update(range(start, end))
+                while cumulative in pending:
+                    pending.remove(cumulative)
+                    cumulative += 1
+                held_packets = set(pending)
+                
+                if identity:
+                    partial.save(identity, held_bytes)
+                last_saved = time.time()
+                
+                # Send ready signal
+                ready = {'status': 'READY'}
+                if identity:
+                    ready['have'] = have
+                if codec:
+                    ready['compression'] = codec
+                self._send_json(ready)
+                
+                # Receive file packets
+                progress = self._progress_bar(file_size, f"Downloading {filename}")
+                
+                hasher = StreamHasher()
+                hasher.update_from_file(f, 0, min(cumulative * packet_size, file_size))
+                reported = cumulative + len(pending)
+                ended = {}      # The control message that ended the transfer
+                buffers = BufferPool(packet_size + SEAL_OVERHEAD)
+                writer = WriteBehind(f, self.config.durability)
+                
+                def receive(_):
+                    """Read packets off the socket until the sender ends the transfer"""
+                    next_index = cumulative
+                    while True:
+                        pipeline.wait_readable(self._channel.socket)
+                        buffer = buffers.take()
+                        frame = self._channel.receive(buffer)
+                        if frame.type == FRAME_CONTROL:
+                            if frame.payload.get('type') not in ('CANCEL', 'ERROR', 'COMPLETE'):
+                                raise Exception(f"Unexpected message {frame.payload.get('type')}")
+                            ended.update(frame.payload)
+                            return
                         
-                        if packet.get('type') == 'CANCEL':
-                            logger.error("\n❌ Transfer cancelled by sender")
-                            output_path.unlink()
-                            return False
+                        # Senders go through the packets they send in order
+                        if frame.offset is None:
+                            index = next_index
+                        elif frame.offset % packet_size == 0:
+                            index = frame.offset // packet_size
+                        else:
+                            index = -1
                         
-                        if packet.get('type') == 'ERROR':
-                            logger.error(f"\n❌ Transfer error: {packet.get('message')}")
-                            output_path.unlink()
-                            return False
+                        if index < next_index or index >= total_packets or index in held_packets:
+                            raise Exception(f"Unexpected packet offset {frame.offset}")
+                        next_index = index + 1
                         
-                        if packet.get('type') == 'COMPLETE':
-                            break
+                        yield index, buffer, frame.flags, frame.payload
+                
+                def verify(items):
+                    """Decompress packets and hash them as the stream passes"""
+                    with open(partial.part_path, 'rb') as kept:
+                        for index, buffer, flags, payload in items:
+                            offset = index * packet_size
+                            if flags & FLAG_COMPRESSED:
+                                if not codec:
+                                    raise Exception("Compressed packet without a negotiated codec")
+                                payload = decompress(codec, payload,
+                                                     min(packet_size, file_size - offset))
+                            # Packets kept from an interrupted transfer are hashed from disk
+                            if hasher.position < offset:
+                                hasher.update_from_file(kept, hasher.position,
+                                                        offset - hasher.position)
+                            hasher.update(payload, offset)
+                            yield index, buffer, payload
+                
+                def write(items):
+                    """Write packets at their offsets, acknowledging and checkpointing as they land"""
+                    nonlocal cumulative, reported, last_saved
+                    for index, buffer, payload in items:
+                        writer.write(payload, index * packet_size,
+                                     lambda buffer=buffer: buffers.give(buffer))
                         
-                        # Write packet data
-                        data = bytes.fromhex(packet['data'])
-                        f.write(data)
+                        pending.add(index)
+                        while cumulative in pending:
+                            pending.remove(cumulative)
+                            cumulative += 1
                         
-                        # Send acknowledgment
-                        self._send_json({'status': 'ACK'})
+                        received = cumulative + len(pending)
+                        progress.update(min(file_size, received * packet_size))
                         
-                        packet_num += 1
-                        progress.update(packet_num)
+                        # Send acknowledgment
+                        if legacy:
+                            self._send_json({'status': 'ACK'})
+                        elif received - reported >= ack_interval or received == total_packets:
+                            self._send_json({
+                                'type': 'ACK',
+                                'ack': cumulative,
+                                'sack': self._packet_ranges(pending)
+                            })
+                            reported = received
                         
-                    except KeyboardInterrupt:
-                        self._send_json({'type': 'CANCEL'})
-                        logger.error("\n❌ Transfer cancelled by user")
-                        output_path.unlink()
+                        # Checkpoint the manifest so a dropped link loses little
+                        if identity and time.time() - last_saved >= self.MANIFEST_INTERVAL:
+                            self._keep_partial(writer, partial, identity, cumulative, pending,
+                                               packet_size, file_size)
+                            last_saved = time.time()
+                        yield index
+                
+                # Socket reads, decompression/hashing and disk writes overlap on
+                # their own threads; ACKs go out from the write stage
+                pipeline = Pipeline(Stage('receive', receive), Stage('verify', verify),
+                                    Stage('write', write))
+                pipeline.start()
+                
+                try:
+                    pipeline.join()
+                    
+                    if ended.get('type') == 'CANCEL':
+                        logger.error("\n❌ Transfer cancelled by sender")
+                        self._keep_partial(writer, partial, identity, cumulative, pending,
+                                           packet_size, file_size)
                         return False
-                    except Exception as e:
-                        logger.error(f"\n❌ Interference in data transfer: {e}")
-                        output_path.unlink()
+                    
+                    if ended.get('type') == 'ERROR':
+                        logger.error(f"\n❌ Transfer error: {ended.get('message')}")
+                        self._keep_partial(writer, partial, identity, cumulative, pending,
+                                           packet_size, file_size)
                         return False
+                    
+                    if cumulative < total_packets:
+                        raise Exception(f"Missing packets from {cumulative}")
+                    expected_checksum = ended.get('checksum', expected_checksum)
+                    
+                    # Packets held from an interrupted transfer may end the file
+                    if hasher.position < file_size:
+                        hasher.update_from_file(f, hasher.position, file_size - hasher.position)
+                    writer.close()
+                    
+                except KeyboardInterrupt:
+                    pipeline.abort()
+                    self._send_json({'type': 'CANCEL'})
+                    logger.error("\n❌ Transfer cancelled by user")
+                    self._keep_partial(writer, partial, identity, cumulative, pending,
+                                       packet_size, file_size)
+                    return False
+                except Exception as e:
+                    pipeline.abort()
+                    logger.error(f"\n❌ Interference in data transfer: {e}")
+                    self._keep_partial(writer, partial, identity, cumulative, pending,
+                                       packet_size, file_size)
+                    return False
+                finally:
+                    writer.abandon()
             
             progress.finish()
+            pipeline.report()
+            self.record.add_pipeline(pipeline, {'receive': 'network', 'verify': 'hash', 'write': 'disk'})
             
             # Verify checksum
-            actual_checksum = self._calculate_checksum(output_path)
-            
-            if actual_checksum == expected_checksum:
+            if hasher.hexdigest() == expected_checksum:
+                partial.complete(output_path, self.config.durability)
                 self._send_json({'status': 'SUCCESS'})
                 logger.info(f"✅ Saved to: {output_path}")
                 return True
             else:
                 self._send_json({'status': 'ERROR', 'message': 'Checksum mismatch'})
                 logger.error("❌ File verification failed")
-                output_path.unlink()
+                partial.discard()
                 return False
                 
         except ConnectionError:
@@ -200,28 +846,349 @@ class FileTransfer:
             logger.error(f"❌ Receive failed: {e}")
             return False
     
+    def _receive_striped(self, metadata, output_path):
+        """Receive a file whose stripes arrive on parallel connections"""
+        from .striping import StripeReceiver
+        
+        stripes = metadata['stripes']
+        joins = self.connection.expect_streams(metadata['session'])
+        receivers = []
+        
+        # Striped transfers always start over; stripes are verified as a whole
+        partial = PartialDownload(output_path.parent, output_path.name)
+        partial.discard()
+        
+        try:
+            try:
+                check_space(output_path.parent, metadata['size'])
+                with open(partial.part_path, 'w+b') as f:
+                    preallocate(f, metadata['size'])
+            except Exception as e:
+                self._send_json({'status': 'ERROR', 'message': str(e)})
+                partial.discard()
+                raise
+            
+            self._send_json({'status': 'READY', 'streams': len(stripes)})
+            
+            progress = self._progress_bar(metadata['size'],
+                                          f"Downloading {output_path.name} ({len(stripes)} streams)")
+            
+            # Collect a connection per stripe; the sender may give up meanwhile
+            channels = {}
+            deadline = time.time() + self.STREAM_TIMEOUT
+            while len(channels) < len(stripes):
+                try:
+                    index, channel = joins.get(timeout=0.2)
+                except queue.Empty:
+                    readable, _, _ = select.select([self.connection.socket], [], [], 0)
+                    if readable:
+                        message = self._receive_json()
+                        raise Exception(message.get('message', 'Transfer aborted by sender'))
+                    if time.time() > deadline:
+                        raise Exception("Timed out waiting for transfer streams")
+                    continue
+                
+                if index in channels or not 0 <= index < len(stripes):
+                    channel.socket.close()
+                    raise Exception(f"Unexpected stream {index}")
+                channels[index] = channel
+            
+            for index, channel in sorted(channels.items()):
+                start, end = stripes[index]
+                receivers.append(StripeReceiver(channel, partial.part_path, index, start, end,
+                                                progress.advance))
+            for receiver in receivers:
+                receiver.start()
+            
+            # The control connection carries the outcome of the whole transfer
+            message = self._receive_json()
+            if message.get('type') != 'COMPLETE':
+                raise Exception(message.get('message', 'Transfer cancelled by sender'))
+            
+            for receiver in receivers:
+                receiver.join()
+            
+            progress.finish()
+            
+            failed = [receiver for receiver in receivers if not receiver.ok]
+            if failed:
+                self._send_json({'status': 'ERROR', 'message': failed[0].error})
+                logger.error("❌ File verification failed")
+                partial.discard()
+                return False
+            
+            partial.complete(output_path, self.config.durability)
+            self._send_json({'status': 'SUCCESS'})
+            logger.info(f"✅ Saved to: {output_path}")
+            return True
+            
+        except Exception as e:
+            for receiver in receivers:
+                receiver.close()
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            partial.discard()
+            return False
+        finally:
+            self.connection.release_streams(metadata['session'])
+    
+    def _receive_delta(self, metadata, output_path, partial):
+        """Rebuild a new version of output_path from its current blocks plus literals"""
+        from .delta import block_signatures, choose_block_size
+        
+        old_size = output_path.stat().st_size
+        block_size = choose_block_size(old_size)
+        partial.discard()
+        
+        with open(output_path, 'rb') as old:
+            table = block_signatures(old, old_size, block_size)
+            self._send_json({
+                'status': 'READY',
+                'delta': {'block_size': block_size, 'size': old_size, 'table_size': len(table)}
+            })
+            for start in range(0, len(table), self.MAX_PACKET_SIZE):
+                self._channel.send_data(table[start:start + self.MAX_PACKET_SIZE], start)
+            
+            progress = self._progress_bar(metadata['size'], f"Downloading {output_path.name} (delta)")
+            buffer = bytearray(block_size)
+            hasher = StreamHasher()
+            
+            try:
+                with open(partial.part_path, 'wb', buffering=0) as f:
+                    while True:
+                        frame = self._channel.receive()
+                        
+                        if frame.type == FRAME_DATA:
+                            if frame.offset != hasher.position:
+                                raise Exception(f"Unexpected literal at {frame.offset}")
+                            f.write(frame.payload)
+                            hasher.update(frame.payload, frame.offset)
+                        
+                        elif frame.payload.get('type') == 'COPY':
+                            message = frame.payload
+                            if message['offset'] != hasher.position:
+                                raise Exception(f"Unexpected copy at {message['offset']}")
+                            
+                            # Reuse blocks from the copy already on disk
+                            start = message['block'] * block_size
+                            end = min(old_size, start + message['count'] * block_size)
+                            old.seek(start)
+                            while start < end:
+                                view = memoryview(buffer)[:min(block_size, end - start)]
+                                read = old.readinto(view)
+                                if not read:
+                                    raise Exception("Local copy changed during transfer")
+                                f.write(view[:read])
+                                hasher.update(view[:read], hasher.position)
+                                start += read
+                        
+                        elif frame.payload.get('type') == 'COMPLETE':
+                            expected_checksum = frame.payload.get('checksum')
+                            break
+                        
+                        else:
+                            logger.error(f"\n❌ Transfer error: "
+                                         f"{frame.payload.get('message', 'Cancelled by sender')}")
+                            partial.discard()
+                            return False
+                        
+                        progress.update(hasher.position)
+            except Exception as e:
+                logger.error(f"\n❌ Interference in data transfer: {e}")
+                partial.discard()
+                return False
+        
+        progress.finish()
+        
+        # Verify checksum
+        if hasher.hexdigest() == expected_checksum:
+            partial.complete(output_path, self.config.durability)
+            self._send_json({'status': 'SUCCESS'})
+            logger.info(f"✅ Updated: {output_path}")
+            return True
+        else:
+            self._send_json({'status': 'ERROR', 'message': 'Checksum mismatch'})
+            logger.error("❌ File verification failed")
+            partial.discard()
+            return False
+    
+    def _receive_dedup(self, metadata, output_path, partial):
+        """Assemble a file from stored chunks plus the chunks the sender is asked for"""
+        from .chunkstore import store_for
+        from .compression import choose_codec, decompress
+        
+        store = store_for(self.config)
+        partial.discard()
+        codec = choose_codec(metadata.get('compression'))
+        ready = {'status': 'READY', 'dedup': True}
+        if codec:
+            ready['compression'] = codec
+        self._send_json(ready)
+        
+        try:
+            chunks = []
+            while True:
+                message = self._receive_json()
+                if message.get('type') != 'CHUNK_LIST':
+                    raise Exception(message.get('message', 'Transfer cancelled by sender'))
+                chunks.extend(message['chunks'])
+                if message.get('final'):
+                    break
+            
+            # Ask once for each chunk the store doesn't have; repeats come from the store
+            needed = set()
+            seen = set()
+            for index, (digest, _) in enumerate(chunks):
+                if digest not in seen and not store.has(digest):
+                    needed.add(index)
+                seen.add(digest)
+            self._send_json({'type': 'CHUNK_NEED', 'chunks': self._packet_ranges(needed)})
+            
+            progress = self._progress_bar(metadata['size'], f"Downloading {output_path.name} (dedup)")
+            hasher = StreamHasher()
+            
+            with open(partial.part_path, 'wb', buffering=0) as f:
+                for index, (digest, length) in enumerate(chunks):
+                    if index in needed:
+                        frame = self._channel.receive()
+                        if frame.type == FRAME_CONTROL:
+                            raise Exception(frame.payload.get('message', 'Transfer cancelled by sender'))
+                        data = frame.payload
+                        if frame.flags & FLAG_COMPRESSED and codec:
+                            data = decompress(codec, data, length)
+                        if frame.offset != hasher.position or len(data) != length:
+                            raise Exception(f"Unexpected chunk at {frame.offset}")
+                        store.put(digest, data)
+                    else:
+                        data = store.read(digest)
+                    
+                    f.write(data)
+                    hasher.update(data, hasher.position)
+                    progress.update(hasher.position)
+            
+            message = self._receive_json()
+            if message.get('type') != 'COMPLETE':
+                raise Exception(message.get('message', 'Transfer cancelled by sender'))
+            
+        except Exception as e:
+            logger.error(f"\n❌ Interference in data transfer: {e}")
+            partial.discard()
+            return False
+        finally:
+            store.evict()
+            store.save()
+        
+        progress.finish()
+        
+        # Verify checksum
+        if hasher.position == metadata['size'] and hasher.hexdigest() == message.get('checksum'):
+            partial.complete(output_path, self.config.durability)
+            self._send_json({'status': 'SUCCESS'})
+            reused = metadata['size'] - sum(chunks[index][1] for index in needed)
+            logger.info(f"♻️  Reused {self._format_size(reused)} from the chunk store")
+            logger.info(f"✅ Saved to: {output_path}")
+            return True
+        else:
+            self._send_json({'status': 'ERROR', 'message': 'Checksum mismatch'})
+            logger.error("❌ File verification failed")
+            partial.discard()
+            return False
+    
+    def _keep_partial(self, writer, partial, identity, cumulative, pending, packet_size, file_size):
+        """Flush written packets and record them in the manifest, or discard if not resumable"""
+        if not identity:
+            writer.abandon()
+            writer.f.close()
+            partial.discard()
+            return
+        
+        try:
+            writer.sync()
+        except Exception as e:
+            # The last checkpoint still describes what safely reached the disk
+            logger.debug(f"Could not flush partial download: {e}")
+            return
+        ranges = [[0, min(cumulative * packet_size, file_size)]]
+        for start, end in self._packet_ranges(pending):
+            ranges.append([start * packet_size, min(end * packet_size, file_size)])
+        partial.save(identity, ranges)
+    
+    def _held_packets(self, byte_ranges, packet_size, file_size):
+        """Packet ranges fully covered by already written byte ranges"""
+        total_packets = (file_size + packet_size - 1) // packet_size
+        packets = []
+        for start, end in byte_ranges:
+            first = -(-start // packet_size)
+            last = total_packets if end >= file_size else end // packet_size
+            if first < last:
+                packets.append([first, last])
+        return packets
+    
+    def _missing_packets(self, total_packets, have):
+        """Yield packet indices not covered by the peer's held ranges"""
+        index = 0
+        for start, end in sorted(have) + [[total_packets, total_packets]]:
+            while index < min(start, total_packets):
+                yield index
+                index += 1
+            index = max(index, end)
+    
+    def _window_size(self, packet_size):
+        """Number of packets allowed in flight before waiting for an ACK"""
+        if self._channel.version == LEGACY_VERSION:
+            return 1
+        if self.config.transfer_window > 0:
+            return self.config.transfer_window
+        if self.connection.link:
+            return self.connection.link.window_for(packet_size)
+        # Auto: keep roughly WINDOW_BYTES on the wire
+        return min(self.MAX_WINDOW, max(self.MIN_WINDOW, self.WINDOW_BYTES // packet_size))
+    
+    def _process_ack(self, message, acked, in_flight):
+        """
+        Apply an acknowledgment from the receiver.
+        Returns the new cumulative ACK and drops acknowledged packets from in_flight.
+        """
+        if message.get('type') == 'CANCEL':
+            raise Exception("Transfer cancelled by receiver")
+        
+        if message.get('type') == 'ACK':
+            acked = max(acked, message['ack'])
+            sack = message.get('sack', [])
+            in_flight.difference_update([
+                index for index in in_flight
+                if index < acked or any(start <= index < end for start, end in sack)
+            ])
+            return acked
+        
+        # Legacy receivers acknowledge one packet at a time
+        if message.get('status') == 'ACK' and in_flight:
+            in_flight.remove(min(in_flight))
+            return acked + 1
+        
+        raise Exception("Packet not acknowledged")
+    
+    def _packet_ranges(self, indices):
+        """Compress packet indices into sorted [start, end) ranges"""
+        ranges = []
+        for index in sorted(indices):
+            if ranges and ranges[-1][1] == index:
+                ranges[-1][1] = index + 1
+            else:
+                ranges.append([index, index + 1])
+        return ranges
+    
+    @property
+    def _channel(self):
+        """Message channel negotiated for the current connection"""
+        return self.connection.channel
+    
     def _send_json(self, data):
-        """Send JSON data"""
-        message = json.dumps(data).encode()
-        length = len(message).to_bytes(4, 'big')
-        self.connection.socket.sendall(length + message)
+        """Send a JSON control message"""
+        self._channel.send_control(data)
     
     def _receive_json(self):
-        """Receive JSON data"""
-        length_bytes = self._receive_exact(4)
-        length = int.from_bytes(length_bytes, 'big')
-        message = self._receive_exact(length)
-        return json.loads(message.decode())
-    
-    def _receive_exact(self, num_bytes):
-        """Receive exact number of bytes"""
-        data = b''
-        while len(data) < num_bytes:
-            chunk = self.connection.socket.recv(num_bytes - len(data))
-            if not chunk:
-                raise ConnectionError("Connection closed")
-            data += chunk
-        return data
+        """Receive a JSON control message"""
+        return self._channel.receive_control()
     
     def _calculate_checksum(self, file_path):
         """Calculate SHA256 checksum of file"""
@@ -0,0 +1,211 @@
+"""
+Transport Autotuning for Pig3on
+Measures the link during pairing and derives packet size, window and socket buffers
+"""
+
+import math
+import socket
+import time
+from utils.logger import get_logger
+from .protocol import FRAME_CONTROL
+
+logger = get_logger(__name__)
+
+PROBE_PINGS = 4
+PROBE_BYTES = 1024 * 1024       # Burst used to estimate bandwidth
+PROBE_FRAME = 64 * 1024
+PROBE_TIMEOUT = 5.0
+
+MIN_PACKET_SIZE = 64 * 1024
+MAX_PACKET_SIZE = 1024 * 1024
+PACKET_TIME = 0.25              # Longest a packet should take on the wire, for progress and resume
+MIN_IN_FLIGHT = 8 * 1024 * 1024     # Per-packet overhead dominates below this, even on fast LANs
+MAX_IN_FLIGHT = 64 * 1024 * 1024
+MAX_BUFFER = 16 * 1024 * 1024
+MIN_WINDOW = 2
+MAX_WINDOW = 256
+PACKETS_PER_WINDOW = 8          # Packets per window, so ACKs keep the pipe full
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+class LinkProfile:
+    """Measured RTT and bandwidth of a peer link, and the transport settings they imply"""
+
+    def __init__(self, rtt, bandwidth):
+        self.rtt = rtt                  # Seconds
+        self.bandwidth = bandwidth      # Bytes per second
+        self.nodelay = True             # Headers and payloads are separate writes
+        self._min_rtt = None
+        self._max_rate = None
+
+    @property
+    def in_flight(self):
+        """Bytes to keep unacknowledged: twice the bandwidth-delay product"""
+        return int(_clamp(2 * self.bandwidth * self.rtt, MIN_IN_FLIGHT, MAX_IN_FLIGHT))
+
+    @property
+    def packet_size(self):
+        """Packet size for large files on this link, in 4 KB steps"""
+        size = min(self.in_flight // PACKETS_PER_WINDOW, self.bandwidth * PACKET_TIME)
+        return int(_clamp(size, MIN_PACKET_SIZE, MAX_PACKET_SIZE)) // 4096 * 4096
+
+    @property
+    def buffer_size(self):
+        """Socket buffer that can hold the bandwidth-delay product"""
+        return int(_clamp(2 * self.bandwidth * self.rtt, 256 * 1024, MAX_BUFFER))
+
+    def packet_for(self, file_size):
+        """Packet size for a file: small files go in a single packet"""
+        return _clamp(file_size, 4096, self.packet_size)
+
+    def window_for(self, packet_size):
+        """Packets in flight that cover the tuned byte window"""
+        return _clamp(math.ceil(self.in_flight / packet_size), MIN_WINDOW, MAX_WINDOW)
+
+    def begin(self):
+        """Start collecting samples for a new transfer"""
+        self._min_rtt = None
+        self._max_rate = None
+
+    def observe(self, rtt=None, rate=None):
+        """
+        Fold in samples from a running transfer. Minimum RTT and maximum
+        delivery rate are used, so queueing behind our own window doesn't
+        feed back into a larger window.
+        """
+        if rtt:
+            self._min_rtt = min(self._min_rtt or rtt, rtt)
+            self.rtt = self._min_rtt
+        if rate:
+            self._max_rate = max(self._max_rate or rate, rate)
+            self.bandwidth = max(self.bandwidth, self._max_rate)
+
+    def finish(self):
+        """Settle on this transfer's measurements so a slower link can lower the estimate"""
+        if self._max_rate:
+            self.bandwidth = self._max_rate
+
+    def apply(self, sock):
+        """Apply socket options, growing kernel buffers only when they are too small"""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                if sock.getsockopt(socket.SOL_SOCKET, option) < self.buffer_size:
+                    sock.setsockopt(socket.SOL_SOCKET, option, self.buffer_size)
+            except OSError as e:
+                logger.debug(f"Could not size socket buffer: {e}")
+
+    def describe(self):
+        """Human readable summary for status output"""
+        return (f"RTT {self.rtt * 1000:.1f} ms, {self.bandwidth * 8 / 1e6:.0f} Mbit/s, "
+                f"packet {self.packet_size // 1024} KB, window {self.window_for(self.packet_size)}, "
+                f"buffers {self.buffer_size // 1024} KB")
+
+    def to_dict(self):
+        """Serializable form persisted per peer in the config"""
+        return {'rtt': self.rtt, 'bandwidth': self.bandwidth}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a profile from its persisted form"""
+        return cls(data['rtt'], data['bandwidth'])
+
+
+class WindowTuner:
+    """Re-derives a transfer's window from ACK timing while it runs"""
+
+    SAMPLE_INTERVAL = 0.05  # Minimum seconds between delivery rate samples
+
+    def __init__(self, link, sock, packet_size, window, on_rtt=None):
+        self.link = link
+        self.sock = sock
+        self.packet_size = packet_size
+        self.window = window
+        # The receiver acknowledges every window // 4 packets of the window it
+        # was told about, so shrinking much below that would stall the sender
+        self.min_window = max(MIN_WINDOW, window // 2)
+        self._sent_at = {}
+        self._buffer = link.buffer_size
+        self._delivered = 0
+        self._sample_start = time.time()
+        self._on_rtt = on_rtt     # Called with each RTT sample, e.g. for metrics
+        link.begin()
+
+    def on_send(self, packet):
+        """Record when a packet went out"""
+        self._sent_at[packet] = time.time()
+
+    def on_ack(self, acknowledged):
+        """Sample RTT and delivery rate from newly acknowledged packets; returns the window"""
+        now = time.time()
+        sent = [self._sent_at.pop(packet) for packet in acknowledged if packet in self._sent_at]
+        if not sent:
+            return self.window
+
+        # The most recently sent packet saw the least queueing
+        rtt = now - max(sent)
+        self.link.observe(rtt=rtt)
+        if self._on_rtt:
+            self._on_rtt(rtt)
+
+        self._delivered += len(sent) * self.packet_size
+        elapsed = now - self._sample_start
+        if elapsed >= max(self.SAMPLE_INTERVAL, self.link.rtt):
+            self.link.observe(rate=self._delivered / elapsed)
+            self._delivered = 0
+            self._sample_start = now
+
+        self.window = max(self.min_window, self.link.window_for(self.packet_size))
+        if self.link.buffer_size > self._buffer:
+            self.link.apply(self.sock)
+            self._buffer = self.link.buffer_size
+        return self.window
+
+
+def probe_link(channel):
+    """Measure RTT with pings and bandwidth with a short burst; the peer runs answer_probe"""
+    samples = []
+    for seq in range(PROBE_PINGS):
+        started = time.perf_counter()
+        channel.send_control({'type': 'PING', 'seq': seq})
+        reply = channel.receive_control()
+        if reply.get('type') != 'PONG' or reply.get('seq') != seq:
+            raise Exception("Unexpected probe reply")
+        samples.append(time.perf_counter() - started)
+    rtt = max(min(samples), 1e-5)
+
+    burst = bytes(PROBE_FRAME)
+    started = time.perf_counter()
+    for offset in range(0, PROBE_BYTES, PROBE_FRAME):
+        channel.send_data(burst, offset)
+    channel.send_control({'type': 'PROBE_END'})
+    if channel.receive_control().get('type') != 'PROBE_ACK':
+        raise Exception("Unexpected probe reply")
+    elapsed = time.perf_counter() - started
+
+    # The ACK's trip back isn't part of the transfer time
+    bandwidth = PROBE_BYTES / max(elapsed - rtt / 2, rtt / 2)
+    link = LinkProfile(rtt, bandwidth)
+    channel.send_control({'type': 'LINK', **link.to_dict()})
+    return link
+
+
+def answer_probe(channel):
+    """Answer a peer's probe_link and return the profile it measured"""
+    while True:
+        frame = channel.receive()
+        if frame.type != FRAME_CONTROL:
+            continue  # Burst data only needs to arrive
+        message = frame.payload
+        kind = message.get('type')
+        if kind == 'PING':
+            channel.send_control({'type': 'PONG', 'seq': message.get('seq')})
+        elif kind == 'PROBE_END':
+            channel.send_control({'type': 'PROBE_ACK'})
+        elif kind == 'LINK':
+            return LinkProfile.from_dict(message)
+        else:
+            raise Exception(f"Unexpected probe message {kind}")
@@ -1,7 +1,18 @@
 """Utility functions for Pig3on"""
 
-from .logger import setup_logger, get_logger
-from .progress import ProgressBar
-from .crypto import CryptoHelper
+from importlib import import_module
 
-__all__ = ['setup_logger', 'get_logger', 'ProgressBar', 'CryptoHelper']
\ No newline at end of file
+# Name -> submodule; imported on first access so `import utils.x` stays cheap
+_EXPORTS = {
+    'setup_logger': 'logger',
+    'get_logger': 'logger',
+    'ProgressBar': 'progress',
+    'CryptoHelper': 'crypto',
+}
+
+__all__ = ['setup_logger', 'get_logger', 'ProgressBar', 'CryptoHelper']
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(import_module(f'.{_EXPORTS[name]}', __name__), name)
@@ -1,30 +1,156 @@
 """
 Cryptography helper for Pig3on
-Simple encryption wrapper for future encryption support
+Session key agreement and authenticated per-chunk encryption
 """
 
 import hashlib
+import struct
+import threading
+from itertools import count
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    AEAD_AVAILABLE = True
+except ImportError:
+    AEAD_AVAILABLE = False
+
+NONCE = struct.Struct('!IQ')    # Lane, counter
+TAG_SIZE = 16
+SEAL_OVERHEAD = NONCE.size + TAG_SIZE
+
+
+class ChunkCipher:
+    """
+    AES-256-GCM for one direction of a session. Every sealed chunk carries
+    its own nonce, made of a lane and a counter, so chunks can be sealed and
+    opened on any thread in any order. Each channel seals on a lane of its
+    own; opening refuses a nonce that was already accepted on that lane.
+    """
+
+    REPLAY_WINDOW = 4096    # Nonces a lane may arrive out of order by
+
+    def __init__(self, key):
+        self._aead = AESGCM(key)
+        self._lanes = count()
+        self._seen = {}     # Lane -> (highest counter, bitmap of the window below it)
+        self._lock = threading.Lock()
+
+    def lane(self):
+        """A new nonce sequence for one channel"""
+        return _Lane(self._aead, next(self._lanes))
+
+    def open(self, payload, associated=b''):
+        """Authenticate and decrypt a sealed chunk; raises ValueError if it was forged or replayed"""
+        if len(payload) < SEAL_OVERHEAD:
+            raise ValueError("Sealed chunk too short")
+        nonce = bytes(payload[:NONCE.size])
+        lane, counter = NONCE.unpack(nonce)
+        if not self._fresh(lane, counter):
+            raise ValueError("Replayed chunk")
+        try:
+            data = self._aead.decrypt(nonce, bytes(payload[NONCE.size:]), associated)
+        except InvalidTag:
+            raise ValueError("Chunk failed authentication")
+        self._accept(lane, counter)
+        return data
+
+    def _fresh(self, lane, counter):
+        with self._lock:
+            highest, bitmap = self._seen.get(lane, (-1, 0))
+        if counter > highest:
+            return True
+        behind = highest - counter
+        return behind < self.REPLAY_WINDOW and not bitmap >> behind & 1
+
+    def _accept(self, lane, counter):
+        with self._lock:
+            highest, bitmap = self._seen.get(lane, (-1, 0))
+            if counter > highest:
+                shift = counter - highest
+                bitmap = (bitmap << shift | 1) if shift < self.REPLAY_WINDOW else 1
+                highest = counter
+            else:
+                behind = highest - counter
+                if bitmap >> behind & 1:
+                    raise ValueError("Replayed chunk")
+                bitmap |= 1 << behind
+            self._seen[lane] = (highest, bitmap & ((1 << self.REPLAY_WINDOW) - 1))
+
+
+class _Lane:
+    """Seals chunks with nonces that are never reused under the lane's key"""
+
+    def __init__(self, aead, lane):
+        self._aead = aead
+        self._lane = lane
+        self._counter = count()
+
+    def seal(self, data, associated=b''):
+        """Encrypt and authenticate data; the result is nonce + ciphertext + tag"""
+        nonce = NONCE.pack(self._lane, next(self._counter))
+        return nonce + self._aead.encrypt(nonce, bytes(data), associated)
+
 
 class CryptoHelper:
     """Helper class for encryption operations"""
-    
+
+    KEY_INFO = b'pig3on session keys v1'
+
     def __init__(self):
-        pass
-    
+        self._private = None
+        self.sealer = None      # ChunkCipher for what we send
+        self.opener = None      # ChunkCipher for what we receive
+        self.code = None        # Short fingerprint both peers can compare
+        self._lane = None
+
     def hash_data(self, data):
         """Hash data using SHA256"""
         if isinstance(data, str):
             data = data.encode()
         return hashlib.sha256(data).hexdigest()
-    
+
+    def key_share(self):
+        """Start a key exchange; returns our public share for the HELLO, or None without a backend"""
+        if not AEAD_AVAILABLE:
+            return None
+        self._private = X25519PrivateKey.generate()
+        return self._public_bytes().hex()
+
+    def agree(self, peer_share, initiator):
+        """Derive a key for each direction from the peer's share and ours"""
+        ours = self._public_bytes()
+        theirs = bytes.fromhex(peer_share)
+        secret = self._private.exchange(X25519PublicKey.from_public_bytes(theirs))
+        self._private = None
+
+        # Both sides order the shares the same way: the connecting peer's first
+        shares = ours + theirs if initiator else theirs + ours
+        keys = HKDF(algorithm=hashes.SHA256(), length=64, salt=None,
+                    info=self.KEY_INFO + shares).derive(secret)
+        outgoing, incoming = (keys[:32], keys[32:]) if initiator else (keys[32:], keys[:32])
+        self.sealer = ChunkCipher(outgoing)
+        self.opener = ChunkCipher(incoming)
+        digest = hashlib.sha256(keys).hexdigest().upper()
+        self.code = f"{digest[:4]}-{digest[4:8]}"
+
+    def _public_bytes(self):
+        return self._private.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+
     def encrypt(self, data):
-        """Encrypt data (placeholder for future implementation)"""
-        # For now, return data as-is
-        # In future, can add AES encryption
-        return data
-    
+        """Encrypt data with the session key (as-is before a key is agreed)"""
+        if self.sealer is None:
+            return data
+        if self._lane is None:
+            self._lane = self.sealer.lane()
+        return self._lane.seal(data)
+
     def decrypt(self, data):
-        """Decrypt data (placeholder for future implementation)"""
-        # For now, return data as-is
-        # In future, can add AES decryption
-        return data
\ No newline at end of file
+        """Decrypt data sealed by the peer's encrypt (as-is before a key is agreed)"""
+        if self.opener is None:
+            return data
+        return self.opener.open(data)
@@ -5,6 +5,7 @@ Logging utility for Pig3on
 import logging
 import sys
 from pathlib import Path
+from .progress import display
 
 # Color codes for terminal
 class Colors:
@@ -34,13 +35,20 @@ class ColoredFormatter(logging.Formatter):
         formatter = logging.Formatter(log_fmt)
         return formatter.format(record)
 
+class ConsoleHandler(logging.StreamHandler):
+    """Stream handler that moves the progress bars out of the way of each line"""
+    
+    def emit(self, record):
+        with display.paused():
+            super().emit(record)
+
 def setup_logger():
     """Setup main logger"""
     logger = logging.getLogger('pig3on')
     logger.setLevel(logging.INFO)
     
     # Console handler
-    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler = ConsoleHandler(sys.stdout)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(ColoredFormatter())
     
@@ -48,6 +56,12 @@ def setup_logger():
     
     return logger
 
+def log_to_stderr():
+    """Send console logging to stderr, leaving stdout to machine-readable output"""
+    for handler in logging.getLogger('pig3on').handlers:
+        if isinstance(handler, ConsoleHandler):
+            handler.setStream(sys.stderr)
+
 def get_logger(name):
     """Get logger for module"""
     return logging.getLogger(f'pig3on.{name}')
\ No newline at end of file
@@ -3,57 +3,205 @@ Progress bar utility for file transfers
 """
 
 import sys
+import json
 import time
+import threading
+import contextlib
+from itertools import count
+
+MODES = ('bar', 'json', 'none')
+REFRESH_INTERVAL = 0.1      # Seconds between redraws, however fast bytes arrive
+JSON_INTERVAL = 0.5         # Seconds between progress events in json mode
+RATE_HALF_LIFE = 2.0        # Seconds after which a throughput sample counts half as much
+
+
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size:.0f} B"
+        size /= 1024
+
+
+def _format_time(seconds):
+    """Format seconds to MM:SS"""
+    if seconds is None or seconds < 0:
+        return "--:--"
+    mins = int(seconds // 60)
+    secs = int(seconds % 60)
+    return f"{mins:02d}:{secs:02d}"
+
+
+class _Display:
+    """
+    Renders every active bar from one ticker thread, so transfers only
+    record their byte counts and never wait on the terminal. On a terminal
+    the bars are redrawn in place, one line each, below the log; in json
+    mode each bar emits newline-delimited JSON events on stdout instead.
+    """
+
+    def __init__(self):
+        self.mode = 'bar'
+        self.lock = threading.RLock()
+        self._bars = []
+        self._drawn = 0         # Bar lines on screen, the cursor at the end of the last
+        self._thread = None
+        self._ids = count(1)
+        self._last_event = 0.0
+
+    def add(self, bar):
+        with self.lock:
+            bar.id = next(self._ids)
+            self._bars.append(bar)
+            self._event(bar, 'start', total=bar.total)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+                self._thread.start()
+
+    def remove(self, bar, ok):
+        """Take a bar off the display, leaving its final line above the others if it finished"""
+        with self.lock:
+            if bar not in self._bars:
+                return
+            self._clear()
+            self._bars.remove(bar)
+            elapsed = time.time() - bar.start_time
+            if ok and self.mode == 'bar':
+                sys.stdout.write(bar.final_line(elapsed) + '\n')
+            self._event(bar, 'finish', bytes=bar.current, total=bar.total,
+                        seconds=round(elapsed, 3),
+                        rate=round(bar.current / elapsed) if elapsed > 0 else None, ok=ok)
+            self._draw()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Take the bars off the screen while something else writes to it"""
+        with self.lock:
+            self._clear()
+            try:
+                yield
+            finally:
+                self._draw()
+
+    def _live(self):
+        return self.mode == 'bar' and sys.stdout.isatty()
+
+    def _clear(self):
+        if self._drawn:
+            sys.stdout.write('\r\x1b[K' + '\x1b[1A\x1b[K' * (self._drawn - 1))
+            sys.stdout.flush()
+            self._drawn = 0
+
+    def _draw(self):
+        if not self._bars or not self._live():
+            return
+        self._clear()
+        sys.stdout.write('\n'.join(bar.line() + '\x1b[K' for bar in self._bars))
+        sys.stdout.flush()
+        self._drawn = len(self._bars)
+
+    def _event(self, bar, event, **fields):
+        if self.mode != 'json':
+            return
+        sys.stdout.write(json.dumps({'event': event, 'id': bar.id, 'name': bar.description,
+                                     **fields, 'time': round(time.time(), 3)}) + '\n')
+        sys.stdout.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(REFRESH_INTERVAL)
+            with self.lock:
+                if not self._bars:
+                    self._thread = None
+                    return
+                now = time.time()
+                for bar in self._bars:
+                    bar.sample(now)
+                if self.mode == 'json' and now - self._last_event >= JSON_INTERVAL:
+                    self._last_event = now
+                    for bar in self._bars:
+                        self._event(bar, 'progress', bytes=bar.current, total=bar.total,
+                                    rate=round(bar.rate or 0), eta=bar.eta)
+                self._draw()
+
+
+display = _Display()
+
+
+def set_mode(mode):
+    """Draw bars ('bar'), emit JSON events ('json') or show nothing ('none')"""
+    if mode not in MODES:
+        raise ValueError(f"Unknown progress mode: {mode}")
+    display.mode = mode
+
 
 class ProgressBar:
-    """Terminal progress bar with upload/download tracking"""
-    
+    """
+    Byte progress of one transfer. update() and advance() only record the
+    count; the display samples it on its own thread to keep an EWMA of the
+    throughput and redraws at REFRESH_INTERVAL.
+    """
+
     def __init__(self, total, description="Progress", bar_length=40):
-        self.total = total
+        self.total = total      # Bytes
         self.description = description
         self.bar_length = bar_length
         self.current = 0
         self.start_time = time.time()
-        
+        self.rate = None        # Bytes per second, smoothed
+        self.id = None
+        self._lock = threading.Lock()
+        self._sampled_at = self.start_time
+        self._sampled = 0
+        display.add(self)
+
     def update(self, current):
-        """Update progress bar"""
+        """Set the number of bytes done"""
         self.current = current
-        
-        # Calculate percentage
-        percent = (current / self.total) * 100
-        
-        # Calculate filled length
-        filled = int(self.bar_length * current / self.total)
-        bar = '█' * filled + '░' * (self.bar_length - filled)
-        
-        # Calculate speed and ETA
-        elapsed = time.time() - self.start_time
-        if elapsed > 0 and current > 0:
-            speed = current / elapsed
-            eta = (self.total - current) / speed if speed > 0 else 0
-            eta_str = self._format_time(eta)
-            speed_str = f"{speed:.1f} packets/s"
-        else:
-            eta_str = "--:--"
-            speed_str = "-- packets/s"
-        
-        # Print progress bar
-        sys.stdout.write(f'\r{self.description}: |{bar}| {percent:.1f}% | {speed_str} | ETA: {eta_str}')
-        sys.stdout.flush()
-    
+
+    def advance(self, count):
+        """Add to the bytes done; safe to call from several threads"""
+        with self._lock:
+            self.current += count
+
     def finish(self):
         """Complete progress bar"""
-        elapsed = time.time() - self.start_time
-        elapsed_str = self._format_time(elapsed)
-        
-        filled_bar = '█' * self.bar_length
-        sys.stdout.write(f'\r{self.description}: |{filled_bar}| 100.0% | Completed in {elapsed_str}\n')
-        sys.stdout.flush()
-    
-    def _format_time(self, seconds):
-        """Format seconds to MM:SS"""
-        if seconds < 0:
-            return "--:--"
-        mins = int(seconds // 60)
-        secs = int(seconds % 60)
-        return f"{mins:02d}:{secs:02d}"
\ No newline at end of file
+        self.current = self.total
+        display.remove(self, ok=True)
+
+    def close(self):
+        """Stop showing the bar without completing it, e.g. after a failure"""
+        display.remove(self, ok=False)
+
+    @property
+    def eta(self):
+        """Seconds left at the smoothed rate, or None before there is one"""
+        if not self.rate:
+            return None
+        return round(max(0, self.total - self.current) / self.rate, 1)
+
+    def sample(self, now):
+        """Fold the bytes done since the last sample into the smoothed rate"""
+        elapsed = now - self._sampled_at
+        if elapsed <= 0:
+            return
+        rate = (self.current - self._sampled) / elapsed
+        weight = 1 - 0.5 ** (elapsed / RATE_HALF_LIFE)
+        self.rate = rate if self.rate is None else self.rate + weight * (rate - self.rate)
+        self._sampled_at = now
+        self._sampled = self.current
+
+    def line(self):
+        """The bar as drawn while the transfer runs"""
+        fraction = min(1.0, self.current / self.total) if self.total else 1.0
+        filled = int(self.bar_length * fraction)
+        bar = '█' * filled + '░' * (self.bar_length - filled)
+        speed = f"{_format_size(self.rate)}/s" if self.rate is not None else "--/s"
+        return (f"{self.description}: |{bar}| {fraction * 100:.1f}% | "
+                f"{_format_size(self.current)} of {_format_size(self.total)} | "
+                f"{speed} | ETA: {_format_time(self.eta)}")
+
+    def final_line(self, elapsed):
+        """The bar as left on screen once the transfer completes"""
+        rate = f" ({_format_size(self.total / elapsed)}/s)" if elapsed > 0 else ""
+        return (f"{self.description}: |{'█' * self.bar_length}| 100.0% | "
+                f"Completed in {_format_time(elapsed)}{rate}")